@@ -39,7 +39,7 @@ class API_URI:
 app = Flask(__name__)
 sys_conf = SystemConfig()
 auth = HttpJwtAuth(PytempAuthorization())
-lru_redis_cache = LruCache(store_type=STORE_TYPE.REDIS, config_file_name=DMAI_CONFIG_FILE_PATH)
+lru_redis_cache = LruCache(store_type=STORE_TYPE.REDIS, config_file_name=DMAI_CONFIG_FILE_PATH, name='api_redis')
 
 
 def get_param_exception(errors):
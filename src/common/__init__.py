@@ -13,6 +13,7 @@ MODE_RUNTIME = 'test'
 DMAI_CONFIG_FILE_PATH = WORKING_DIR + '/resources/configs/dmai.conf'
 DMAI_LOG_CONFIG_FILE_PATH = WORKING_DIR + '/resources/configs/logging.conf'
 DMAI_LOG_FILE_PATH = WORKING_DIR + '/logs/pytemp.log'
+DMAI_CACHE_SNAPSHOT_DIR = WORKING_DIR + '/snapshots'
 
 DMAI_LANG_VI_FILE_PATH = WORKING_DIR + '/resources/lang/message_vi.json'
 DMAI_LANG_EN_FILE_PATH = WORKING_DIR + '/resources/lang/message_en.json'
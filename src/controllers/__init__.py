@@ -9,6 +9,11 @@ class PREFIX_CACHE_KEY:
     GET_INTENT = 'get_intent'
 
 
+class CACHE_TAG:
+    # template theo cú pháp str.format, bot_id là tham số hoặc thuộc tính của đối tượng
+    BOT = 'bot:{bot_id}'
+
+
 class CUSTOMER_STRUCTURE:
     ID = 'id'
     NAME = 'name'
@@ -6,7 +6,8 @@
     Date created: 2017/04/28
 """
 from src.apis import lru_redis_cache
-from src.controllers import CUSTOMER_STRUCTURE, META_CLASS, PREFIX_CACHE_KEY
+from src.common.my_except import InputNotFoundError
+from src.controllers import CUSTOMER_STRUCTURE, META_CLASS, PREFIX_CACHE_KEY, CACHE_TAG
 from src.controllers.base_controller import BaseController
 from src.libs.http_validator import Required, Length, Unicode, Range, In, InstanceOf, PhoneNumber, Email
 from src.libs.subscribe import subscribe_for_class
@@ -39,7 +40,9 @@ class BotController(BaseController):
 
     @subscribe_for_class(label=SUBSCRIBE_LABEL.DELETE_BOT_CONFIG, entity_id_index=1)
     def delete(self):
-        return BotConfigRepository().delete(self.bot_id)
+        result = BotConfigRepository().delete(self.bot_id)
+        self.invalidate_cache()
+        return result
 
     @subscribe_for_class(label=SUBSCRIBE_LABEL.UPDATE_BOT_CONFIG, entity_id_index=1)
     def set(self, bot_config):
@@ -75,13 +78,20 @@ class BotController(BaseController):
         }
         self.abort_if_data_invalid(rules_for_consumer, bot_config[BOT_STRUCTURE.CONSUMER])
 
-        return BotConfigRepository().get(self.bot_id)
-        # return BotConfigRepository().set(self.bot_id, bot_config)
+        result = BotConfigRepository().get(self.bot_id)
+        # result = BotConfigRepository().set(self.bot_id, bot_config)
+        self.invalidate_cache()
+        return result
 
-    @lru_redis_cache.add_for_class(prefix_key=PREFIX_CACHE_KEY.GET_INTENT)
+    @lru_redis_cache.add_for_class(prefix_key=PREFIX_CACHE_KEY.GET_INTENT, key_attrs=['bot_id'],
+                                   negative_exceptions=(InputNotFoundError,), tags=[CACHE_TAG.BOT])
     def get(self):
         return BotConfigRepository().get(self.bot_id)
 
+    def invalidate_cache(self):
+        """ xóa các value đã cache của bot, kể cả kết quả không tìm thấy """
+        lru_redis_cache.invalidate_tag(CACHE_TAG.BOT.format(bot_id=self.bot_id))
+
     def register(self, bot_config):
         self.abort_if_param_none_or_empty(bot_config, 'bot config')
         rules = {
@@ -111,4 +121,6 @@ class BotController(BaseController):
         }
         self.abort_if_data_invalid(rules_for_consumer, bot_config[BOT_STRUCTURE.CONSUMER])
 
-        return BotConfigRepository().register(self.bot_id, bot_config)
+        result = BotConfigRepository().register(self.bot_id, bot_config)
+        self.invalidate_cache()
+        return result
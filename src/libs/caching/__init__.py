@@ -10,45 +10,601 @@
     LRU Cache sẽ lưu lại trên RAM hoặc Redis
 """
 import configparser
+import hashlib
+import heapq
+import inspect
 import json
+import sys
 import threading
 import time
+import uuid
 import weakref
 from collections import OrderedDict
 from functools import wraps
 
 import redis
 
+from src.libs.caching.circuit_breaker import BREAKER_STATE, CircuitBreaker, MissedWrites
+from src.libs.caching.eviction import EVICTION_POLICY, create_policy
+from src.libs.caching.reaper import REAP_BATCH_DEFAULT, get_reaper
+from src.libs.caching.stats import CacheStats, LatencyHistogram, render_metrics
+from src.libs.caching.shared_store import SHARED_MAX_SIZE_DEFAULT, SharedMemoryCacheDict
+from src.libs.caching.snapshot import CacheSnapshot, SnapshotReader, write_snapshot
+from src.libs.caching.value_codec import CODEC, ValueCodec, get_codec
+from src.libs.thread_pool import OVERFLOW_POLICY, TaskRejectedError, ThreadPool
+
 
 class STORE_TYPE:
     LOCAL = 1
     REDIS = 2
+    SHARDED = 3
+    TIERED = 4
+    # dùng chung giữa các tiến trình trên cùng máy qua mmap, cần đặt name cho LruCache
+    SHARED = 5
 
 
 CACHE_MAX_SIZE_DEFAULT = 1024000
 EXPIRATION_DEFAULT = 15 * 60
+SHARDS_DEFAULT = 16
+LOCK_TIMEOUT_DEFAULT = 10
+
+
+def deep_sizeof(value, _seen=None):
+    """ ước lượng số byte bộ nhớ của value bằng cách cộng dồn sys.getsizeof của các phần tử con """
+    if _seen is None:
+        _seen = set()
+    if id(value) in _seen:
+        return 0
+    _seen.add(id(value))
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(deep_sizeof(k, _seen) + deep_sizeof(v, _seen) for k, v in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(deep_sizeof(v, _seen) for v in value)
+    elif hasattr(value, '__dict__'):
+        size += deep_sizeof(value.__dict__, _seen)
+    return size
+
+
+def encoded_sizeof(value):
+    """ số byte của value khi mã hóa json, rẻ hơn deep_sizeof với dữ liệu dạng json """
+    if isinstance(value, bytes):
+        return len(value)
+    return len(json.dumps(value, ensure_ascii=False, default=str).encode('utf-8'))
+
+
+def _create_store(store_type, config_file_name=None, max_size=CACHE_MAX_SIZE_DEFAULT,
+                  expiration=EXPIRATION_DEFAULT, shards=SHARDS_DEFAULT, max_bytes=None, size_estimator=None,
+                  codec=None, policy=None, name=None):
+    """ tạo kho lưu trữ cache theo store_type """
+    if store_type == STORE_TYPE.LOCAL:
+        return LRUCacheDict(max_size, expiration, max_bytes=max_bytes, size_estimator=size_estimator, policy=policy)
+    elif store_type == STORE_TYPE.SHARDED:
+        return ShardedLRUCacheDict(max_size, expiration, shards=shards, max_bytes=max_bytes,
+                                   size_estimator=size_estimator, policy=policy)
+    elif store_type == STORE_TYPE.REDIS:
+        if config_file_name is None:
+            raise ValueError('config_file_name must not be None if store_type is REDIS')
+        return RedisCacheDict(config_file_name, max_size, expiration, codec=codec)
+    elif store_type == STORE_TYPE.TIERED:
+        if config_file_name is None:
+            raise ValueError('config_file_name must not be None if store_type is TIERED')
+        return TieredCacheDict(config_file_name, max_size, expiration, codec=codec)
+    elif store_type == STORE_TYPE.SHARED:
+        if name is None:
+            raise ValueError('name must not be None if store_type is SHARED')
+        return SharedMemoryCacheDict(name, max_size, expiration, codec=codec)
+    else:
+        raise NotImplementedError('store_type=%s' % store_type)
+
+
+class SingleFlight(object):
+    """ Gộp các lần gọi trùng key đang chạy đồng thời: chỉ một thread thực hiện hàm,
+    các thread khác chờ và nhận cùng kết quả (hoặc cùng ngoại lệ).
+    """
+
+    class _Call(object):
+        __slots__ = ('event', 'value', 'error')
+
+        def __init__(self):
+            self.event = threading.Event()
+            self.value = None
+            self.error = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.value
+        try:
+            call.value = func()
+            return call.value
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+
+SWR_MARKER = '__swr__'
+REFRESH_WORKERS_DEFAULT = 4
+# quá số lần làm mới đang chờ này thì bỏ qua, value cũ vẫn được trả về cho tới lần làm mới sau
+REFRESH_QUEUE_SIZE_DEFAULT = 256
+NEGATIVE_MARKER = '__negative__'
+NEGATIVE_TTL_DEFAULT = 30
+
+_refresh_pool = None
+_refresh_pool_lock = threading.Lock()
+
+
+def _get_refresh_pool():
+    """ ThreadPool dùng chung cho việc làm mới value ở chế độ stale-while-revalidate """
+    global _refresh_pool
+    if _refresh_pool is None:
+        with _refresh_pool_lock:
+            if _refresh_pool is None:
+                # không chặn thread đang phục vụ request khi hàng đợi làm mới đầy
+                _refresh_pool = ThreadPool(num_workers=REFRESH_WORKERS_DEFAULT, queue_size=REFRESH_QUEUE_SIZE_DEFAULT,
+                                           overflow=OVERFLOW_POLICY.REJECT)
+    return _refresh_pool
+
+
+class CacheLoader(object):
+    """ Lấy value từ cache, nếu không có thì gọi hàm load và lưu kết quả vào cache.
+
+    - flight: SingleFlight để gộp các lần miss cùng key trong tiến trình.
+    - distributed_lock: dùng thêm khóa trên Redis để gộp các lần miss giữa nhiều worker/node,
+      chỉ có tác dụng với kho có hàm lock (REDIS, TIERED).
+    - stale_ttl: sau khi hết hạn (expiration) value cũ vẫn được trả về thêm stale_ttl giây
+      trong khi một thread của ThreadPool làm mới value ở chế độ nền.
+    - refresh_ahead: tỷ lệ (0..1) của expiration, value sẽ được làm mới ở chế độ nền khi
+      thời gian còn lại ít hơn tỷ lệ này, vd 0.2 là làm mới khi đã qua 80% thời gian sống.
+    - negative_exceptions: các kiểu exception được nhớ lại theo key trong negative_ttl giây,
+      trong thời gian đó exception được dựng lại từ args đã lưu và raise ngay mà không gọi hàm load.
+    """
+
+    def __init__(self, cache, flight=None, distributed_lock=False, lock_timeout=LOCK_TIMEOUT_DEFAULT,
+                 stale_ttl=None, refresh_ahead=None, expiration=None, stats=None, latency=None,
+                 negative_exceptions=None, negative_ttl=NEGATIVE_TTL_DEFAULT):
+        if refresh_ahead is not None and not 0 <= refresh_ahead < 1:
+            raise ValueError('refresh_ahead must be in [0, 1)')
+        self.cache = cache
+        self.flight = flight
+        self.distributed_lock = distributed_lock
+        self.lock_timeout = lock_timeout
+        self.stale_ttl = stale_ttl
+        self.refresh_ahead = refresh_ahead
+        self.expiration = expiration
+        self.revalidate = stale_ttl is not None or refresh_ahead is not None
+        self.stats = stats if stats is not None else CacheStats()
+        self.latency = latency if latency is not None else LatencyHistogram()
+        self.negative_exceptions = tuple(negative_exceptions) if negative_exceptions else ()
+        self.negative_ttl = negative_ttl
+        self._negative_types = {_class_path(a_type): a_type for a_type in self.negative_exceptions}
+        self._refreshing = set()
+        self._refreshing_lock = threading.Lock()
+
+    def _fresh_ttl(self):
+        return self.expiration if self.expiration is not None else self.cache.expiration
+
+    def get(self, key, load, tags=None):
+        """
+        :param tags: danh sách tag gắn với value khi lưu, dùng để xóa theo nhóm bằng invalidate_tag
+        """
+        t0 = time.perf_counter()
+        try:
+            record = self.cache[key]
+        except KeyError:
+            self.latency.observe(time.perf_counter() - t0)
+        else:
+            self.latency.observe(time.perf_counter() - t0)
+            hit, value = self._serve(key, record, load, tags)
+            if hit:
+                self.stats.hits += 1
+                return value
+        self.stats.misses += 1
+        return self._flight(key, lambda: self._load_and_store(key, load, tags=tags))
+
+    def _serve(self, key, record, load, tags=None):
+        """ trả về (True, value) nếu record lấy từ cache còn dùng được, ngược lại là (False, None) """
+        if self._is_negative(record):
+            ex = self._rebuild_negative(record)
+            if ex is None:
+                # không dựng lại được exception (vd đã đổi cấu hình) thì coi như miss
+                return False, None
+            self.stats.hits += 1
+            raise ex
+        if not self.revalidate:
+            return True, record
+        value, age = self._unstamp(record)
+        fresh_ttl = self._fresh_ttl()
+        if age is None or fresh_ttl is None:
+            return True, value
+        if age < fresh_ttl + (self.stale_ttl or 0):
+            refresh_at = fresh_ttl * (1 - self.refresh_ahead) if self.refresh_ahead else fresh_ttl
+            if age >= refresh_at:
+                self._schedule_refresh(key, load, tags)
+            return True, value
+        return False, None
+
+    def _flight(self, key, func):
+        if self.flight is None:
+            return func()
+        return self.flight.do(key, func)
+
+    def _lookup(self, key):
+        """ kiểm tra lại cache sau khi chờ, chỉ chấp nhận value còn hạn """
+        record = self.cache[key]
+        if self._is_negative(record):
+            ex = self._rebuild_negative(record)
+            if ex is None:
+                raise KeyError(key)
+            raise ex
+        if not self.revalidate:
+            return record
+        value, age = self._unstamp(record)
+        fresh_ttl = self._fresh_ttl()
+        if age is not None and fresh_ttl is not None and age >= fresh_ttl:
+            raise KeyError(key)
+        return value
+
+    def _load_and_store(self, key, load, force=False, tags=None):
+        if not force:
+            # kiểm tra lại vì trong lúc chờ, thread khác có thể đã lưu value
+            try:
+                return self._lookup(key)
+            except KeyError:
+                pass
+        lock = None
+        acquired = False
+        if self.distributed_lock and hasattr(self.cache, 'lock'):
+            try:
+                lock = self.cache.lock(key, self.lock_timeout)
+                acquired = lock.acquire(blocking=True, blocking_timeout=self.lock_timeout)
+            except redis.RedisError as ex:
+                # Redis lỗi thì vẫn tiếp tục tính toán, chỉ mất tác dụng gộp giữa các worker
+                print("CacheLoader: can not acquire redis lock for key %s: %s" % (key, ex))
+        if acquired:
+            try:
+                if not force:
+                    try:
+                        return self._lookup(key)
+                    except KeyError:
+                        pass
+                return self._call(key, load, tags)
+            finally:
+                try:
+                    lock.release()
+                except redis.RedisError:
+                    pass
+        return self._call(key, load, tags)
+
+    def _call(self, key, load, tags=None):
+        try:
+            value = load()
+        except self.negative_exceptions as ex:
+            self._store_negative(key, ex, tags)
+            raise
+        return self._store(key, value, tags)
+
+    def _store(self, key, value, tags=None):
+        fresh_ttl = self._fresh_ttl()
+        if self.revalidate and fresh_ttl is not None:
+            self.cache.set(key, [SWR_MARKER, time.time(), value], fresh_ttl + (self.stale_ttl or 0), tags=tags)
+        elif tags:
+            self.cache.set(key, value, tags=tags)
+        else:
+            self.cache[key] = value
+        return value
+
+    def _store_negative(self, key, ex, tags=None):
+        # chỉ lưu args để dựng lại exception, dùng được cho cả kho lưu dạng json như Redis
+        try:
+            self.cache.set(key, [NEGATIVE_MARKER, _class_path(type(ex)), list(ex.args)], self.negative_ttl,
+                           tags=tags)
+        except (TypeError, ValueError, redis.RedisError) as err:
+            print("CacheLoader: can not cache %s for key %s: %s" % (type(ex).__name__, key, err))
+
+    def _is_negative(self, record):
+        return bool(self.negative_exceptions) and isinstance(record, (list, tuple)) and len(record) == 3 \
+            and record[0] == NEGATIVE_MARKER
+
+    def _rebuild_negative(self, record):
+        a_type = self._negative_types.get(record[1])
+        if a_type is None:
+            return None
+        try:
+            return a_type(*record[2])
+        except Exception as ex:
+            print("CacheLoader: can not rebuild %s: %s" % (record[1], ex))
+            return None
+
+    @staticmethod
+    def _unstamp(record):
+        if isinstance(record, (list, tuple)) and len(record) == 3 and record[0] == SWR_MARKER:
+            return record[2], time.time() - record[1]
+        return record, None
+
+    def _schedule_refresh(self, key, load, tags=None):
+        with self._refreshing_lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+        try:
+            _get_refresh_pool().add_task(self._refresh, key, load, tags)
+        except TaskRejectedError:
+            # hàng đợi làm mới đầy, lần đọc sau sẽ thử lại
+            with self._refreshing_lock:
+                self._refreshing.discard(key)
+        except Exception:
+            with self._refreshing_lock:
+                self._refreshing.discard(key)
+            raise
+
+    def _refresh(self, key, load, tags=None):
+        try:
+            self._flight(key, lambda: self._load_and_store(key, load, force=True, tags=tags))
+        finally:
+            with self._refreshing_lock:
+                self._refreshing.discard(key)
+
+
+def _class_path(a_type):
+    return '%s.%s' % (a_type.__module__, a_type.__name__)
+
+
+KEY_MAX_LENGTH_DEFAULT = 200
+
+_fingerprints = {}
+
+
+def register_fingerprint(a_type, func):
+    """
+    đăng ký hàm tạo dấu vân tay cho các tham số có kiểu a_type (và lớp con), dùng khi tham số
+    quá lớn hoặc repr không ổn định, vd: register_fingerprint(BotConfig, lambda b: b.id)
+    """
+    _fingerprints[a_type] = func
+
+
+def _fingerprint(value):
+    if _fingerprints:
+        for klass in type(value).__mro__:
+            func = _fingerprints.get(klass)
+            if func is not None:
+                return func(value)
+    return value
+
+
+class CacheKeyBuilder(object):
+    """ Tạo key cache cho hàm được cache.
+
+    - key_attrs: danh sách thuộc tính của đối tượng (my_self) được đưa vào key, vd ['bot_id'].
+    - key_args: danh sách tên tham số được đưa vào key, None là dùng tất cả tham số.
+    - max_length: key dài hơn sẽ được rút gọn thành name#sha1 có độ dài cố định.
+
+    >>> def get(self, bot_id, lang='vi', debug=False): pass
+    >>> builder = CacheKeyBuilder('get', get, key_args=['bot_id', 'lang'])
+    >>> builder.build((None, 'bot_1'), {'debug': True})
+    "get#('bot_1', 'vi')"
+    """
+
+    def __init__(self, name, func=None, key_attrs=None, key_args=None, max_length=KEY_MAX_LENGTH_DEFAULT):
+        self.name = name
+        self.key_attrs = tuple(key_attrs) if key_attrs else ()
+        self.key_args = tuple(key_args) if key_args is not None else None
+        self.max_length = max_length
+        self.signature = None
+        if self.key_args is not None:
+            if func is None:
+                raise ValueError('func must not be None if key_args is not None')
+            if isinstance(func, staticmethod):
+                func = func.__func__
+            self.signature = inspect.signature(func)
+
+    def build(self, args, kwargs, instance=None):
+        """
+        :param args: tham số truyền vào hàm, với hàm của class thì args[0] là my_self nếu có key_args
+        :param instance: đối tượng để lấy key_attrs
+        """
+        if self.key_args is None:
+            parts = (tuple(_fingerprint(a) for a in args), {k: _fingerprint(v) for k, v in kwargs.items()})
+        else:
+            bound = self.signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            parts = tuple(_fingerprint(bound.arguments.get(a)) for a in self.key_args)
+        if self.key_attrs:
+            parts = (tuple(_fingerprint(getattr(instance, a, None)) for a in self.key_attrs),) + tuple(parts)
+        # Về nguyên tắc một repr python (...) không nên trả về bất kỳ ký tự '#'.
+        key = self.name + "#" + repr(parts)
+        if self.max_length is not None and len(key) > self.max_length:
+            key = self.name + "#" + hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return key
+
+
+class CacheTagBuilder(object):
+    """ Tạo tag cho value của hàm được cache từ các template theo cú pháp str.format.
+
+    Tên trong template là tên tham số của hàm hoặc thuộc tính của đối tượng (với hàm của class),
+    tham số được ưu tiên nếu trùng tên.
+
+    >>> def get(self, bot_id, lang='vi'): pass
+    >>> CacheTagBuilder(['bot:{bot_id}', 'lang:{lang}'], get).build((None, 'bot_1'), {})
+    ['bot:bot_1', 'lang:vi']
+    """
+
+    def __init__(self, templates, func):
+        self.templates = tuple(templates)
+        if isinstance(func, staticmethod):
+            func = func.__func__
+        self.signature = inspect.signature(func)
+
+    def build(self, args, kwargs, instance=None):
+        """
+        :param args: tham số truyền vào hàm, với hàm của class thì args[0] là my_self
+        :param instance: đối tượng để lấy thuộc tính
+        """
+        bound = self.signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        values = dict(getattr(instance, '__dict__', {})) if instance is not None else {}
+        values.update(bound.arguments)
+        return [template.format(**values) for template in self.templates]
+
+
+_lru_caches = weakref.WeakSet()
+
+
+def _function_name(func):
+    return func.__func__.__name__ if isinstance(func, staticmethod) else func.__name__
+
+
+def _store_samples(store, labels):
+    if isinstance(store, TieredCacheDict):
+        return _store_samples(store.l1, labels + [('tier', 'l1')]) + _store_samples(store.l2, labels + [('tier', 'l2')])
+    stats = store.get_stats()
+    samples = [
+        ('store_hits_total', 'counter', labels, stats['hits']),
+        ('store_misses_total', 'counter', labels, stats['misses']),
+        ('store_evictions_total', 'counter', labels, stats['evictions']),
+        ('store_expirations_total', 'counter', labels, stats['expirations']),
+    ]
+    if stats['size'] is not None:
+        # RedisCacheDict chỉ có size sau khi đã đếm ít nhất một lần
+        samples.append(('store_size', 'gauge', labels, stats['size']))
+    if 'bytes' in stats:
+        samples.append(('store_bytes', 'gauge', labels, stats['bytes']))
+    if hasattr(store, 'latency'):
+        samples.append(('store_latency_seconds', 'histogram', labels, store.latency))
+    return samples
+
+
+def export_metrics():
+    """ xuất thống kê của tất cả LruCache đang tồn tại dạng text của Prometheus """
+    samples = []
+    for lru_cache in list(_lru_caches):
+        samples.extend(lru_cache.metric_samples())
+    return render_metrics(samples)
+
+
+def _caller_name():
+    """ tên mặc định của LruCache theo nơi tạo: module:dòng """
+    frame = sys._getframe(2)
+    return '%s:%d' % (frame.f_globals.get('__name__', '?'), frame.f_lineno)
 
 
 class LruCache:
-    def __init__(self, max_size=CACHE_MAX_SIZE_DEFAULT,
+    def __init__(self, max_size=None,
                  expiration=EXPIRATION_DEFAULT,
                  store_type=STORE_TYPE.LOCAL,
-                 config_file_name=None):
+                 config_file_name=None,
+                 shards=SHARDS_DEFAULT,
+                 max_bytes=None,
+                 size_estimator=None,
+                 codec=None,
+                 single_flight=True,
+                 distributed_lock=False,
+                 lock_timeout=LOCK_TIMEOUT_DEFAULT,
+                 max_key_length=KEY_MAX_LENGTH_DEFAULT,
+                 name=None,
+                 policy=None):
+        """
+        :param max_size: số key tối đa, None là CACHE_MAX_SIZE_DEFAULT, với STORE_TYPE.SHARED là
+            SHARED_MAX_SIZE_DEFAULT vì mỗi slot chiếm sẵn bộ nhớ trong /dev/shm
+        :param name: tên của cache, dùng làm nhãn metrics và là tên vùng nhớ dùng chung của
+            STORE_TYPE.SHARED (bắt buộc với SHARED), None là module:dòng nơi tạo cache để nhãn
+            không phụ thuộc thứ tự import
+        """
+        if store_type == STORE_TYPE.SHARED and not name:
+            raise ValueError('name must not be None if store_type is SHARED')
+        if max_size is None:
+            max_size = SHARED_MAX_SIZE_DEFAULT if store_type == STORE_TYPE.SHARED else CACHE_MAX_SIZE_DEFAULT
         self.max_size = max_size
         self.expiration = expiration
         self.store_type = store_type
         self.config_file_name = config_file_name
-        if self.store_type == STORE_TYPE.LOCAL:
-            self.cache = LRUCacheDict(self.max_size, self.expiration)
-        elif self.store_type == STORE_TYPE.REDIS:
-            if self.config_file_name is None:
-                raise ValueError('config_file_name must not be None if store_type is REDIS')
-            self.cache = RedisCacheDict(self.config_file_name, self.max_size, self.expiration)
-        else:
-            raise NotImplementedError('store_type=%s' % self.store_type)
+        self.shards = shards
+        self.max_bytes = max_bytes
+        self.size_estimator = size_estimator
+        self.codec = codec
+        self.policy = policy
+        self.flight = SingleFlight() if single_flight else None
+        self.distributed_lock = distributed_lock
+        self.lock_timeout = lock_timeout
+        self.max_key_length = max_key_length
+        self.name = name if name else _caller_name()
+        self._prefix_stats = {}
+        _lru_caches.add(self)
+        self.cache = _create_store(self.store_type, self.config_file_name, self.max_size, self.expiration,
+                                   shards=self.shards, max_bytes=self.max_bytes, size_estimator=self.size_estimator,
+                                   codec=self.codec, policy=self.policy, name=self.name)
+
+    def _get_prefix_stats(self, prefix_key):
+        if prefix_key not in self._prefix_stats:
+            self._prefix_stats[prefix_key] = (CacheStats(), LatencyHistogram())
+        return self._prefix_stats[prefix_key]
+
+    def get_stats(self):
+        """
+        lấy thống kê của kho cache và của từng prefix_key
+        :return: {'store': thống kê của kho, 'prefixes': {prefix_key: hit/miss và độ trễ tra cứu}}
+        """
+        prefixes = {}
+        for prefix_key, (stats, latency) in self._prefix_stats.items():
+            prefixes[prefix_key] = stats.as_dict()
+            prefixes[prefix_key]['latency'] = latency.as_dict()
+        store = self.cache.get_stats() if self.cache is not None else {}
+        return {'store': store, 'prefixes': prefixes}
+
+    def metric_samples(self):
+        labels = [('cache', self.name)]
+        samples = []
+        for prefix_key, (stats, latency) in self._prefix_stats.items():
+            prefix_labels = labels + [('prefix', prefix_key)]
+            samples.append(('hits_total', 'counter', prefix_labels, stats.hits))
+            samples.append(('misses_total', 'counter', prefix_labels, stats.misses))
+            samples.append(('lookup_seconds', 'histogram', prefix_labels, latency))
+        if self.cache is not None:
+            samples.extend(_store_samples(self.cache, labels))
+        return samples
+
+    def export_metrics(self):
+        """ xuất thống kê dạng text của Prometheus """
+        return render_metrics(self.metric_samples())
+
+    def clear(self):
+        """ xóa toàn bộ cache, với Redis là tăng generation của namespace """
+        if self.cache is not None:
+            self.cache.clear()
 
-    def add(self, prefix_key=None):
+    def invalidate_tag(self, tag):
         """
+        xóa mọi value được lưu kèm tag, vd lru_cache.invalidate_tag('bot:%s' % bot_id)
+        :return: số key đã xóa
+        """
+        if self.cache is None:
+            return 0
+        return self.cache.invalidate_tag(tag)
+
+    def add(self, prefix_key=None, stale_ttl=None, refresh_ahead=None, key_args=None,
+            negative_exceptions=None, negative_ttl=NEGATIVE_TTL_DEFAULT, tags=None):
+        """
+        :param key_args: danh sách tên tham số được đưa vào key, None là dùng tất cả tham số
+        :param stale_ttl: số giây tiếp tục trả về value cũ sau khi hết hạn trong lúc làm mới ở chế độ nền
+        :param refresh_ahead: tỷ lệ thời gian sống còn lại để bắt đầu làm mới trước ở chế độ nền
+        :param negative_exceptions: các kiểu exception được cache lại theo key, vd (InputNotFoundError,)
+        :param negative_ttl: số giây giữ exception trong cache, nên ngắn hơn expiration
+        :param tags: danh sách template tag theo cú pháp str.format, vd ['bot:{bot_id}']
         # >>> @lru_cache_function(3, 1)
         # ... def f(x):
         # ...    print "Calling f(" + str(x) + ")"
@@ -61,12 +617,27 @@ class LruCache:
         """
 
         def wrapper(func):
-            return LRUCachedFunction(func, prefix_key, self.cache)
+            return LRUCachedFunction(func, prefix_key, self.cache, flight=self.flight,
+                                     distributed_lock=self.distributed_lock, lock_timeout=self.lock_timeout,
+                                     stale_ttl=stale_ttl, refresh_ahead=refresh_ahead,
+                                     single_flight=self.flight is not None,
+                                     key_args=key_args, max_key_length=self.max_key_length,
+                                     negative_exceptions=negative_exceptions, negative_ttl=negative_ttl,
+                                     tags=tags,
+                                     stats=self._get_prefix_stats(prefix_key if prefix_key else _function_name(func)))
 
         return wrapper
 
-    def add_for_class(self, prefix_key=None):
+    def add_for_class(self, prefix_key=None, stale_ttl=None, refresh_ahead=None, key_attrs=None, key_args=None,
+                      negative_exceptions=None, negative_ttl=NEGATIVE_TTL_DEFAULT, tags=None):
         """
+        :param key_attrs: danh sách thuộc tính của đối tượng được đưa vào key, vd ['bot_id']
+        :param key_args: danh sách tên tham số được đưa vào key, None là dùng tất cả tham số
+        :param stale_ttl: số giây tiếp tục trả về value cũ sau khi hết hạn trong lúc làm mới ở chế độ nền
+        :param refresh_ahead: tỷ lệ thời gian sống còn lại để bắt đầu làm mới trước ở chế độ nền
+        :param negative_exceptions: các kiểu exception được cache lại theo key, vd (InputNotFoundError,)
+        :param negative_ttl: số giây giữ exception trong cache, nên ngắn hơn expiration
+        :param tags: danh sách template tag theo cú pháp str.format, vd ['bot:{bot_id}']
         # >>> @lru_cache_function(3, 1)
         # ... def f(x):
         # ...    print "Calling f(" + str(x) + ")"
@@ -80,35 +651,88 @@ class LruCache:
 
         def wrapper(func):
             me = self
+            name = prefix_key if prefix_key else func.__name__
+            stats, latency = me._get_prefix_stats(name)
+            loader = CacheLoader(me.cache, me.flight, me.distributed_lock, me.lock_timeout,
+                                 stale_ttl=stale_ttl, refresh_ahead=refresh_ahead, stats=stats, latency=latency,
+                                 negative_exceptions=negative_exceptions, negative_ttl=negative_ttl)
+            builder = CacheKeyBuilder(name, func,
+                                      key_attrs=key_attrs, key_args=key_args, max_length=me.max_key_length)
+            tag_builder = CacheTagBuilder(tags, func) if tags else None
 
             @wraps(func)
             def wrapped(my_self, *args, **kwargs):
                 if me.cache is None:
-                    if me.store_type == STORE_TYPE.LOCAL:
-                        me.cache = LRUCacheDict()
-                    elif me.store_type == STORE_TYPE.REDIS:
-                        if me.config_file_name is None:
-                            raise ValueError('config_file_name must not be None if store_type is REDIS')
-                        self.cache = RedisCacheDict(me.config_file_name)
-                    else:
-                        raise NotImplementedError('store_type=%s' % me.store_type)
-                name = prefix_key if prefix_key else func.__name__
-
-                key = name + "#" + repr((args, kwargs))
+                    me.cache = _create_store(me.store_type, me.config_file_name, me.max_size, me.expiration,
+                                             shards=me.shards, max_bytes=me.max_bytes,
+                                             size_estimator=me.size_estimator, codec=me.codec, policy=me.policy,
+                                             name=me.name)
+                    loader.cache = me.cache
+                if key_args is None:
+                    key = builder.build(args, kwargs, my_self)
+                else:
+                    key = builder.build((my_self,) + args, kwargs, my_self)
 
-                try:
-                    # print("cache key", key)
-                    return me.cache[key]
-                except KeyError:
+                def load():
                     try:
-                        value = func(my_self, *args, **kwargs)
+                        return func(my_self, *args, **kwargs)
                     except TypeError as e:
                         if 'missing 1 required positional argument' in str(e):
                             raise KeyError('you must use add function')
                         else:
                             raise e
-                    me.cache[key] = value
-                    return value
+
+                item_tags = tag_builder.build((my_self,) + args, kwargs, my_self) if tag_builder else None
+                return loader.get(key, load, item_tags)
+
+            return wrapped
+
+        return wrapper
+
+    def add_batch(self, prefix_key=None):
+        """
+        cache cho hàm nhận vào danh sách id ở tham số đầu tiên và trả về dict {id: value}.
+        Các id đã có trong cache được lấy ra bằng một lần get_many, hàm gốc chỉ được gọi
+        một lần với các id còn thiếu, kết quả mới được lưu lại bằng set_many.
+        # >>> @lru_cache.add_batch()
+        # ... def get_bots(bot_ids):
+        # ...    print "Calling get_bots(" + str(bot_ids) + ")"
+        # ...    return {bot_id: bot_id.upper() for bot_id in bot_ids}
+        # >>> get_bots(['a', 'b'])
+        # Calling get_bots(['a', 'b'])
+        # {'a': 'A', 'b': 'B'}
+        # >>> get_bots(['a', 'b', 'c'])
+        # Calling get_bots(['c'])
+        # {'a': 'A', 'b': 'B', 'c': 'C'}
+        """
+
+        def wrapper(func):
+            me = self
+            name = prefix_key if prefix_key else func.__name__
+            stats, latency = me._get_prefix_stats(name)
+            builder = CacheKeyBuilder(name, max_length=me.max_key_length)
+
+            @wraps(func)
+            def wrapped(ids, *args, **kwargs):
+                if me.cache is None:
+                    me.cache = _create_store(me.store_type, me.config_file_name, me.max_size, me.expiration,
+                                             shards=me.shards, max_bytes=me.max_bytes,
+                                             size_estimator=me.size_estimator, codec=me.codec, policy=me.policy,
+                                             name=me.name)
+                ids = list(ids)
+                keys = {an_id: builder.build((an_id,) + args, kwargs) for an_id in ids}
+                t0 = time.perf_counter()
+                cached = me.cache.get_many(list(keys.values()))
+                latency.observe(time.perf_counter() - t0)
+                result = {an_id: cached[keys[an_id]] for an_id in ids if keys[an_id] in cached}
+                missing = [an_id for an_id in ids if an_id not in result]
+                stats.hits += len(result)
+                stats.misses += len(missing)
+                if missing:
+                    values = func(missing, *args, **kwargs) or {}
+                    me.cache.set_many({keys[an_id]: value for an_id, value in values.items() if an_id in keys})
+                    result.update(values)
+                return {an_id: result[an_id] for an_id in ids if an_id in result}
 
             return wrapped
 
@@ -151,46 +775,50 @@ class LRUCachedFunction(object):
 
     """
 
-    def __init__(self, a_function, prefix_key=None, cache=None, store_type=STORE_TYPE.LOCAL, config_file_name=None):
-        if cache:
+    def __init__(self, a_function, prefix_key=None, cache=None, store_type=STORE_TYPE.LOCAL, config_file_name=None,
+                 flight=None, distributed_lock=False, lock_timeout=LOCK_TIMEOUT_DEFAULT,
+                 stale_ttl=None, refresh_ahead=None, single_flight=True,
+                 key_args=None, max_key_length=KEY_MAX_LENGTH_DEFAULT, stats=None,
+                 negative_exceptions=None, negative_ttl=NEGATIVE_TTL_DEFAULT, tags=None):
+        if cache is not None:
             self.cache = cache
         else:
-            if store_type == STORE_TYPE.LOCAL:
-                self.cache = LRUCacheDict()
-            elif store_type == STORE_TYPE.REDIS:
-                if config_file_name is None:
-                    raise ValueError('config_file_name must not be None if store_type is REDIS')
-                self.cache = RedisCacheDict(config_file_name)
-            else:
-                raise NotImplementedError('store_type=%s' % store_type)
+            self.cache = _create_store(store_type, config_file_name)
+        if flight is None and single_flight:
+            flight = SingleFlight()
+        stats, latency = stats if stats is not None else (None, None)
+        self.loader = CacheLoader(self.cache, flight,
+                                  distributed_lock, lock_timeout, stale_ttl=stale_ttl, refresh_ahead=refresh_ahead,
+                                  stats=stats, latency=latency,
+                                  negative_exceptions=negative_exceptions, negative_ttl=negative_ttl)
         self.function = a_function
         if isinstance(self.function, staticmethod):
             self.__name__ = prefix_key if prefix_key else self.function.__func__.__name__
         else:
             self.__name__ = prefix_key if prefix_key else self.function.__name__
+        self.key_builder = CacheKeyBuilder(self.__name__, self.function, key_args=key_args,
+                                           max_length=max_key_length)
+        self.tag_builder = CacheTagBuilder(tags, self.function) if tags else None
 
     def __call__(self, *args, **kwargs):
-        # Về nguyên tắc một repr python (...) không nên trả về bất kỳ ký tự '#'.
-        key = self.__name__ + "#" + repr((args, kwargs))
+        key = self.key_builder.build(args, kwargs)
 
-        try:
-            # print("cache key", key)
-            return self.cache[key]
-        except KeyError:
+        def load():
             try:
                 # khi chạy cython phải thực hiện call hàm static theo kiêu meta-class.
                 # còn trên python gọi như bình thường
                 if isinstance(self.function, staticmethod):
-                    value = self.function.__func__(*args, **kwargs)
+                    return self.function.__func__(*args, **kwargs)
                 else:
-                    value = self.function(*args, **kwargs)
+                    return self.function(*args, **kwargs)
             except TypeError as e:
                 if 'missing 1 required positional argument' in str(e):
                     raise KeyError('you must use add_for_class function')
                 else:
                     raise e
-            self.cache[key] = value
-            return value
+
+        tags = self.tag_builder.build(args, kwargs) if self.tag_builder else None
+        return self.loader.get(key, load, tags)
 
 
 def _lock_decorator(func):
@@ -210,6 +838,79 @@ def _lock_decorator(func):
     return withlock
 
 
+class _CacheEntry(object):
+    """ bản ghi duy nhất cho mỗi key trong LRUCacheDict """
+    __slots__ = ('value', 'expire_at', 'nbytes', 'tags')
+
+    def __init__(self, value, expire_at, nbytes=0, tags=None):
+        self.value = value
+        self.expire_at = expire_at
+        self.nbytes = nbytes
+        self.tags = tags
+
+
+class _ExpiryIndex(object):
+    """ Chỉ mục hết hạn dạng bánh xe thời gian (timer wheel).
+
+    Các key được gom vào bucket theo khoảng resolution giây, bucket được xếp trong một heap
+    theo thứ tự thời gian. cleanup chỉ cần lấy ra các bucket đã quá hạn nên chi phí được
+    chia đều O(1) cho mỗi key thay vì phải duyệt toàn bộ cache.
+    """
+
+    def __init__(self, resolution=1):
+        self.resolution = resolution
+        self._buckets = {}
+        self._ticks = []
+
+    def _tick_of(self, expire_at):
+        return int(expire_at // self.resolution)
+
+    def add(self, key, expire_at):
+        tick = self._tick_of(expire_at)
+        bucket = self._buckets.get(tick)
+        if bucket is None:
+            bucket = self._buckets[tick] = set()
+            heapq.heappush(self._ticks, tick)
+        bucket.add(key)
+
+    def discard(self, key, expire_at):
+        bucket = self._buckets.get(self._tick_of(expire_at))
+        if bucket is not None:
+            bucket.discard(key)
+
+    def pop_expired(self, now, limit=None):
+        """ lấy ra tối đa limit key nằm trong những bucket đã qua hoàn toàn ở thời điểm now """
+        keys = []
+        current = self._tick_of(now)
+        while self._ticks and self._ticks[0] < current:
+            bucket = self._buckets.get(self._ticks[0])
+            if limit is not None and bucket and len(keys) + len(bucket) > limit:
+                # bucket quá lớn thì chỉ lấy một phần, phần còn lại để lần sau
+                while len(keys) < limit:
+                    keys.append(bucket.pop())
+                return keys
+            self._buckets.pop(heapq.heappop(self._ticks), None)
+            if bucket:
+                keys.extend(bucket)
+        return keys
+
+    def deadline(self, expire_at):
+        """ thời điểm bucket chứa expire_at quá hạn hoàn toàn """
+        return (self._tick_of(expire_at) + 1) * self.resolution
+
+    def next_expire(self):
+        """ thời điểm sớm nhất mà một bucket sẽ quá hạn, None nếu không còn key nào """
+        while self._ticks and not self._buckets.get(self._ticks[0]):
+            self._buckets.pop(heapq.heappop(self._ticks), None)
+        if not self._ticks:
+            return None
+        return (self._ticks[0] + 1) * self.resolution
+
+    def clear(self):
+        self._buckets.clear()
+        del self._ticks[:]
+
+
 class LRUCacheDict(object):
     """ A dictionary-like object, supporting LRU caching semantics.
 
@@ -233,56 +934,119 @@ class LRUCacheDict(object):
     KeyError: 'a'
 
     By default, this cache will only expire items whenever you poke it - all methods on
-    this class will result in a cleanup. If the thread_clear option is specified, a background
-    thread will clean it up every thread_clear_min_check seconds.
+    this class will result in a cleanup. If the thread_clear option is specified, the cache is
+    registered with the process-wide ExpiryReaper which removes expired keys in the background.
 
     If this class must be used in a multithreaded environment, the option concurrent should be
     set to true. Note that the cache will always be concurrent if a background cleanup thread
     is used.
+
+    Mỗi lần cleanup hoặc reap chỉ xóa tối đa REAP_BATCH_DEFAULT key hết hạn để không giữ khóa quá lâu,
+    key hết hạn chưa bị xóa vẫn không được trả về khi đọc.
+
+    Mỗi key chỉ có một bản ghi _CacheEntry nằm trong một OrderedDict theo thứ tự truy cập,
+    thời điểm hết hạn được đánh chỉ mục trong _ExpiryIndex nên get/set/evict đều O(1) chia đều.
+
+    Nếu truyền max_bytes, cache còn bị giới hạn theo tổng số byte ước lượng của các value
+    (tính bằng size_estimator, mặc định là deep_sizeof) và sẽ loại bỏ các key ít dùng nhất
+    cho đến khi bytes_size() không vượt quá max_bytes. Chỉ truyền size_estimator (không có
+    max_bytes) để theo dõi số byte mà không giới hạn.
+
+    Value có thể được lưu kèm tag bằng set(key, value, tags=[...]), invalidate_tag(tag) xóa
+    các key mang tag đó với chi phí tỷ lệ với số key được gắn tag.
+
+    policy chọn cách loại key khi đầy: EVICTION_POLICY.LRU (mặc định), TINY_LFU hoặc ARC, hai chính sách
+    sau chống được việc một loạt key chỉ dùng một lần đẩy các key phổ biến ra khỏi cache.
+
+    >>> d = LRUCacheDict(max_size=3, expiration=60, policy=EVICTION_POLICY.TINY_LFU)
+    >>> d['hot'] = 1
+    >>> for _ in range(5):
+    ...     _ = d['hot']
+    >>> for i in range(10):
+    ...     d['once_%d' % i] = i
+    >>> d.has_key('hot')
+    True
+
+    Có thể gắn một snapshot đã ghi ra file (xem CacheSnapshot) bằng attach_snapshot, key không có
+    trong cache sẽ được nạp từ snapshot ở lần truy cập đầu tiên với thời gian sống còn lại.
+
+    >>> d = LRUCacheDict(max_size=100, expiration=60, max_bytes=10, size_estimator=len)
+    >>> d['a'] = 'xxxx'
+    >>> d['b'] = 'yyyyyy'
+    >>> d['c'] = 'zz'
+    >>> d.has_key('a'), d.bytes_size()
+    (False, 8)
     """
 
     def __init__(self, max_size=CACHE_MAX_SIZE_DEFAULT, expiration=EXPIRATION_DEFAULT,
                  thread_clear=False,
-                 concurrent=False):
+                 concurrent=False,
+                 expiry_resolution=1,
+                 max_bytes=None,
+                 size_estimator=None,
+                 policy=None):
         self.max_size = max_size
         self.expiration = expiration
-        self.__values = {}
-        self.__expire_times = OrderedDict()
-        self.__access_times = OrderedDict()
+        self.max_bytes = max_bytes
+        # chỉ ước lượng kích thước khi có giới hạn byte hoặc khi được truyền size_estimator
+        self.track_bytes = max_bytes is not None or size_estimator is not None
+        self.size_estimator = size_estimator or deep_sizeof
+        self._bytes = 0
+        self._entries = OrderedDict()
+        self._expiry_index = _ExpiryIndex(expiry_resolution)
+        # tag -> tập key mang tag đó
+        self._tags = {}
+        self._snapshot = None
+        self._policy = create_policy(policy, max_size)
+        self.stats = CacheStats()
         self.thread_clear = thread_clear
         self.concurrent = concurrent or thread_clear
         if self.concurrent:
             self._rlock = threading.RLock()
-        if thread_clear:
-            et = self.EmptyCacheThread(self)
-            et.start()
-
-    class EmptyCacheThread(threading.Thread):
-        daemon = True
+        # hẹn giờ hiện tại với ExpiryReaper, chỉ dùng khi thread_clear
+        self._reap_timer = None
 
-        def __init__(self, cache, peek_duration=60):
-            # me = self
-            #
-            # def kill_self(o):
-            #     me
-            self.ref = weakref.ref(cache)
-            self.peek_duration = peek_duration
-            super(LRUCacheDict.EmptyCacheThread, self).__init__()
+    def enable_concurrent(self):
+        """ bật khóa cho cache đang không concurrent, phải gọi trước khi cache được dùng từ nhiều thread """
+        if not self.concurrent:
+            self._rlock = threading.RLock()
+            self.concurrent = True
 
-        def run(self):
-            while self.ref():
-                c = self.ref()
-                if c:
-                    next_expire = c.cleanup()
-                    if next_expire is None:
-                        time.sleep(self.peek_duration)
-                    else:
-                        time.sleep(next_expire + 1)
-                        # c = None
+    @_lock_decorator
+    def reap(self, batch=REAP_BATCH_DEFAULT):
+        """ xóa tối đa batch key hết hạn rồi hẹn lần tiếp theo, được gọi bởi ExpiryReaper """
+        t = time.time()
+        self._reap_timer = None
+        self._expire(t, batch)
+        next_expire = self._expiry_index.next_expire()
+        if next_expire is not None:
+            self._reap_timer = get_reaper().schedule(self, max(next_expire, t))
+
+    def _schedule_reap(self, expire_at):
+        deadline = self._expiry_index.deadline(expire_at)
+        if self._reap_timer is not None:
+            if self._reap_timer.deadline <= deadline:
+                return
+            self._reap_timer.cancel()
+        self._reap_timer = get_reaper().schedule(self, deadline)
 
     @_lock_decorator
     def size(self):
-        return len(self.__values)
+        return len(self._entries)
+
+    def __len__(self):
+        return self.size()
+
+    @_lock_decorator
+    def bytes_size(self):
+        """ tổng số byte ước lượng của các value đang được lưu """
+        return self._bytes
+
+    def get_stats(self):
+        result = self.stats.as_dict()
+        result['size'] = self.size()
+        result['bytes'] = self.bytes_size()
+        return result
 
     @_lock_decorator
     def clear(self):
@@ -299,12 +1063,19 @@ class LRUCacheDict(object):
         ...
         KeyError: 'foo'
         """
-        self.__values.clear()
-        self.__expire_times.clear()
-        self.__access_times.clear()
+        self._entries.clear()
+        self._expiry_index.clear()
+        self._tags.clear()
+        self._bytes = 0
+        if self._policy is not None:
+            self._policy.clear()
+        if self._reap_timer is not None:
+            self._reap_timer.cancel()
+            self._reap_timer = None
+        self._detach_snapshot()
 
     def __contains__(self, key):
-        return key in self.__values
+        return self.has_key(key)
 
     @_lock_decorator
     def has_key(self, key):
@@ -326,64 +1097,400 @@ class LRUCacheDict(object):
         ...
         KeyError: 'foo'
         """
-        return key in self.__values
+        t = time.time()
+        entry = self._entries.get(key)
+        if entry is None and self._snapshot is not None:
+            entry = self._restore(key, t)
+        return entry is not None and not self._is_expired(entry, t)
 
     @_lock_decorator
     def __setitem__(self, key, value):
-        t = int(time.time())
-        self.__delete__(key)
-        self.__values[key] = value
-        self.__access_times[key] = t
-        self.__expire_times[key] = t + self.expiration
+        self._store(key, value, time.time())
+        self.cleanup()
+
+    @_lock_decorator
+    def set(self, key, value, expiration=None, tags=None):
+        """
+        lưu value với thời gian hết hạn riêng cho key, expiration=None thì dùng self.expiration
+        :param tags: danh sách tag gắn với key, dùng cho invalidate_tag
+        """
+        self._store(key, value, time.time(), expiration, tags)
         self.cleanup()
 
+    @_lock_decorator
+    def invalidate_tag(self, tag):
+        """
+        xóa mọi key mang tag
+        :return: số key đã xóa
+        """
+        keys = self._tags.pop(tag, ())
+        for key in keys:
+            self.__delete__(key)
+        restored = self._snapshot.pop_tag(tag) if self._snapshot is not None else ()
+        return len(keys) + len(restored)
+
+    @_lock_decorator
+    def attach_snapshot(self, reader):
+        """
+        gắn snapshot để nạp lười các key chưa có trong cache
+        :param reader: SnapshotReader
+        """
+        self._detach_snapshot()
+        for key in list(self._entries.keys()):
+            reader.discard(key)
+        self._snapshot = reader if len(reader) else None
+        if self._snapshot is None:
+            reader.close()
+
+    def _detach_snapshot(self):
+        if self._snapshot is not None:
+            self._snapshot.close()
+            self._snapshot = None
+
+    def _restore(self, key, t):
+        """ nạp key từ snapshot vào cache, trả về entry hoặc None """
+        try:
+            value, expire_at, tags = self._snapshot.pop(key)
+        except KeyError:
+            return None
+        finally:
+            if not len(self._snapshot):
+                self._detach_snapshot()
+        if expire_at is not None and expire_at <= t:
+            return None
+        self._store(key, value, t, None if expire_at is None else expire_at - t, tags)
+        return self._entries.get(key)
+
+    @_lock_decorator
+    def snapshot_items(self):
+        """
+        các bản ghi để ghi snapshot, theo thứ tự từ ít dùng tới dùng gần nhất
+        :return: danh sách (key, value, thời điểm hết hạn, tags, value đã được mã hóa hay chưa)
+        """
+        items = []
+        if self._snapshot is not None:
+            items.extend((key, data, expire_at, tags, True)
+                         for key, data, expire_at, tags in self._snapshot.raw_items())
+        items.extend((key, entry.value, entry.expire_at, entry.tags, False) for key, entry in self._entries.items())
+        return items
+
     @_lock_decorator
     def __getitem__(self, key):
-        t = int(time.time())
-        del self.__access_times[key]
-        self.__access_times[key] = t
+        value = self._load(key, time.time())
+        self.cleanup()
+        return value
+
+    @_lock_decorator
+    def get_many(self, keys):
+        """
+        lấy nhiều key trong một lần gọi
+        :param keys: danh sách key
+        :return: dict gồm các key có trong cache và value tương ứng, key không có sẽ bị bỏ qua
+        """
+        t = time.time()
+        result = {}
+        for key in keys:
+            try:
+                result[key] = self._load(key, t)
+            except KeyError:
+                pass
+        self.cleanup()
+        return result
+
+    @_lock_decorator
+    def set_many(self, mapping):
+        """ lưu nhiều cặp key, value trong một lần gọi, chỉ cleanup một lần """
+        t = time.time()
+        for key, value in mapping.items():
+            self._store(key, value, t)
         self.cleanup()
-        return self.__values[key]
+
+    def _store(self, key, value, t, expiration=None, tags=None):
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._forget(key, old, replaced=True)
+        elif self._snapshot is not None:
+            self._snapshot.discard(key)
+        if expiration is None:
+            expiration = self.expiration
+        expire_at = None if expiration is None else t + expiration
+        nbytes = self.size_estimator(value) if self.track_bytes else 0
+        tags = tuple(tags) if tags else None
+        self._entries[key] = _CacheEntry(value, expire_at, nbytes, tags)
+        self._bytes += nbytes
+        if expire_at is not None:
+            self._expiry_index.add(key, expire_at)
+            if self.thread_clear:
+                self._schedule_reap(expire_at)
+        if tags:
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+        if self._policy is not None:
+            if old is None:
+                self._policy.on_insert(key)
+            else:
+                self._policy.on_access(key)
+
+    def _load(self, key, t):
+        entry = self._entries.get(key)
+        if entry is None and self._snapshot is not None:
+            entry = self._restore(key, t)
+        if entry is None:
+            self.stats.misses += 1
+            raise KeyError(key)
+        if self._is_expired(entry, t):
+            self.__delete__(key)
+            self.stats.expirations += 1
+            self.stats.misses += 1
+            raise KeyError(key)
+        self._entries.move_to_end(key)
+        if self._policy is not None:
+            self._policy.on_access(key)
+        self.stats.hits += 1
+        return entry.value
 
     @_lock_decorator
     def __delete__(self, key):
-        if key in self.__values:
-            del self.__values[key]
-            del self.__expire_times[key]
-            del self.__access_times[key]
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._forget(key, entry)
+        elif self._snapshot is not None:
+            self._snapshot.discard(key)
+        return entry
+
+    def _forget(self, key, entry, replaced=False):
+        """
+        cập nhật chỉ mục hết hạn, chỉ mục tag và số byte sau khi entry đã bị lấy ra khỏi _entries
+        :param replaced: key sẽ được lưu lại ngay nên chính sách loại bỏ vẫn giữ lịch sử của key
+        """
+        self._bytes -= entry.nbytes
+        if entry.expire_at is not None:
+            self._expiry_index.discard(key, entry.expire_at)
+        self._untag(key, entry)
+        if self._policy is not None and not replaced:
+            self._policy.on_remove(key)
+
+    def _untag(self, key, entry):
+        if entry.tags:
+            for tag in entry.tags:
+                keys = self._tags.get(tag)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del self._tags[tag]
+
+    def __delitem__(self, key):
+        if self.__delete__(key) is None:
+            raise KeyError(key)
+
+    def _over_budget(self):
+        return self.max_bytes is not None and self._bytes > self.max_bytes and len(self._entries) > 0
+
+    @staticmethod
+    def _is_expired(entry, t):
+        return entry.expire_at is not None and entry.expire_at <= t
+
+    def _expire(self, t, batch):
+        for k in self._expiry_index.pop_expired(t, batch):
+            entry = self._entries.get(k)
+            if entry is not None and self._is_expired(entry, t):
+                del self._entries[k]
+                self._bytes -= entry.nbytes
+                self._untag(k, entry)
+                if self._policy is not None:
+                    self._policy.on_remove(k)
+                self.stats.expirations += 1
 
     @_lock_decorator
     def cleanup(self):
-        if self.expiration is None:
-            return None
-        t = int(time.time())
+        t = time.time()
         # Delete expired
-        next_expire = None
-        keys = list(self.__expire_times.keys())
-        for k in keys:
-            value = self.__expire_times.get(k, None)
-            if value and value < t:
-                self.__delete__(k)
-            else:
-                next_expire = value
-                break
+        self._expire(t, REAP_BATCH_DEFAULT)
 
         # If we have more than self.max_size items, delete the oldest
-        while len(self.__values) > self.max_size:
-            keys = list(self.__access_times.keys())
-            for k in keys:
-                self.__delete__(k)
-                break
+        while len(self._entries) > self.max_size or self._over_budget():
+            k = self._policy.victim() if self._policy is not None else None
+            if k is None or k not in self._entries:
+                k, entry = self._entries.popitem(last=False)
+            else:
+                entry = self._entries.pop(k)
+            self._forget(k, entry)
+            self.stats.evictions += 1
+
+        next_expire = self._expiry_index.next_expire()
         if not (next_expire is None):
-            return next_expire - t
+            return max(next_expire - t, 0)
         else:
             return None
 
 
+class ShardedLRUCacheDict(object):
+    """ LRUCacheDict chia thành nhiều phân đoạn (shard) độc lập để giảm tranh chấp khóa.
+
+    Mỗi key được băm vào một shard, mỗi shard là một LRUCacheDict có khóa riêng và giữ
+    một phần max_size. Các thread truy cập key khác shard sẽ không phải chờ nhau.
+
+    >>> d = ShardedLRUCacheDict(max_size=64, expiration=3, shards=4)
+    >>> d['foo'] = 'bar'
+    >>> d['foo']
+    'bar'
+    """
+
+    def __init__(self, max_size=CACHE_MAX_SIZE_DEFAULT, expiration=EXPIRATION_DEFAULT,
+                 thread_clear=False,
+                 shards=SHARDS_DEFAULT,
+                 max_bytes=None,
+                 size_estimator=None,
+                 policy=None):
+        if shards < 1:
+            raise ValueError('shards must be greater than 0')
+        self.max_size = max_size
+        self.expiration = expiration
+        self.max_bytes = max_bytes
+        self.concurrent = True
+        self.shard_max_size = -(-max_size // shards)
+        shard_max_bytes = None if max_bytes is None else -(-max_bytes // shards)
+        self._shards = [LRUCacheDict(self.shard_max_size, expiration, thread_clear=thread_clear, concurrent=True,
+                                     max_bytes=shard_max_bytes, size_estimator=size_estimator, policy=policy)
+                        for _ in range(shards)]
+
+    def _shard(self, key):
+        return self._shards[hash(key) % len(self._shards)]
+
+    def size(self):
+        return sum(shard.size() for shard in self._shards)
+
+    def bytes_size(self):
+        return sum(shard.bytes_size() for shard in self._shards)
+
+    @property
+    def stats(self):
+        stats = CacheStats()
+        for shard in self._shards:
+            stats.merge(shard.stats)
+        return stats
+
+    def get_stats(self):
+        result = self.stats.as_dict()
+        result['size'] = self.size()
+        result['bytes'] = self.bytes_size()
+        return result
+
+    def __len__(self):
+        return self.size()
+
+    def clear(self):
+        for shard in self._shards:
+            shard.clear()
+
+    def __contains__(self, key):
+        return self._shard(key).has_key(key)
+
+    def has_key(self, key):
+        return self._shard(key).has_key(key)
+
+    def __setitem__(self, key, value):
+        self._shard(key)[key] = value
+
+    def set(self, key, value, expiration=None, tags=None):
+        self._shard(key).set(key, value, expiration, tags)
+
+    def invalidate_tag(self, tag):
+        return sum(shard.invalidate_tag(tag) for shard in self._shards)
+
+    def __getitem__(self, key):
+        return self._shard(key)[key]
+
+    def _group_by_shard(self, keys):
+        groups = {}
+        for key in keys:
+            groups.setdefault(hash(key) % len(self._shards), []).append(key)
+        return groups
+
+    def get_many(self, keys):
+        result = {}
+        for index, shard_keys in self._group_by_shard(keys).items():
+            result.update(self._shards[index].get_many(shard_keys))
+        return result
+
+    def set_many(self, mapping):
+        for index, shard_keys in self._group_by_shard(mapping.keys()).items():
+            self._shards[index].set_many({key: mapping[key] for key in shard_keys})
+
+    def __delete__(self, key):
+        return self._shard(key).__delete__(key)
+
+    def __delitem__(self, key):
+        del self._shard(key)[key]
+
+    def cleanup(self):
+        next_expires = [n for n in (shard.cleanup() for shard in self._shards) if n is not None]
+        return min(next_expires) if next_expires else None
+
+
 class REDIS_MODE:
     HOST = 'host'
     PORT = 'port'
     EXPIRED_TIME_FOR_KEY = 'expired_time_for_key'
+    CACHE_NAMESPACE = 'cache_namespace'
+    CACHE_EVICTION = 'cache_eviction'
+    SOCKET_TIMEOUT = 'socket_timeout'
+    CONNECT_TIMEOUT = 'connect_timeout'
+    MAX_CONNECTIONS = 'max_connections'
+    CACHE_FALLBACK_SIZE = 'cache_fallback_size'
+
+
+class REDIS_EVICTION:
+    # tự loại bỏ key theo chỉ mục truy cập (sorted set) riêng của namespace
+    SCOPED = 'scoped'
+    # không tự loại bỏ, giao hoàn toàn cho chính sách maxmemory của Redis (vd: allkeys-lru)
+    MAXMEMORY = 'maxmemory'
+
+
+REDIS_NAMESPACE_DEFAULT = 'pytemp:cache'
+REDIS_EVICT_BATCH_DEFAULT = 16
+# số giây giữ kết quả đếm key bằng SCAN ở chế độ MAXMEMORY trước khi đếm lại
+REDIS_SIZE_SCAN_INTERVAL_DEFAULT = 300
+# số giây giữ generation của namespace trong tiến trình trước khi đọc lại từ Redis
+REDIS_GENERATION_REFRESH_DEFAULT = 1
+# số giây tối đa chờ một lệnh/một lần kết nối, tránh treo request khi Redis không phản hồi
+REDIS_SOCKET_TIMEOUT_DEFAULT = 1.0
+REDIS_CONNECT_TIMEOUT_DEFAULT = 1.0
+REDIS_MAX_CONNECTIONS_DEFAULT = 64
+# số key của LRUCacheDict cục bộ dùng thay Redis khi breaker mở, 0 là không dùng (miss ngay)
+REDIS_FALLBACK_SIZE_DEFAULT = 10240
+# số key/tag bị bỏ lỡ tối đa được nhớ trong lúc breaker mở, quá số này thì phải xóa cả namespace
+REDIS_MISSED_MAX_DEFAULT = 100000
+# số key được xóa trong mỗi lệnh khi áp dụng các lần ghi đã bỏ lỡ
+REDIS_RECOVER_BATCH_DEFAULT = 1000
+
+_redis_backends = {}
+_redis_backends_lock = threading.Lock()
+
+
+def _get_redis_backend(host, port, socket_timeout, connect_timeout, max_connections):
+    """
+    connection pool và circuit breaker dùng chung cho mọi RedisCacheDict trỏ tới cùng host:port,
+    breaker mở thì thread probe PING lại Redis cho tới khi kết nối được
+    :return: (pool, breaker)
+    """
+    name = '%s:%s' % (host, port)
+    with _redis_backends_lock:
+        backend = _redis_backends.get(name)
+        if backend is None:
+            pool = redis.BlockingConnectionPool(host=host, port=int(port), db=0, max_connections=max_connections,
+                                                timeout=connect_timeout, socket_timeout=socket_timeout,
+                                                socket_connect_timeout=connect_timeout)
+            probe = redis.Redis(connection_pool=pool).ping
+            backend = _redis_backends[name] = (pool, CircuitBreaker('redis %s' % name, probe))
+        return backend
+
+
+def _ttl_seconds(pttl):
+    """ đổi kết quả PTTL (mili giây, âm nếu key không hết hạn hoặc không tồn tại) ra số giây hoặc None """
+    if pttl is None or pttl < 0:
+        return None
+    return pttl / 1000.0
 
 
 class RedisCacheDict:
@@ -415,46 +1522,246 @@ class RedisCacheDict:
     If this class must be used in a multithreaded environment, the option concurrent should be
     set to true. Note that the cache will always be concurrent if a background cleanup thread
     is used.
+
+    Key được đặt trong namespace kèm generation lưu ở Redis (namespace:generation:key, generation 0
+    giữ dạng cũ namespace:key). clear() chỉ tăng generation bằng một lệnh INCR, các key cũ không
+    còn được đọc tới và tự hết hạn. Mỗi tiến trình đọc lại generation sau generation_refresh giây
+    nên các worker khác thấy lần xóa chậm nhất sau khoảng thời gian này.
+
+    Các lệnh đi qua connection pool dùng chung có timeout, lỗi kết nối liên tiếp sẽ mở circuit breaker:
+    trong lúc Redis không sẵn sàng các lệnh trả về ngay (miss) hoặc dùng LRUCacheDict cục bộ
+    fallback_size key. Khi thread probe kết nối lại được, fallback bị xóa và các lần xóa/ghi đã bỏ lỡ
+    được áp dụng lại lên Redis (quá nhiều thì tăng generation) để không đọc phải value cũ.
     """
 
     def __init__(self, config_file_name, max_size=CACHE_MAX_SIZE_DEFAULT, expiration=EXPIRATION_DEFAULT,
-                 concurrent=False
+                 concurrent=False,
+                 namespace=None,
+                 eviction=None,
+                 evict_batch=REDIS_EVICT_BATCH_DEFAULT,
+                 codec=None,
+                 generation_refresh=REDIS_GENERATION_REFRESH_DEFAULT,
+                 fallback_size=None
                  ):
+        """
+        :param fallback_size: số key của cache cục bộ khi Redis không sẵn sàng, None thì đọc từ config, 0 là không dùng
+        """
         self.max_size = max_size
         self.expiration = expiration
+        self.codec = get_codec(codec)
         config = configparser.ConfigParser()
         config.read(config_file_name, 'utf-8')
         self.host = config.get(REDIS_MODE.__name__, REDIS_MODE.HOST)
         self.port = config.get(REDIS_MODE.__name__, REDIS_MODE.PORT)
-        self._redis = redis.Redis(host=self.host, port=self.port, db=0)
+        self.namespace = namespace or config.get(REDIS_MODE.__name__, REDIS_MODE.CACHE_NAMESPACE,
+                                                 fallback=REDIS_NAMESPACE_DEFAULT)
+        self.eviction = eviction or config.get(REDIS_MODE.__name__, REDIS_MODE.CACHE_EVICTION,
+                                               fallback=REDIS_EVICTION.SCOPED)
+        if self.eviction not in (REDIS_EVICTION.SCOPED, REDIS_EVICTION.MAXMEMORY):
+            raise NotImplementedError('eviction=%s' % self.eviction)
+        self.evict_batch = evict_batch
+        # TTL dài nhất đã dùng, key trong chỉ mục có thời điểm truy cập cũ hơn khoảng này chắc chắn đã hết hạn
+        self._longest_ttl = expiration
+        self._generation_key = self.namespace + ':__generation__'
+        self.generation_refresh = generation_refresh
+        # số key đếm được lần gần nhất, get_stats chỉ đọc giá trị này để không quét Redis mỗi lần lấy metrics
+        self._size = None
+        self._size_checked_at = None
+        self._generation = 0
+        self._generation_checked_at = None
+        pool, self.breaker = _get_redis_backend(
+            self.host, self.port,
+            config.getfloat(REDIS_MODE.__name__, REDIS_MODE.SOCKET_TIMEOUT, fallback=REDIS_SOCKET_TIMEOUT_DEFAULT),
+            config.getfloat(REDIS_MODE.__name__, REDIS_MODE.CONNECT_TIMEOUT, fallback=REDIS_CONNECT_TIMEOUT_DEFAULT),
+            config.getint(REDIS_MODE.__name__, REDIS_MODE.MAX_CONNECTIONS, fallback=REDIS_MAX_CONNECTIONS_DEFAULT))
+        self._redis = redis.Redis(connection_pool=pool)
         self.concurrent = concurrent
         if self.concurrent:
             self._rlock = threading.RLock()
 
-        self.is_redis_ready = self.check_connection_available()
+        if fallback_size is None:
+            fallback_size = config.getint(REDIS_MODE.__name__, REDIS_MODE.CACHE_FALLBACK_SIZE,
+                                          fallback=REDIS_FALLBACK_SIZE_DEFAULT)
+        self.fallback = LRUCacheDict(fallback_size, expiration, concurrent=True) if fallback_size else None
+        # các key/tag bị ghi hoặc xóa trong lúc breaker mở, cần xóa khỏi Redis khi kết nối lại
+        self._missed = MissedWrites(self.namespace, max(fallback_size, REDIS_MISSED_MAX_DEFAULT))
+        self._degraded = False
+        # _degraded được dùng chung giữa các thread kể cả khi không concurrent
+        self._state_lock = threading.Lock()
+
+        self.stats = CacheStats()
+        self.latency = LatencyHistogram()
+        self.check_connection_available()
+
+    def get_instance(self):
+        return self._redis
+
+    @property
+    def is_redis_ready(self):
+        return self.breaker.allow()
+
+    def _timed(self, func, *args, **kwargs):
+        """ gọi một lệnh tới Redis, ghi lại độ trễ round trip và kết quả cho circuit breaker """
+        t0 = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        except (redis.ConnectionError, redis.TimeoutError):
+            self.breaker.record_failure()
+            raise
+        finally:
+            self.latency.observe(time.perf_counter() - t0)
+        self.breaker.record_success()
+        return result
+
+    def get_stats(self):
+        result = self.stats.as_dict()
+        result['size'] = self._size
+        result['latency'] = self.latency.as_dict()
+        result['breaker'] = self.breaker.state
+        if self.fallback is not None:
+            result['fallback'] = self.fallback.get_stats()
+        return result
 
     def check_connection_available(self):
         try:
             self._redis.ping()
+            self.breaker.record_success()
             return True
-        except redis.ConnectionError:
+        except redis.RedisError:
             print("check_connection_available: redis connection not available: host = %s, port = %s"
                   % (self.host, self.port))
+            # mở breaker để thread probe tự kết nối lại thay vì tắt cache suốt vòng đời tiến trình
+            self.breaker.trip()
             return False
 
+    def _available(self):
+        """ Redis có dùng được không, lần đầu thấy Redis trở lại thì bỏ fallback và áp dụng các lần xóa đã bỏ lỡ """
+        if not self.breaker.allow():
+            self._degraded = True
+            return False
+        if self._degraded or self._missed:
+            try:
+                self._recover()
+            except redis.RedisError as ex:
+                print("RedisCacheDict: can not recover namespace %s: %s" % (self.namespace, ex))
+                return False
+        return True
+
+    def _recover(self):
+        """
+        xóa khỏi Redis các key và tag bị ghi/xóa trong lúc mất kết nối, không ghi lại value.
+        Chỉ tăng generation (xóa namespace của mọi tiến trình) khi clear() bị bỏ lỡ hoặc có quá nhiều key
+        """
+        with self._state_lock:
+            degraded, self._degraded = self._degraded, False
+        keys, tags, flush = self._missed.take()
+        try:
+            if flush is not None:
+                print("RedisCacheDict: %s, flush namespace %s for every process" % (flush, self.namespace))
+                self._generation = self._timed(self._redis.incr, self._generation_key)
+                self._generation_checked_at = time.time()
+            else:
+                for tag in tags:
+                    self._delete_tag(tag)
+                self._delete_keys(list(keys))
+        except redis.RedisError:
+            # trả lại để lần sau thử lại, xóa lại key đã xóa không ảnh hưởng gì
+            self._missed.restore(keys, tags, flush)
+            with self._state_lock:
+                self._degraded = self._degraded or degraded
+            raise
+        if degraded:
+            if self.fallback is not None:
+                self.fallback.clear()
+            print("RedisCacheDict: namespace %s recovered, %d missed keys and %d missed tags invalidated"
+                  % (self.namespace, len(keys), len(tags)))
+
+    def _delete_keys(self, keys):
+        for start in range(0, len(keys), REDIS_RECOVER_BATCH_DEFAULT):
+            full_keys = [self._full_key(key) for key in keys[start:start + REDIS_RECOVER_BATCH_DEFAULT]]
+            pipe = self._redis.pipeline(transaction=False)
+            pipe.delete(*full_keys)
+            if self.eviction == REDIS_EVICTION.SCOPED:
+                pipe.zrem(self._index_key, *full_keys)
+            self._timed(pipe.execute)
+
+    def _miss_write(self, key):
+        """ ghi nhớ key cần xóa khỏi Redis khi kết nối lại """
+        self._missed.add_key(key)
+
+    def _on_error(self, op, ex):
+        print("RedisCacheDict: %s failed on namespace %s: %s" % (op, self.namespace, ex))
+
+    def _scope(self):
+        """ tiền tố của namespace theo generation hiện tại """
+        now = time.time()
+        if self._generation_checked_at is None or now - self._generation_checked_at >= self.generation_refresh:
+            self._generation_checked_at = now
+            try:
+                self._generation = int(self._timed(self._redis.get, self._generation_key) or 0)
+            except redis.RedisError as ex:
+                print("RedisCacheDict: can not read generation of %s: %s" % (self.namespace, ex))
+        if self._generation:
+            return '%s:%d' % (self.namespace, self._generation)
+        return self.namespace
+
+    @property
+    def _index_key(self):
+        return self._scope() + ':__lru_index__'
+
+    @property
+    def generation(self):
+        self._scope()
+        return self._generation
+
+    def _full_key(self, key):
+        return '%s:%s' % (self._scope(), key)
+
     @_lock_decorator
     def size(self):
-        return self._redis.dbsize()
+        """
+        số key của namespace, ở chế độ MAXMEMORY phải quét bằng SCAN nên kết quả được giữ lại
+        REDIS_SIZE_SCAN_INTERVAL_DEFAULT giây
+        """
+        if not self._available():
+            return self.fallback.size() if self.fallback is not None else 0
+        now = time.time()
+        if self.eviction != REDIS_EVICTION.SCOPED and self._size_checked_at is not None \
+                and now - self._size_checked_at < REDIS_SIZE_SCAN_INTERVAL_DEFAULT:
+            return self._size
+        try:
+            if self.eviction == REDIS_EVICTION.SCOPED:
+                self._size = self._timed(self._redis.zcard, self._index_key)
+            else:
+                self._size = self._timed(
+                    lambda: sum(1 for _ in self._redis.scan_iter(match=self._full_key('*'), count=1000)))
+                self._size_checked_at = now
+        except redis.RedisError as ex:
+            self._on_error('size', ex)
+            return 0
+        return self._size
 
     @_lock_decorator
     def clear(self):
         """
-        Clears the dict. Không thực hiện do trong Redis có thể dùng chung nhiều dự án
+        Clears the dict. Không xóa key do trong Redis có thể dùng chung nhiều dự án, chỉ tăng
+        generation của namespace để các key cũ không còn được dùng và tự hết hạn
         """
-        pass
+        if self.fallback is not None:
+            self.fallback.clear()
+        if not self._available():
+            self._missed.add_flush('clear() missed')
+            return
+        try:
+            self._generation = self._timed(self._redis.incr, self._generation_key)
+        except redis.RedisError as ex:
+            self._on_error('clear', ex)
+            self._missed.add_flush('clear() missed')
+            return
+        self._generation_checked_at = time.time()
 
     def __contains__(self, key):
-        return self._redis.exists(key)
+        return self.has_key(key)
 
     @_lock_decorator
     def has_key(self, key):
@@ -476,44 +1783,514 @@ class RedisCacheDict:
         ...
         KeyError: 'foo'
         """
-        return self._redis.exists(key)
+        if not self._available():
+            return self.fallback is not None and self.fallback.has_key(key)
+        try:
+            return bool(self._timed(self._redis.exists, self._full_key(key)))
+        except redis.RedisError as ex:
+            self._on_error('has_key', ex)
+            return False
 
     @_lock_decorator
     def __setitem__(self, key, value):
-        if self.is_redis_ready:
-            self._redis.set(key, json.dumps(value), self.expiration)
-            self.cleanup()
-        else:
-            print("REDIS not ready for cache")
+        self.set(key, value)
+
+    def _tag_key(self, tag):
+        return '%s:__tag__:%s' % (self._scope(), tag)
+
+    @_lock_decorator
+    def set(self, key, value, expiration=None, tags=None):
+        """
+        lưu value với thời gian hết hạn riêng cho key, expiration=None thì dùng self.expiration
+        :param tags: danh sách tag gắn với key, mỗi tag là một SET chứa các key mang tag đó
+        """
+        if not self._available():
+            self._set_fallback(key, value, expiration, tags)
+            return
+        if expiration is None:
+            expiration = self.expiration
+        elif self._longest_ttl is not None and expiration > self._longest_ttl:
+            self._longest_ttl = expiration
+        try:
+            full_key = self._full_key(key)
+            pipe = self._redis.pipeline(transaction=False)
+            pipe.set(full_key, self.codec.encode(value), expiration)
+            if self.eviction == REDIS_EVICTION.SCOPED:
+                pipe.zadd(self._index_key, {full_key: time.time()})
+                if self._longest_ttl is not None:
+                    pipe.expire(self._index_key, self._longest_ttl)
+            for tag in tags or ():
+                tag_key = self._tag_key(tag)
+                pipe.sadd(tag_key, key)
+                # SET của tag sống ít nhất bằng key lâu nhất, key đã hết hạn còn sót trong SET sẽ
+                # bị bỏ qua khi invalidate
+                if self._longest_ttl is not None:
+                    pipe.expire(tag_key, self._longest_ttl)
+            self._timed(pipe.execute)
+        except redis.RedisError as ex:
+            self._on_error('set', ex)
+            self._set_fallback(key, value, expiration, tags)
+            return
+        self._safe_cleanup()
+
+    def _set_fallback(self, key, value, expiration=None, tags=None):
+        self._miss_write(key)
+        if self.fallback is not None:
+            self.fallback.set(key, value, expiration, tags)
+
+    @_lock_decorator
+    def invalidate_tag(self, tag):
+        """
+        xóa mọi key mang tag, chi phí tỷ lệ với số key được gắn tag
+        :return: số key đã xóa
+        """
+        return len(self._pop_tag(tag))
+
+    def _pop_tag(self, tag):
+        """ lấy và xóa SET của tag trong một transaction rồi xóa các key, trả về danh sách key """
+        if self.fallback is not None:
+            self.fallback.invalidate_tag(tag)
+        if not self._available():
+            # xóa các key mang tag khi kết nối lại
+            self._missed.add_tag(tag)
+            return []
+        try:
+            return self._delete_tag(tag)
+        except redis.RedisError as ex:
+            self._on_error('invalidate_tag', ex)
+            self._missed.add_tag(tag)
+            return []
+
+    def _delete_tag(self, tag):
+        tag_key = self._tag_key(tag)
+        pipe = self._redis.pipeline(transaction=True)
+        pipe.smembers(tag_key)
+        pipe.delete(tag_key)
+        members = self._timed(pipe.execute)[0]
+        keys = [m.decode('utf-8') if isinstance(m, bytes) else m for m in members]
+        self._delete_keys(keys)
+        return keys
 
     @_lock_decorator
     def __getitem__(self, key):
-        if self.is_redis_ready:
-            value = self._redis.get(key)
-            if not value:
-                raise KeyError
-            return json.loads(value, encoding="utf-8")
-        raise KeyError
+        return self._get(key, False)
+
+    @_lock_decorator
+    def get_with_ttl(self, key):
+        """
+        lấy value cùng số giây còn sống của key trong cùng một round trip
+        :return: (value, số giây còn sống hoặc None nếu key không hết hạn hoặc lấy từ fallback)
+        :raise KeyError: nếu không có key
+        """
+        return self._get(key, True)
+
+    def _get(self, key, with_ttl):
+        if not self._available():
+            value = self._get_fallback(key)
+            return (value, None) if with_ttl else value
+        full_key = self._full_key(key)
+        try:
+            if self.eviction == REDIS_EVICTION.SCOPED or with_ttl:
+                # lấy value, thời gian sống và cập nhật thời điểm truy cập trong cùng một round trip
+                pipe = self._redis.pipeline(transaction=False)
+                pipe.get(full_key)
+                if with_ttl:
+                    pipe.pttl(full_key)
+                if self.eviction == REDIS_EVICTION.SCOPED:
+                    pipe.zadd(self._index_key, {full_key: time.time()}, xx=True)
+                replies = self._timed(pipe.execute)
+                value = replies[0]
+            else:
+                value = self._timed(self._redis.get, full_key)
+        except redis.RedisError as ex:
+            self._on_error('get', ex)
+            value = self._get_fallback(key)
+            return (value, None) if with_ttl else value
+        if not value:
+            self.stats.misses += 1
+            raise KeyError(key)
+        self.stats.hits += 1
+        value = self._decode(key, value)
+        if with_ttl:
+            return value, _ttl_seconds(replies[1])
+        return value
+
+    def _get_fallback(self, key):
+        if self.fallback is not None:
+            try:
+                value = self.fallback[key]
+            except KeyError:
+                pass
+            else:
+                self.stats.hits += 1
+                return value
+        self.stats.misses += 1
+        raise KeyError(key)
+
+    def _decode(self, key, value):
+        try:
+            return self.codec.decode(value)
+        except ValueError as ex:
+            # value hỏng được coi như không có trong cache
+            print("RedisCacheDict: can not decode value of key %s: %s" % (key, ex))
+            raise KeyError(key)
+
+    def lock(self, key, timeout=LOCK_TIMEOUT_DEFAULT):
+        """ khóa phân tán theo key trong namespace, dùng để gộp các lần miss giữa nhiều worker """
+        if not self._available():
+            # không chờ khóa khi breaker mở, CacheLoader bỏ qua lỗi này và tự tính toán
+            raise redis.ConnectionError('circuit breaker of %s:%s is open' % (self.host, self.port))
+        return self._redis.lock(self._full_key(key) + ':__lock__', timeout=timeout)
+
+    @_lock_decorator
+    def get_many(self, keys):
+        """
+        lấy nhiều key bằng một lệnh MGET (và cập nhật chỉ mục truy cập trong cùng pipeline)
+        :param keys: danh sách key
+        :return: dict gồm các key có trong cache và value tương ứng
+        """
+        return self._get_many(keys, False)
+
+    def get_many_with_ttl(self, keys):
+        """
+        như get_many nhưng lấy thêm số giây còn sống của từng key trong cùng pipeline
+        :return: dict key -> (value, số giây còn sống hoặc None)
+        """
+        return self._get_many(keys, True)
+
+    def _get_many(self, keys, with_ttl):
+        keys = list(keys)
+        if not keys:
+            return {}
+        if not self._available():
+            return self._get_many_fallback(keys, with_ttl)
+        full_keys = [self._full_key(key) for key in keys]
+        pipe = self._redis.pipeline(transaction=False)
+        pipe.mget(full_keys)
+        if self.eviction == REDIS_EVICTION.SCOPED:
+            now = time.time()
+            pipe.zadd(self._index_key, {full_key: now for full_key in full_keys}, xx=True)
+        if with_ttl:
+            for full_key in full_keys:
+                pipe.pttl(full_key)
+        try:
+            replies = self._timed(pipe.execute)
+        except redis.RedisError as ex:
+            self._on_error('get_many', ex)
+            return self._get_many_fallback(keys, with_ttl)
+        ttls = replies[-len(keys):] if with_ttl else None
+        result = {}
+        for i, (key, value) in enumerate(zip(keys, replies[0])):
+            if value:
+                try:
+                    value = self._decode(key, value)
+                except KeyError:
+                    continue
+                result[key] = (value, _ttl_seconds(ttls[i])) if with_ttl else value
+        self.stats.hits += len(result)
+        self.stats.misses += len(keys) - len(result)
+        return result
+
+    def _get_many_fallback(self, keys, with_ttl=False):
+        result = self.fallback.get_many(keys) if self.fallback is not None else {}
+        self.stats.hits += len(result)
+        self.stats.misses += len(keys) - len(result)
+        if with_ttl:
+            return {key: (value, None) for key, value in result.items()}
+        return result
+
+    @_lock_decorator
+    def set_many(self, mapping):
+        """ lưu nhiều cặp key, value trong một pipeline """
+        if not mapping:
+            return
+        if not self._available():
+            self._set_many_fallback(mapping)
+            return
+        now = time.time()
+        pipe = self._redis.pipeline(transaction=False)
+        index = {}
+        for key, value in mapping.items():
+            full_key = self._full_key(key)
+            pipe.set(full_key, self.codec.encode(value), self.expiration)
+            index[full_key] = now
+        if self.eviction == REDIS_EVICTION.SCOPED:
+            pipe.zadd(self._index_key, index)
+            if self._longest_ttl is not None:
+                pipe.expire(self._index_key, self._longest_ttl)
+        try:
+            self._timed(pipe.execute)
+        except redis.RedisError as ex:
+            self._on_error('set_many', ex)
+            self._set_many_fallback(mapping)
+            return
+        self._safe_cleanup()
+
+    def _safe_cleanup(self):
+        """ loại bỏ key sau khi ghi, lỗi ở đây không ảnh hưởng tới value đã ghi thành công """
+        try:
+            self.cleanup()
+        except redis.RedisError as ex:
+            self._on_error('cleanup', ex)
+
+    def _set_many_fallback(self, mapping):
+        for key in mapping:
+            self._miss_write(key)
+        if self.fallback is not None:
+            self.fallback.set_many(mapping)
 
     @_lock_decorator
     def __delete__(self, key):
-        self._redis.delete([key])
+        if self.fallback is not None:
+            self.fallback.__delete__(key)
+        if not self._available():
+            self._miss_write(key)
+            return
+        full_key = self._full_key(key)
+        pipe = self._redis.pipeline(transaction=False)
+        pipe.delete(full_key)
+        if self.eviction == REDIS_EVICTION.SCOPED:
+            pipe.zrem(self._index_key, full_key)
+        try:
+            self._timed(pipe.execute)
+        except redis.RedisError as ex:
+            self._on_error('delete', ex)
+            self._miss_write(key)
+
+    def __delitem__(self, key):
+        self.__delete__(key)
 
     @_lock_decorator
     def cleanup(self):
-        keys = self._redis.keys()
-        a_range = self.size() - self.max_size
-        if a_range > 0:
-            self._redis.delete(keys[0:a_range])
+        """
+        Loại bỏ tối đa evict_batch key của namespace mỗi lần gọi: trước hết là các key chắc chắn
+        đã hết hạn, sau đó là các key ít được truy cập nhất nếu vượt quá max_size.
+        Không dùng KEYS/DBSIZE nên không chặn Redis và không đụng tới key của dự án khác.
+        """
+        if self.eviction != REDIS_EVICTION.SCOPED or not self.breaker.allow():
+            return None
+        pipe = self._redis.pipeline(transaction=False)
+        pipe.zcard(self._index_key)
+        if self._longest_ttl is not None:
+            pipe.zrangebyscore(self._index_key, '-inf', time.time() - self._longest_ttl,
+                               start=0, num=self.evict_batch)
+        results = self._timed(pipe.execute)
+        count = results[0]
+        victims = list(results[1]) if self._longest_ttl is not None else []
+        over = min(count - len(victims) - self.max_size, self.evict_batch - len(victims))
+        if over > 0:
+            victims.extend(self._timed(self._redis.zrange, self._index_key, len(victims), len(victims) + over - 1))
+        if victims:
+            self.stats.evictions += len(victims)
+            pipe = self._redis.pipeline(transaction=False)
+            pipe.zrem(self._index_key, *victims)
+            pipe.delete(*victims)
+            self._timed(pipe.execute)
+        return None
+
+
+class TieredCacheDict(object):
+    """ Cache 2 tầng: L1 là LRUCacheDict nhỏ trong tiến trình, L2 là RedisCacheDict dùng chung.
+
+    Key nóng được phục vụ từ L1 không cần round trip tới Redis. Mỗi lần ghi hoặc xóa sẽ được
+    loan báo qua Redis pub/sub để các worker khác xóa bản sao L1 của key đó, giữ các node
+    nhất quán với nhau. Khi chưa đăng ký được kênh pub/sub (lúc khởi động, mất kết nối) L1 bị
+    bỏ qua, sau mỗi lần đăng ký lại L1 được xóa vì các thông báo trong lúc đó đã bị bỏ lỡ.
+    Bản sao L1 chỉ sống tối đa l1_expiration giây (mặc định L1_EXPIRATION_DEFAULT) nên một thông báo
+    bị mất cũng chỉ làm worker đọc value cũ trong chừng đó thời gian.
+    """
+    INVALIDATION_CHANNEL_DEFAULT = 'pytemp:cache:invalidation'
+    L1_MAX_SIZE_DEFAULT = 10240
+    # thời gian sống tối đa của bản sao L1, là giới hạn trên của thời gian đọc phải value cũ khi
+    # một thông báo invalidation bị mất
+    L1_EXPIRATION_DEFAULT = 5
+
+    def __init__(self, config_file_name, max_size=CACHE_MAX_SIZE_DEFAULT, expiration=EXPIRATION_DEFAULT,
+                 l1_max_size=L1_MAX_SIZE_DEFAULT, l1_expiration=L1_EXPIRATION_DEFAULT,
+                 channel=INVALIDATION_CHANNEL_DEFAULT, codec=None):
+        """
+        :param l1_expiration: số giây tối đa giữ bản sao L1, không vượt quá expiration, None là bằng expiration
+        """
+        self.max_size = max_size
+        self.expiration = expiration
+        self.concurrent = True
+        self.channel = channel
+        self.origin = uuid.uuid4().hex
+        if l1_expiration is None or (expiration is not None and l1_expiration > expiration):
+            l1_expiration = expiration
+        # L1 đã là cache cục bộ nên L2 không cần fallback khi Redis không sẵn sàng
+        self.l2 = RedisCacheDict(config_file_name, max_size, expiration, concurrent=True, codec=codec,
+                                 fallback_size=0)
+        self.l1 = LRUCacheDict(l1_max_size, l1_expiration, concurrent=True)
+        # L1 chỉ được dùng khi đang nhận được invalidation, trước đó mọi lệnh đọc/ghi đi thẳng tới L2
+        self.subscribed = False
+        # luôn chạy thread nhận invalidation, thread tự kết nối lại khi Redis trở lại
+        self.InvalidationThread(self).start()
+
+    class InvalidationThread(threading.Thread):
+        """ Thread nhận các thông báo invalidation từ worker khác và xóa key khỏi L1 """
+        daemon = True
+
+        def __init__(self, cache, reconnect_delay=5):
+            self.ref = weakref.ref(cache)
+            self.l1 = cache.l1
+            self.origin = cache.origin
+            self.channel = cache.channel
+            self._redis = cache.l2.get_instance()
+            self.reconnect_delay = reconnect_delay
+            super(TieredCacheDict.InvalidationThread, self).__init__()
+
+        def run(self):
+            while self.ref():
+                try:
+                    pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+                    pubsub.subscribe(self.channel)
+                    # thông báo gửi trước khi đăng ký xong đã bị bỏ lỡ nên xóa L1 rồi mới dùng lại L1
+                    self.l1.clear()
+                    self._set_subscribed(True)
+                    while self.ref():
+                        message = pubsub.get_message(timeout=1)
+                        if message and message.get('type') == 'message':
+                            self.handle(message['data'])
+                except redis.RedisError as ex:
+                    print("TieredCacheDict: invalidation subscriber error: %s" % ex)
+                    # bỏ qua L1 tới khi đăng ký lại được
+                    self._set_subscribed(False)
+                    self.l1.clear()
+                    time.sleep(self.reconnect_delay)
+
+        def _set_subscribed(self, subscribed):
+            cache = self.ref()
+            if cache is not None:
+                cache.subscribed = subscribed
+
+        def handle(self, data):
+            try:
+                message = json.loads(data.decode('utf-8') if isinstance(data, bytes) else data)
+            except ValueError:
+                return
+            if message.get('origin') == self.origin:
+                return
+            if message.get('op') == 'clear':
+                self.l1.clear()
+            else:
+                for key in message.get('keys', []):
+                    self.l1.__delete__(key)
+
+    def _publish(self, op, keys=None):
+        if not self.l2.is_redis_ready:
+            return
+        message = {'origin': self.origin, 'op': op, 'keys': keys or []}
+        try:
+            self.l2.get_instance().publish(self.channel, json.dumps(message))
+        except redis.RedisError as ex:
+            print("TieredCacheDict: can not publish invalidation: %s" % ex)
+
+    def size(self):
+        return self.l2.size()
+
+    def get_stats(self):
+        return {'l1': self.l1.get_stats(), 'l2': self.l2.get_stats()}
+
+    def clear(self):
+        """
+        Tăng generation của L2 và xóa L1 của mọi worker
+        """
+        self.l2.clear()
+        self.l1.clear()
+        self._publish('clear')
+
+    def __contains__(self, key):
+        return self.has_key(key)
+
+    def has_key(self, key):
+        return (self.subscribed and self.l1.has_key(key)) or bool(self.l2.has_key(key))
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def set(self, key, value, expiration=None, tags=None):
+        self.l2.set(key, value, expiration, tags)
+        if self.subscribed:
+            if expiration is not None and self.l1.expiration is not None:
+                expiration = min(expiration, self.l1.expiration)
+            self.l1.set(key, value, expiration, tags)
+        self._publish('delete', [key])
+
+    def invalidate_tag(self, tag):
+        """
+        xóa các key mang tag ở L2 rồi loan báo danh sách key đó để mọi worker xóa bản sao L1,
+        kể cả bản sao được nạp từ L2 không kèm tag
+        """
+        keys = self.l2._pop_tag(tag)
+        count = self.l1.invalidate_tag(tag)
+        for key in keys:
+            self.l1.__delete__(key)
+        if keys:
+            self._publish('delete', keys)
+        return max(len(keys), count)
+
+    def __getitem__(self, key):
+        if self.subscribed:
+            try:
+                return self.l1[key]
+            except KeyError:
+                pass
+        value, ttl = self.l2.get_with_ttl(key)
+        self._promote(key, value, ttl)
+        return value
+
+    def _promote(self, key, value, ttl):
+        """ chép value từ L2 lên L1 với thời gian sống còn lại ở L2, để TTL riêng của key (vd negative_ttl) không bị kéo dài """
+        if not self.subscribed:
+            return
+        if ttl is None:
+            self.l1.set(key, value)
+        elif ttl > 0:
+            if self.l1.expiration is not None:
+                ttl = min(ttl, self.l1.expiration)
+            self.l1.set(key, value, ttl)
+
+    def lock(self, key, timeout=LOCK_TIMEOUT_DEFAULT):
+        return self.l2.lock(key, timeout)
+
+    def get_many(self, keys):
+        keys = list(keys)
+        result = self.l1.get_many(keys) if self.subscribed else {}
+        missing = [key for key in keys if key not in result]
+        if missing:
+            for key, (value, ttl) in self.l2.get_many_with_ttl(missing).items():
+                self._promote(key, value, ttl)
+                result[key] = value
+        return result
+
+    def set_many(self, mapping):
+        if not mapping:
+            return
+        self.l2.set_many(mapping)
+        if self.subscribed:
+            self.l1.set_many(mapping)
+        self._publish('delete', list(mapping.keys()))
+
+    def __delete__(self, key):
+        self.l1.__delete__(key)
+        self.l2.__delete__(key)
+        self._publish('delete', [key])
+
+    def __delitem__(self, key):
+        self.__delete__(key)
+
+    def cleanup(self):
+        return self.l1.cleanup()
 
 
-lru_local_cache = LruCache()
+lru_local_cache = LruCache(name='local')
 
 if __name__ == "__main__":
     __store_type = STORE_TYPE.REDIS
     __file_config = ''
 
-    lru_cache = LruCache()
+    lru_cache = LruCache(name='demo')
 
 
     class TestCache:
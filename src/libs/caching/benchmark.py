@@ -0,0 +1,344 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*-
+""" Bộ benchmark cho các kho cache, dùng để so sánh hiệu năng giữa các commit.
+
+    Mỗi kịch bản là một tổ hợp (target, phân bố key, tỷ lệ đọc, số thread, kích thước cache):
+        - target: lru (LRUCacheDict), sharded (ShardedLRUCacheDict), decorator (LruCache.add),
+          redis (RedisCacheDict, cần --redis-config hoặc --fake-redis để dùng fakeredis trong tiến trình)
+        - phân bố key: zipf (key phổ biến được truy cập nhiều, hệ số --zipf-s) hoặc uniform
+        - đọc bị miss thì ghi lại (cache-aside), các thao tác còn lại là ghi
+    Kết quả là JSON gồm ops/sec, độ trễ p50/p99 (giây) và tỷ lệ hit của từng kịch bản, mỗi kịch bản có
+    id cố định để so với file kết quả của commit khác bằng --baseline.
+
+    python -m src.libs.caching.benchmark --targets lru,decorator --threads 1,4 --output bench.json
+    python -m src.libs.caching.benchmark --targets lru,decorator --threads 1,4 --baseline bench.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from bisect import bisect_left
+from unittest import mock
+
+import redis
+
+from src.libs.caching import LRUCacheDict, LruCache, RedisCacheDict, ShardedLRUCacheDict
+
+
+class DISTRIBUTION:
+    ZIPF = 'zipf'
+    UNIFORM = 'uniform'
+
+
+class TARGET:
+    LRU = 'lru'
+    SHARDED = 'sharded'
+    DECORATOR = 'decorator'
+    REDIS = 'redis'
+
+
+OPS_DEFAULT = 20000
+KEY_SPACE_DEFAULT = 100000
+ZIPF_S_DEFAULT = 1.0
+VALUE_SIZE_DEFAULT = 100
+SEED_DEFAULT = 20201018
+
+
+class ZipfKeys(object):
+    """ sinh key theo phân bố Zipf trên key_space key: key thứ k có xác suất tỷ lệ với 1 / k^s
+
+    >>> keys = ZipfKeys(1000, 1.0, random.Random(1))
+    >>> sample = [keys.next() for _ in range(10000)]
+    >>> sample.count(0) > sample.count(10) > sample.count(500)
+    True
+    """
+
+    def __init__(self, key_space, s=ZIPF_S_DEFAULT, rnd=None):
+        self.rnd = rnd or random.Random()
+        total = 0.0
+        self._cdf = []
+        for k in range(1, key_space + 1):
+            total += 1.0 / k ** s
+            self._cdf.append(total)
+        self._total = total
+
+    def next(self):
+        return bisect_left(self._cdf, self.rnd.random() * self._total)
+
+
+class UniformKeys(object):
+    def __init__(self, key_space, rnd=None):
+        self.key_space = key_space
+        self.rnd = rnd or random.Random()
+
+    def next(self):
+        return self.rnd.randrange(self.key_space)
+
+
+def _create_keys(distribution, key_space, zipf_s, rnd):
+    if distribution == DISTRIBUTION.ZIPF:
+        return ZipfKeys(key_space, zipf_s, rnd)
+    if distribution == DISTRIBUTION.UNIFORM:
+        return UniformKeys(key_space, rnd)
+    raise NotImplementedError('distribution=%s' % distribution)
+
+
+def _percentile(ordered, q):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class _Driver(object):
+    """ thao tác lên một target: read trả về True nếu hit, fill lưu value sau khi miss, write là ghi mới """
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def read(self, key):
+        try:
+            self.cache[key]
+            return True
+        except KeyError:
+            return False
+
+    def fill(self, key, value):
+        self.cache[key] = value
+
+    def write(self, key, value):
+        self.cache[key] = value
+
+    def close(self):
+        pass
+
+
+class _DecoratorDriver(_Driver):
+    """ gọi hàm được bọc bởi LruCache.add, hàm gốc được gọi tức là miss, ghi là invalidate tag của key """
+
+    def __init__(self, size, value):
+        self.loads = 0
+        self.value = value
+        cache = LruCache(max_size=size, expiration=None, name='benchmark')
+
+        @cache.add(tags=['benchmark:{key}'])
+        def load(key):
+            self.loads += 1
+            return self.value
+
+        self.load = load
+        super(_DecoratorDriver, self).__init__(cache)
+
+    def read(self, key):
+        loads = self.loads
+        self.load(key)
+        return self.loads == loads
+
+    def fill(self, key, value):
+        # hàm được bọc đã tự lưu value khi miss
+        pass
+
+    def write(self, key, value):
+        self.cache.invalidate_tag('benchmark:%s' % key)
+
+
+class _RedisDriver(_Driver):
+    def close(self):
+        self.cache.clear()
+
+
+def _fake_redis_cache(size):
+    """ RedisCacheDict chạy trên fakeredis trong tiến trình, cần cài gói fakeredis """
+    import fakeredis
+    server = fakeredis.FakeServer()
+    with tempfile.NamedTemporaryFile('w', suffix='.conf', delete=False) as f:
+        # host riêng để pool/breaker dùng chung của host thật không bị thay bởi fakeredis
+        f.write('[REDIS_MODE]\nhost=fakeredis-benchmark\nport=0\n')
+    try:
+        with mock.patch.object(redis, 'Redis', lambda *args, **kwargs: fakeredis.FakeRedis(server=server)):
+            return RedisCacheDict(f.name, size, None, concurrent=True, namespace='pytemp:benchmark',
+                                  fallback_size=0)
+    finally:
+        os.remove(f.name)
+
+
+def create_driver(target, size, value, redis_config=None, fake_redis=False):
+    if target == TARGET.LRU:
+        return _Driver(LRUCacheDict(size, None, concurrent=True))
+    if target == TARGET.SHARDED:
+        return _Driver(ShardedLRUCacheDict(size, None))
+    if target == TARGET.DECORATOR:
+        return _DecoratorDriver(size, value)
+    if target == TARGET.REDIS:
+        if fake_redis:
+            return _RedisDriver(_fake_redis_cache(size))
+        if redis_config is None:
+            raise ValueError('redis target needs --redis-config or --fake-redis')
+        return _RedisDriver(RedisCacheDict(redis_config, size, None, concurrent=True, namespace='pytemp:benchmark',
+                                           fallback_size=0))
+    raise NotImplementedError('target=%s' % target)
+
+
+def run_scenario(target, distribution, read_ratio, threads, size, ops=OPS_DEFAULT, key_space=KEY_SPACE_DEFAULT,
+                 zipf_s=ZIPF_S_DEFAULT, value_size=VALUE_SIZE_DEFAULT, seed=SEED_DEFAULT, redis_config=None,
+                 fake_redis=False):
+    """
+    chạy một kịch bản, ops thao tác được chia đều cho các thread
+    :return: dict kết quả của kịch bản
+    """
+    value = 'x' * value_size
+    driver = create_driver(target, size, value, redis_config, fake_redis)
+    per_thread = max(1, ops // threads)
+    latencies = [None] * threads
+    counters = [None] * threads
+    barrier = threading.Barrier(threads + 1)
+
+    def work(index):
+        rnd = random.Random(seed + index)
+        keys = _create_keys(distribution, key_space, zipf_s, rnd)
+        observed = []
+        reads = hits = 0
+        clock = time.perf_counter
+        barrier.wait()
+        for _ in range(per_thread):
+            key = 'k%d' % keys.next()
+            t0 = clock()
+            if rnd.random() < read_ratio:
+                reads += 1
+                if driver.read(key):
+                    hits += 1
+                else:
+                    driver.fill(key, value)
+            else:
+                driver.write(key, value)
+            observed.append(clock() - t0)
+        latencies[index] = observed
+        counters[index] = (reads, hits)
+
+    workers = [threading.Thread(target=work, args=(i,)) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    barrier.wait()
+    t0 = time.perf_counter()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - t0
+    driver.close()
+
+    ordered = sorted(seconds for observed in latencies for seconds in observed)
+    reads = sum(c[0] for c in counters)
+    hits = sum(c[1] for c in counters)
+    return {
+        'id': scenario_id(target, distribution, read_ratio, threads, size),
+        'target': target,
+        'distribution': distribution,
+        'read_ratio': read_ratio,
+        'threads': threads,
+        'size': size,
+        'ops': len(ordered),
+        'seconds': elapsed,
+        'ops_per_sec': len(ordered) / elapsed if elapsed else 0.0,
+        'p50': _percentile(ordered, 0.5),
+        'p99': _percentile(ordered, 0.99),
+        'hit_ratio': float(hits) / reads if reads else 0.0
+    }
+
+
+def scenario_id(target, distribution, read_ratio, threads, size):
+    return '%s/%s/r%g/t%d/s%d' % (target, distribution, read_ratio, threads, size)
+
+
+def _revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(targets, distributions, read_ratios, threads, sizes, **kwargs):
+    """ chạy mọi tổ hợp kịch bản, trả về dict gồm thông tin môi trường và danh sách kết quả """
+    results = []
+    for target in targets:
+        for distribution in distributions:
+            for read_ratio in read_ratios:
+                for thread_count in threads:
+                    for size in sizes:
+                        result = run_scenario(target, distribution, read_ratio, thread_count, size, **kwargs)
+                        print("%-40s %12.0f ops/s  p50 %.6fs  p99 %.6fs  hit %.3f"
+                              % (result['id'], result['ops_per_sec'], result['p50'], result['p99'],
+                                 result['hit_ratio']), file=sys.stderr)
+                        results.append(result)
+    return {
+        'revision': _revision(),
+        'python': platform.python_version(),
+        'created_at': time.time(),
+        'params': kwargs,
+        'results': results
+    }
+
+
+def compare(baseline, current):
+    """
+    so sánh hai lần chạy theo id kịch bản
+    :return: danh sách (id, tỷ lệ ops/sec mới / cũ, tỷ lệ p99 mới / cũ, chênh lệch hit ratio)
+    """
+    old = {result['id']: result for result in baseline['results']}
+    rows = []
+    for result in current['results']:
+        base = old.get(result['id'])
+        if base is None:
+            continue
+        rows.append((result['id'],
+                     result['ops_per_sec'] / base['ops_per_sec'] if base['ops_per_sec'] else None,
+                     result['p99'] / base['p99'] if base['p99'] else None,
+                     result['hit_ratio'] - base['hit_ratio']))
+    return rows
+
+
+def _split(value, cast=str):
+    return [cast(item) for item in value.split(',') if item]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='benchmark for src.libs.caching')
+    parser.add_argument('--targets', type=_split, default=[TARGET.LRU, TARGET.SHARDED, TARGET.DECORATOR])
+    parser.add_argument('--distributions', type=_split, default=[DISTRIBUTION.ZIPF, DISTRIBUTION.UNIFORM])
+    parser.add_argument('--read-ratios', type=lambda v: _split(v, float), default=[0.9, 0.5])
+    parser.add_argument('--threads', type=lambda v: _split(v, int), default=[1, 4])
+    parser.add_argument('--sizes', type=lambda v: _split(v, int), default=[1000, 10000])
+    parser.add_argument('--ops', type=int, default=OPS_DEFAULT)
+    parser.add_argument('--key-space', type=int, default=KEY_SPACE_DEFAULT)
+    parser.add_argument('--zipf-s', type=float, default=ZIPF_S_DEFAULT)
+    parser.add_argument('--value-size', type=int, default=VALUE_SIZE_DEFAULT)
+    parser.add_argument('--seed', type=int, default=SEED_DEFAULT)
+    parser.add_argument('--redis-config', default=None)
+    parser.add_argument('--fake-redis', action='store_true')
+    parser.add_argument('--output', default=None, help='file JSON kết quả, mặc định in ra stdout')
+    parser.add_argument('--baseline', default=None, help='file JSON của lần chạy trước để so sánh')
+    args = parser.parse_args(argv)
+
+    report = run_suite(args.targets, args.distributions, args.read_ratios, args.threads, args.sizes,
+                       ops=args.ops, key_space=args.key_space, zipf_s=args.zipf_s, value_size=args.value_size,
+                       seed=args.seed, redis_config=args.redis_config, fake_redis=args.fake_redis)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(report, indent=2, sort_keys=True))
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        for scenario, throughput, p99, hit_ratio in compare(baseline, report):
+            print("%-40s ops/s x%s  p99 x%s  hit %+.3f"
+                  % (scenario, '%.2f' % throughput if throughput else '-', '%.2f' % p99 if p99 else '-',
+                     hit_ratio), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*-
+""" Circuit breaker cho kết nối tới Redis.
+
+    CLOSED: mọi lệnh được gửi tới Redis, lỗi kết nối liên tiếp được đếm lại.
+    OPEN: sau failure_threshold lỗi liên tiếp, mọi lệnh bị từ chối ngay (không chờ socket timeout)
+    và một thread nền gọi hàm probe (vd PING) mỗi probe_interval giây. Probe thành công thì
+    breaker trở lại CLOSED.
+    MissedWrites ghi nhớ các lần ghi/xóa bị bỏ lỡ trong lúc breaker mở để áp dụng khi kết nối lại.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class BREAKER_STATE:
+    CLOSED = 'closed'
+    OPEN = 'open'
+
+
+FAILURE_THRESHOLD_DEFAULT = 3
+PROBE_INTERVAL_DEFAULT = 2
+
+
+class CircuitBreaker(object):
+    """
+    >>> breaker = CircuitBreaker('doctest', probe=None, failure_threshold=2)
+    >>> breaker.record_failure(); breaker.allow()
+    True
+    >>> breaker.record_failure(); breaker.allow()
+    CircuitBreaker doctest: opened after 2 failures
+    False
+    >>> breaker.opened_at -= 5
+    >>> breaker.record_success(); breaker.allow()
+    CircuitBreaker doctest: closed after 5.0s
+    True
+    """
+
+    def __init__(self, name, probe, failure_threshold=FAILURE_THRESHOLD_DEFAULT,
+                 probe_interval=PROBE_INTERVAL_DEFAULT):
+        """
+        :param probe: hàm kiểm tra kết nối, raise exception nếu chưa kết nối được, None là không tự phục hồi
+        """
+        self.name = name
+        self.probe = probe
+        self.failure_threshold = failure_threshold
+        self.probe_interval = probe_interval
+        self.state = BREAKER_STATE.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+        self._probe_thread = None
+
+    def allow(self):
+        return self.state == BREAKER_STATE.CLOSED
+
+    def record_success(self):
+        if self.failures or self.state != BREAKER_STATE.CLOSED:
+            with self._lock:
+                self.failures = 0
+                if self.state != BREAKER_STATE.CLOSED:
+                    self.state = BREAKER_STATE.CLOSED
+                    print("CircuitBreaker %s: closed after %.1fs" % (self.name, time.time() - self.opened_at))
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold and self.state == BREAKER_STATE.CLOSED:
+                self._open()
+
+    def trip(self):
+        """ mở breaker ngay, vd khi không kết nối được lúc khởi động """
+        with self._lock:
+            self.failures = max(self.failures, self.failure_threshold)
+            if self.state == BREAKER_STATE.CLOSED:
+                self._open()
+
+    def _open(self):
+        self.state = BREAKER_STATE.OPEN
+        self.opened_at = time.time()
+        print("CircuitBreaker %s: opened after %d failures" % (self.name, self.failures))
+        if self.probe is not None and (self._probe_thread is None or not self._probe_thread.is_alive()):
+            self._probe_thread = threading.Thread(target=self._run_probe, name='breaker-probe-%s' % self.name)
+            self._probe_thread.daemon = True
+            self._probe_thread.start()
+
+    def _run_probe(self):
+        while self.state != BREAKER_STATE.CLOSED:
+            time.sleep(self.probe_interval)
+            try:
+                self.probe()
+            except Exception:
+                continue
+            self.record_success()
+
+
+class MissedWrites(object):
+    """ Các lần ghi/xóa chưa áp dụng được lên Redis trong lúc breaker mở, khi kết nối lại chỉ cần xóa
+    các key (và các tag) đó để lần đọc sau nạp lại. Quá max_size lần thì không còn biết key nào cần xóa,
+    namespace phải được xóa hết bằng cách tăng generation và flush cho biết lý do.
+
+    >>> missed = MissedWrites('doctest', max_size=3)
+    >>> missed.add_key('a'); missed.add_key('a'); missed.add_tag('bot:1')
+    >>> keys, tags, flush = missed.take()
+    >>> list(keys), list(tags), flush, bool(missed)
+    (['a'], ['bot:1'], None, False)
+    >>> for key in 'abcd':
+    ...     missed.add_key(key)
+    MissedWrites doctest: more than 3 missed writes, the namespace will be flushed for every process
+    >>> keys, tags, flush = missed.take()
+    >>> list(keys), flush
+    ([], 'more than 3 missed writes')
+    >>> missed.restore(['x'], [], None); list(missed.take()[0])
+    ['x']
+    """
+
+    def __init__(self, name, max_size):
+        self.name = name
+        self.max_size = max_size
+        self._keys = OrderedDict()
+        self._tags = OrderedDict()
+        self._flush = None
+        self._lock = threading.Lock()
+
+    def __bool__(self):
+        return bool(self._keys or self._tags or self._flush)
+
+    def add_key(self, key):
+        with self._lock:
+            self._add(self._keys, key)
+
+    def add_tag(self, tag):
+        with self._lock:
+            self._add(self._tags, tag)
+
+    def add_flush(self, reason):
+        """ thao tác cần xóa cả namespace, vd clear() khi breaker mở """
+        with self._lock:
+            self._set_flush(reason)
+
+    def _add(self, items, item):
+        if self._flush is not None:
+            return
+        if item not in items and len(self._keys) + len(self._tags) >= self.max_size:
+            reason = 'more than %d missed writes' % self.max_size
+            print("MissedWrites %s: %s, the namespace will be flushed for every process" % (self.name, reason))
+            self._set_flush(reason)
+        else:
+            items[item] = None
+
+    def _set_flush(self, reason):
+        if self._flush is None:
+            self._flush = reason
+        self._keys = OrderedDict()
+        self._tags = OrderedDict()
+
+    def take(self):
+        """
+        lấy ra và xóa các lần ghi đã bỏ lỡ
+        :return: (các key, các tag, lý do phải xóa cả namespace hoặc None)
+        """
+        with self._lock:
+            result = (self._keys, self._tags, self._flush)
+            self._keys = OrderedDict()
+            self._tags = OrderedDict()
+            self._flush = None
+        return result
+
+    def restore(self, keys, tags, flush):
+        """ trả lại những gì đã take khi chưa áp dụng được lên Redis """
+        with self._lock:
+            if flush is not None:
+                self._set_flush(flush)
+            for tag in tags:
+                self._add(self._tags, tag)
+            for key in keys:
+                self._add(self._keys, key)
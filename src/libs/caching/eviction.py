@@ -0,0 +1,221 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*-
+""" Các chính sách loại bỏ key cho LRUCacheDict ngoài LRU mặc định.
+
+    - TINY_LFU (W-TinyLFU): key mới vào một cửa sổ LRU nhỏ, khi rời cửa sổ chỉ được nhận vào vùng
+      chính nếu tần suất (ước lượng bằng count-min sketch) cao hơn key sắp bị loại của vùng chính.
+      Một loạt key chỉ xuất hiện một lần không đẩy được các key phổ biến ra ngoài.
+    - ARC: cân bằng tự động giữa key mới dùng (T1) và key dùng nhiều lần (T2) nhờ hai danh sách
+      "bóng ma" (B1, B2) ghi nhớ các key vừa bị loại.
+
+    Chính sách chỉ giữ key, value vẫn nằm trong LRUCacheDict. LRUCacheDict gọi on_insert khi thêm key,
+    on_access khi đọc hoặc ghi đè key, on_remove khi key bị xóa/hết hạn và victim để chọn key cần loại.
+"""
+from collections import OrderedDict
+
+
+class EVICTION_POLICY:
+    LRU = 'lru'
+    TINY_LFU = 'tinylfu'
+    ARC = 'arc'
+
+
+class CountMinSketch(object):
+    """ Ước lượng tần suất truy cập với bộ nhớ cố định, bộ đếm tối đa 15 và được chia đôi định kỳ
+    để tần suất cũ giảm dần.
+
+    >>> sketch = CountMinSketch(64)
+    >>> for _ in range(5):
+    ...     sketch.increment('hot')
+    >>> sketch.frequency('hot'), sketch.frequency('cold')
+    (5, 0)
+    """
+    DEPTH = 4
+    MAX_COUNT = 15
+    _SEEDS = (0x97cb3127, 0xe5a6b2c1, 0x3c6ef372, 0xa54ff53a)
+
+    def __init__(self, capacity):
+        width = 16
+        while width < capacity:
+            width <<= 1
+        self.width = width
+        self._mask = width - 1
+        self._table = [0] * (width * self.DEPTH)
+        self.sample_size = 10 * width
+        self._additions = 0
+
+    def _indexes(self, key):
+        h = hash(key)
+        for row, seed in enumerate(self._SEEDS):
+            x = ((h ^ seed) * 0x9e3779b1) & 0xffffffff
+            yield row * self.width + ((x ^ (x >> 15)) & self._mask)
+
+    def increment(self, key):
+        table = self._table
+        added = False
+        for i in self._indexes(key):
+            if table[i] < self.MAX_COUNT:
+                table[i] += 1
+                added = True
+        if added:
+            self._additions += 1
+            if self._additions >= self.sample_size:
+                self._reset()
+
+    def frequency(self, key):
+        table = self._table
+        return min(table[i] for i in self._indexes(key))
+
+    def _reset(self):
+        self._table = [count >> 1 for count in self._table]
+        self._additions >>= 1
+
+    def clear(self):
+        self._table = [0] * len(self._table)
+        self._additions = 0
+
+
+class TinyLfuPolicy(object):
+    """ W-TinyLFU: cửa sổ LRU (window_ratio dung lượng) + vùng chính SLRU (probation, protected) """
+
+    def __init__(self, max_size, window_ratio=0.01, protected_ratio=0.8):
+        self.window_max = max(1, int(max_size * window_ratio))
+        self.protected_max = max(1, int((max_size - self.window_max) * protected_ratio))
+        self.sketch = CountMinSketch(max_size)
+        self._window = OrderedDict()
+        self._probation = OrderedDict()
+        self._protected = OrderedDict()
+        # key vừa rời cửa sổ, đang chờ so tần suất với key sắp bị loại của probation
+        self._candidate = None
+
+    def on_insert(self, key):
+        self.sketch.increment(key)
+        self._window[key] = True
+        if len(self._window) > self.window_max:
+            candidate, _ = self._window.popitem(last=False)
+            self._probation[candidate] = True
+            self._candidate = candidate
+
+    def on_access(self, key):
+        self.sketch.increment(key)
+        if key in self._window:
+            self._window.move_to_end(key)
+        elif key in self._probation:
+            del self._probation[key]
+            self._protected[key] = True
+            if len(self._protected) > self.protected_max:
+                demoted, _ = self._protected.popitem(last=False)
+                self._probation[demoted] = True
+        elif key in self._protected:
+            self._protected.move_to_end(key)
+
+    def on_remove(self, key):
+        if self._window.pop(key, None) is None and self._probation.pop(key, None) is None:
+            self._protected.pop(key, None)
+        if key == self._candidate:
+            self._candidate = None
+
+    def victim(self):
+        candidate, self._candidate = self._candidate, None
+        if self._probation:
+            victim = next(iter(self._probation))
+            if candidate is not None and candidate != victim and candidate in self._probation \
+                    and self.sketch.frequency(candidate) <= self.sketch.frequency(victim):
+                victim = candidate
+            del self._probation[victim]
+            return victim
+        for segment in (self._protected, self._window):
+            if segment:
+                return segment.popitem(last=False)[0]
+        return None
+
+    def clear(self):
+        self._window.clear()
+        self._probation.clear()
+        self._protected.clear()
+        self._candidate = None
+        self.sketch.clear()
+
+
+class ArcPolicy(object):
+    """ Adaptive Replacement Cache: T1/T2 là key đang có trong cache, B1/B2 là key vừa bị loại """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        # kích thước mục tiêu của T1
+        self.p = 0
+        self._t1 = OrderedDict()
+        self._t2 = OrderedDict()
+        self._b1 = OrderedDict()
+        self._b2 = OrderedDict()
+        self._newest = None
+
+    def on_insert(self, key):
+        if key in self._b1:
+            self.p = min(self.max_size, self.p + max(len(self._b2) // len(self._b1), 1))
+            del self._b1[key]
+            self._t2[key] = True
+        elif key in self._b2:
+            self.p = max(0, self.p - max(len(self._b1) // len(self._b2), 1))
+            del self._b2[key]
+            self._t2[key] = True
+        else:
+            self._t1[key] = True
+        self._newest = key
+        self._trim_ghosts()
+
+    def on_access(self, key):
+        if key in self._t1:
+            del self._t1[key]
+            self._t2[key] = True
+        elif key in self._t2:
+            self._t2.move_to_end(key)
+
+    def on_remove(self, key):
+        if self._t1.pop(key, None) is None:
+            self._t2.pop(key, None)
+
+    def victim(self):
+        t1_first = next(iter(self._t1)) if self._t1 else None
+        use_t1 = self._t1 and (len(self._t1) > self.p or not self._t2)
+        # không loại key vừa được thêm nếu còn lựa chọn khác
+        if use_t1 and t1_first == self._newest and len(self._t1) == 1 and self._t2:
+            use_t1 = False
+        if use_t1:
+            key, _ = self._t1.popitem(last=False)
+            self._b1[key] = True
+        elif self._t2:
+            key, _ = self._t2.popitem(last=False)
+            self._b2[key] = True
+        else:
+            return None
+        self._trim_ghosts()
+        return key
+
+    def _trim_ghosts(self):
+        while self._b1 and len(self._t1) + len(self._b1) > self.max_size:
+            self._b1.popitem(last=False)
+        while self._b2 and len(self._t1) + len(self._t2) + len(self._b1) + len(self._b2) > 2 * self.max_size:
+            self._b2.popitem(last=False)
+
+    def clear(self):
+        self.p = 0
+        self._t1.clear()
+        self._t2.clear()
+        self._b1.clear()
+        self._b2.clear()
+        self._newest = None
+
+
+def create_policy(policy, max_size):
+    """
+    :param policy: tên chính sách trong EVICTION_POLICY
+    :return: đối tượng chính sách, None với LRU vì LRUCacheDict tự xử lý theo thứ tự truy cập
+    """
+    if policy is None or policy == EVICTION_POLICY.LRU:
+        return None
+    if policy == EVICTION_POLICY.TINY_LFU:
+        return TinyLfuPolicy(max_size)
+    if policy == EVICTION_POLICY.ARC:
+        return ArcPolicy(max_size)
+    raise NotImplementedError('policy=%s' % policy)
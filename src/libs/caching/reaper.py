@@ -0,0 +1,190 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*-
+""" Một thread dùng chung cho cả tiến trình để xóa key hết hạn của các cache (thay cho mỗi cache
+    một EmptyCacheThread).
+
+    Các cache hẹn giờ với ExpiryReaper theo thời điểm hết hạn sớm nhất của mình, các hẹn giờ được
+    lưu trong bánh xe thời gian phân cấp (TimerWheel) nên thêm/hủy đều O(1). Khi tới hạn, reaper gọi
+    cache.reap(batch) để xóa tối đa batch key trong một lần giữ khóa, nếu còn key hết hạn thì cache
+    tự hẹn lại để được gọi tiếp ngay sau đó. Reaper chỉ giữ weakref tới cache nên cache vẫn được
+    thu hồi bộ nhớ bình thường.
+"""
+import threading
+import time
+import weakref
+
+REAPER_TICK_DEFAULT = 1.0
+REAP_BATCH_DEFAULT = 256
+
+
+class TimerWheel(object):
+    """ Bánh xe thời gian phân cấp: levels tầng, mỗi tầng slots ô, ô của tầng sau rộng gấp slots lần
+    tầng trước. Hẹn giờ xa được đặt ở tầng cao và dồn dần xuống tầng 0 khi thời gian trôi qua.
+
+    >>> wheel = TimerWheel(tick=1, slots=4, levels=2)
+    >>> wheel.schedule('a', 102, now=100)
+    >>> wheel.schedule('b', 111, now=100)
+    >>> wheel.schedule('c', 130, now=100)
+    >>> wheel.advance(105), wheel.advance(112), wheel.advance(200)
+    (['a'], ['b'], ['c'])
+    """
+
+    def __init__(self, tick=REAPER_TICK_DEFAULT, slots=64, levels=4):
+        self.tick = tick
+        self.slots = slots
+        self.levels = levels
+        self._wheels = [[[] for _ in range(slots)] for _ in range(levels)]
+        self._overflow = []
+        self._due = []
+        self._current = None
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def has_due(self):
+        return bool(self._due)
+
+    def _tick_of(self, t):
+        return int(t // self.tick)
+
+    def schedule(self, item, deadline, now=None):
+        """ đặt item vào bánh xe, item được trả về bởi advance khi thời gian đã qua deadline """
+        if now is None:
+            now = time.time()
+        if self._current is None or self._count == 0:
+            self._current = self._tick_of(now)
+        self._count += 1
+        if deadline <= now:
+            self._due.append(item)
+            return
+        target = self._tick_of(deadline)
+        if deadline > target * self.tick:
+            target += 1
+        self._place(target, item)
+
+    def _place(self, target, item):
+        delta = target - self._current
+        if delta <= 0:
+            self._due.append(item)
+            return
+        span = self.slots
+        for level in range(self.levels):
+            if delta < span:
+                unit = span // self.slots
+                self._wheels[level][(target // unit) % self.slots].append((target, item))
+                return
+            span *= self.slots
+        self._overflow.append((target, item))
+
+    def advance(self, now):
+        """ quay bánh xe tới thời điểm now, trả về các item đã tới hạn """
+        due, self._due = self._due, []
+        if self._current is None:
+            return due
+        target = self._tick_of(now)
+        if self._count == len(due):
+            # không còn hẹn giờ nào đang chờ, nhảy thẳng tới now
+            self._current = max(self._current, target)
+        while self._current < target:
+            self._current += 1
+            self._cascade(self._current)
+            index = self._current % self.slots
+            bucket, self._wheels[0][index] = self._wheels[0][index], []
+            for item_target, item in bucket:
+                if item_target <= self._current:
+                    due.append(item)
+                else:
+                    self._place(item_target, item)
+        # item được dồn xuống đúng vào tick hiện tại
+        due.extend(self._due)
+        self._due = []
+        self._count -= len(due)
+        return due
+
+    def _cascade(self, current):
+        unit = 1
+        for level in range(1, self.levels):
+            unit *= self.slots
+            if current % unit:
+                return
+            index = (current // unit) % self.slots
+            bucket, self._wheels[level][index] = self._wheels[level][index], []
+            for item_target, item in bucket:
+                self._place(item_target, item)
+        if current % (unit * self.slots) == 0:
+            overflow, self._overflow = self._overflow, []
+            for item_target, item in overflow:
+                self._place(item_target, item)
+
+
+class ReapTimer(object):
+    """ một lần hẹn giờ của cache, hủy bằng cancel() """
+    __slots__ = ('ref', 'deadline', 'cancelled')
+
+    def __init__(self, cache, deadline):
+        self.ref = weakref.ref(cache)
+        self.deadline = deadline
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class ExpiryReaper(object):
+    """ Thread nền dùng chung, gọi cache.reap(batch) khi hẹn giờ của cache tới hạn """
+
+    def __init__(self, tick=REAPER_TICK_DEFAULT, batch=REAP_BATCH_DEFAULT):
+        self.batch = batch
+        self._wheel = TimerWheel(tick)
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def schedule(self, cache, deadline):
+        """
+        hẹn giờ gọi cache.reap tại deadline
+        :return: ReapTimer để hủy khi cache hẹn lại sớm hơn
+        """
+        timer = ReapTimer(cache, deadline)
+        with self._cond:
+            self._wheel.schedule(timer, deadline)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='cache-expiry-reaper')
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify()
+        return timer
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not len(self._wheel):
+                    self._cond.wait()
+                elif not self._wheel.has_due():
+                    self._cond.wait(self._wheel.tick)
+                due = self._wheel.advance(time.time())
+            for timer in due:
+                if timer.cancelled:
+                    continue
+                cache = timer.ref()
+                if cache is None:
+                    continue
+                try:
+                    cache.reap(self.batch)
+                except Exception as ex:
+                    print("ExpiryReaper: reap error: %s" % ex)
+                cache = None
+
+
+_reaper = None
+_reaper_lock = threading.Lock()
+
+
+def get_reaper():
+    """ ExpiryReaper dùng chung của tiến trình """
+    global _reaper
+    if _reaper is None:
+        with _reaper_lock:
+            if _reaper is None:
+                _reaper = ExpiryReaper()
+    return _reaper
@@ -0,0 +1,366 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*-
+""" SharedMemoryCacheDict: cache dùng chung cho mọi tiến trình (vd các worker gunicorn) trên cùng một máy.
+
+    Dữ liệu nằm trong một file được mmap (mặc định trong /dev/shm) gồm:
+        header | bộ đếm của từng stripe | bảng meta của các slot | vùng value
+    Bảng được chia thành các stripe độc lập, mỗi stripe có khóa riêng (threading.Lock trong tiến trình
+    và fcntl.lockf trên 1 byte của file giữa các tiến trình). Mỗi key chỉ có thể nằm trong một cửa sổ
+    PROBE_WINDOW slot liên tiếp của stripe, khi cửa sổ đầy thì key có thời điểm truy cập cũ nhất trong
+    cửa sổ bị loại (LRU xấp xỉ). Mỗi slot có kích thước cố định slot_size byte chứa key, tag và value
+    đã mã hóa bằng ValueCodec, value lớn hơn sẽ không được cache.
+
+    Meta của mỗi slot: trạng thái, độ dài key/tag/value, hash của key, bloom filter của tag,
+    thời điểm hết hạn và thời điểm truy cập gần nhất (time.time() dùng chung giữa các tiến trình).
+"""
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from src.libs.caching.stats import CacheStats
+from src.libs.caching.value_codec import get_codec
+
+SHARED_MAGIC = b'PTSM'
+SHARED_VERSION = 1
+SHARED_SLOT_SIZE_DEFAULT = 1024
+# 4096 slot x 1024 byte = 4MB mỗi cache
+SHARED_MAX_SIZE_DEFAULT = 4096
+SHARED_STRIPES_DEFAULT = 64
+SHARED_DIR_DEFAULT = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+PROBE_WINDOW = 8
+
+_HEADER = struct.Struct('<4sBxxxIII')
+_HEADER_SIZE = 64
+_STRIPE = struct.Struct('<I4x')
+# trạng thái, độ dài key, độ dài tag, độ dài value, hash key, bloom tag, hết hạn (0 là không), truy cập
+_META = struct.Struct('<BxHH2xIQQdd')
+_ACCESS_OFFSET = _META.size - 8
+_FREE = 0
+_USED = 1
+_TAG_SEPARATOR = '\x1f'
+
+
+def _hash_bytes(data):
+    return int.from_bytes(hashlib.md5(data).digest()[:8], 'little')
+
+
+def _tag_bloom(tags):
+    bloom = 0
+    for tag in tags or ():
+        h = _hash_bytes(tag.encode('utf-8'))
+        bloom |= (1 << (h & 63)) | (1 << ((h >> 6) & 63))
+    return bloom
+
+
+def _key_bytes(key):
+    if isinstance(key, bytes):
+        return key
+    if not isinstance(key, str):
+        key = repr(key)
+    return key.encode('utf-8')
+
+
+_stripe_locks = {}
+_stripe_locks_lock = threading.Lock()
+
+
+def _get_stripe_locks(path, stripes):
+    """ khóa fcntl không loại trừ nhau trong cùng tiến trình nên các đối tượng cùng file dùng chung threading.Lock """
+    with _stripe_locks_lock:
+        if path not in _stripe_locks:
+            _stripe_locks[path] = [threading.Lock() for _ in range(stripes)]
+        return _stripe_locks[path]
+
+
+class SharedMemoryCacheDict(object):
+    """ Cache dạng dict dùng chung giữa các tiến trình qua mmap.
+
+    >>> d = SharedMemoryCacheDict('doctest', max_size=64, expiration=60)
+    >>> d['foo'] = {'bar': 1}
+    >>> d['foo']
+    {'bar': 1}
+    >>> other = SharedMemoryCacheDict('doctest', max_size=64, expiration=60)
+    >>> other['foo']
+    {'bar': 1}
+    >>> other.close(); d.close(); os.remove(d.path)
+    """
+
+    def __init__(self, name, max_size=SHARED_MAX_SIZE_DEFAULT, expiration=None, slot_size=SHARED_SLOT_SIZE_DEFAULT,
+                 stripes=SHARED_STRIPES_DEFAULT, directory=SHARED_DIR_DEFAULT, codec=None):
+        """
+        :param name: tên của cache, các tiến trình dùng cùng name sẽ dùng chung dữ liệu
+        :param max_size: số slot, được làm tròn lên bội số của stripes, file có kích thước khoảng
+            max_size * slot_size byte
+        :param slot_size: số byte tối đa của key + tag + value đã mã hóa
+        """
+        self.name = name
+        self.expiration = expiration
+        self.slot_size = slot_size
+        self.stripes = max(1, min(stripes, max_size))
+        self.slots_per_stripe = max(PROBE_WINDOW, -(-max_size // self.stripes))
+        self.max_size = self.slots_per_stripe * self.stripes
+        self.codec = get_codec(codec)
+        self.concurrent = True
+        self.path = os.path.join(directory, 'pytemp_%s.cache' % name)
+        self.stats = CacheStats()
+        self._meta_offset = _HEADER_SIZE + _STRIPE.size * self.stripes
+        self._block_offset = self._meta_offset + _META.size * self.max_size
+        self._file_size = self._block_offset + slot_size * self.max_size
+        self._locks = _get_stripe_locks(self.path, self.stripes)
+        self._sweep_stripe = 0
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            self._init_file()
+            self._mmap = mmap.mmap(self._fd, self._file_size, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+        except Exception:
+            os.close(self._fd)
+            raise
+
+    def _init_file(self):
+        """ tiến trình đầu tiên tạo file, các tiến trình sau kiểm tra cấu hình có khớp không """
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, 0)
+        try:
+            header = os.pread(self._fd, _HEADER.size, 0)
+            if len(header) == _HEADER.size and header[:4] == SHARED_MAGIC:
+                magic, version, stripes, slots_per_stripe, slot_size = _HEADER.unpack(header)
+                if (version, stripes, slots_per_stripe, slot_size) != \
+                        (SHARED_VERSION, self.stripes, self.slots_per_stripe, self.slot_size):
+                    raise ValueError('shared cache %s was created with another configuration' % self.path)
+                return
+            os.ftruncate(self._fd, 0)
+            os.ftruncate(self._fd, self._file_size)
+            os.lseek(self._fd, 0, os.SEEK_SET)
+            os.write(self._fd, _HEADER.pack(SHARED_MAGIC, SHARED_VERSION, self.stripes, self.slots_per_stripe,
+                                            self.slot_size))
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, 0)
+
+    @contextmanager
+    def _stripe_lock(self, stripe):
+        with self._locks[stripe]:
+            offset = _HEADER_SIZE + _STRIPE.size * stripe
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, offset)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, offset)
+
+    def _locate(self, h):
+        """ stripe và danh sách slot trong cửa sổ của hash h """
+        stripe = h % self.stripes
+        base = stripe * self.slots_per_stripe
+        home = (h // self.stripes) % self.slots_per_stripe
+        return stripe, [base + (home + i) % self.slots_per_stripe for i in range(PROBE_WINDOW)]
+
+    def _meta(self, slot):
+        return _META.unpack_from(self._mmap, self._meta_offset + _META.size * slot)
+
+    def _block(self, slot):
+        return self._block_offset + self.slot_size * slot
+
+    def _add_count(self, stripe, delta):
+        offset = _HEADER_SIZE + _STRIPE.size * stripe
+        _STRIPE.pack_into(self._mmap, offset, _STRIPE.unpack_from(self._mmap, offset)[0] + delta)
+
+    def _free(self, stripe, slot):
+        _META.pack_into(self._mmap, self._meta_offset + _META.size * slot, _FREE, 0, 0, 0, 0, 0, 0.0, 0.0)
+        self._add_count(stripe, -1)
+
+    def _find(self, slot_list, h, kb):
+        for slot in slot_list:
+            meta = self._meta(slot)
+            if meta[0] == _USED and meta[4] == h and meta[1] == len(kb):
+                block = self._block(slot)
+                if self._mmap[block:block + meta[1]] == kb:
+                    return slot, meta
+        return None, None
+
+    @staticmethod
+    def _is_expired(meta, t):
+        return meta[6] != 0 and meta[6] <= t
+
+    def size(self):
+        return sum(_STRIPE.unpack_from(self._mmap, _HEADER_SIZE + _STRIPE.size * stripe)[0]
+                   for stripe in range(self.stripes))
+
+    def __len__(self):
+        return self.size()
+
+    def get_stats(self):
+        result = self.stats.as_dict()
+        result['size'] = self.size()
+        result['bytes'] = self._file_size
+        return result
+
+    def clear(self):
+        """ xóa dữ liệu của mọi tiến trình """
+        empty = bytes(_META.size * self.slots_per_stripe)
+        for stripe in range(self.stripes):
+            with self._stripe_lock(stripe):
+                start = self._meta_offset + _META.size * self.slots_per_stripe * stripe
+                self._mmap[start:start + len(empty)] = empty
+                _STRIPE.pack_into(self._mmap, _HEADER_SIZE + _STRIPE.size * stripe, 0)
+
+    def __contains__(self, key):
+        return self.has_key(key)
+
+    def has_key(self, key):
+        kb = _key_bytes(key)
+        h = _hash_bytes(kb)
+        stripe, slot_list = self._locate(h)
+        with self._stripe_lock(stripe):
+            slot, meta = self._find(slot_list, h, kb)
+            return slot is not None and not self._is_expired(meta, time.time())
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def set(self, key, value, expiration=None, tags=None):
+        """
+        lưu value, value (sau khi mã hóa) lớn hơn slot_size sẽ không được lưu
+        :param tags: danh sách tag gắn với key, dùng cho invalidate_tag
+        """
+        kb = _key_bytes(key)
+        tb = _TAG_SEPARATOR.join(tags).encode('utf-8') if tags else b''
+        data = self.codec.encode(value)
+        if len(kb) + len(tb) + len(data) > self.slot_size:
+            # vẫn xóa value cũ để không đọc lại dữ liệu đã lỗi thời
+            self.__delete__(key)
+            return
+        if expiration is None:
+            expiration = self.expiration
+        t = time.time()
+        expire_at = 0.0 if expiration is None else t + expiration
+        h = _hash_bytes(kb)
+        stripe, slot_list = self._locate(h)
+        with self._stripe_lock(stripe):
+            slot, meta = self._find(slot_list, h, kb)
+            if slot is None:
+                slot = self._choose_slot(stripe, slot_list, t)
+            block = self._block(slot)
+            self._mmap[block:block + len(kb)] = kb
+            self._mmap[block + len(kb):block + len(kb) + len(tb)] = tb
+            self._mmap[block + len(kb) + len(tb):block + len(kb) + len(tb) + len(data)] = data
+            _META.pack_into(self._mmap, self._meta_offset + _META.size * slot, _USED, len(kb), len(tb), len(data), h,
+                            _tag_bloom(tags), expire_at, t)
+
+    def _choose_slot(self, stripe, slot_list, t):
+        """ chọn slot trống hoặc đã hết hạn, nếu không có thì loại slot ít được truy cập nhất trong cửa sổ """
+        victim = None
+        victim_access = None
+        for slot in slot_list:
+            meta = self._meta(slot)
+            if meta[0] == _FREE:
+                self._add_count(stripe, 1)
+                return slot
+            if self._is_expired(meta, t):
+                self.stats.expirations += 1
+                return slot
+            if victim is None or meta[7] < victim_access:
+                victim, victim_access = slot, meta[7]
+        self.stats.evictions += 1
+        return victim
+
+    def __getitem__(self, key):
+        kb = _key_bytes(key)
+        h = _hash_bytes(kb)
+        stripe, slot_list = self._locate(h)
+        t = time.time()
+        with self._stripe_lock(stripe):
+            slot, meta = self._find(slot_list, h, kb)
+            if slot is None:
+                data = None
+            elif self._is_expired(meta, t):
+                self._free(stripe, slot)
+                self.stats.expirations += 1
+                data = None
+            else:
+                struct.pack_into('<d', self._mmap, self._meta_offset + _META.size * slot + _ACCESS_OFFSET, t)
+                start = self._block(slot) + meta[1] + meta[2]
+                data = self._mmap[start:start + meta[3]]
+        if data is None:
+            self.stats.misses += 1
+            raise KeyError(key)
+        try:
+            value = self.codec.decode(data)
+        except ValueError:
+            self.stats.misses += 1
+            raise KeyError(key)
+        self.stats.hits += 1
+        return value
+
+    def get_many(self, keys):
+        result = {}
+        for key in keys:
+            try:
+                result[key] = self[key]
+            except KeyError:
+                pass
+        return result
+
+    def set_many(self, mapping):
+        for key, value in mapping.items():
+            self.set(key, value)
+
+    def __delete__(self, key):
+        kb = _key_bytes(key)
+        h = _hash_bytes(kb)
+        stripe, slot_list = self._locate(h)
+        with self._stripe_lock(stripe):
+            slot, _ = self._find(slot_list, h, kb)
+            if slot is not None:
+                self._free(stripe, slot)
+                return True
+        return None
+
+    def __delitem__(self, key):
+        if self.__delete__(key) is None:
+            raise KeyError(key)
+
+    def invalidate_tag(self, tag):
+        """
+        xóa mọi key mang tag. Tag không có chỉ mục dùng chung nên phải duyệt meta của mọi slot,
+        bloom filter trong meta giúp chỉ phải đọc tag của các slot có khả năng mang tag
+        :return: số key đã xóa
+        """
+        bloom = _tag_bloom([tag])
+        tb = tag.encode('utf-8')
+        count = 0
+        for stripe in range(self.stripes):
+            base = stripe * self.slots_per_stripe
+            with self._stripe_lock(stripe):
+                for slot in range(base, base + self.slots_per_stripe):
+                    meta = self._meta(slot)
+                    if meta[0] != _USED or meta[5] & bloom != bloom:
+                        continue
+                    start = self._block(slot) + meta[1]
+                    if tb in self._mmap[start:start + meta[2]].split(_TAG_SEPARATOR.encode('utf-8')):
+                        self._free(stripe, slot)
+                        count += 1
+        return count
+
+    def cleanup(self):
+        """ giải phóng slot hết hạn của một stripe mỗi lần gọi (lần lượt từng stripe) """
+        stripe = self._sweep_stripe
+        self._sweep_stripe = (stripe + 1) % self.stripes
+        base = stripe * self.slots_per_stripe
+        t = time.time()
+        with self._stripe_lock(stripe):
+            for slot in range(base, base + self.slots_per_stripe):
+                meta = self._meta(slot)
+                if meta[0] == _USED and self._is_expired(meta, t):
+                    self._free(stripe, slot)
+                    self.stats.expirations += 1
+        return None
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+            os.close(self._fd)
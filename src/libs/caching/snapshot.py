@@ -0,0 +1,277 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*-
+""" Snapshot của LRUCacheDict ra file để worker khởi động lại vẫn có sẵn dữ liệu (warm start).
+
+    Định dạng file (little endian):
+        header: magic 'PTCS', version (1 byte), thời điểm ghi (double), số bản ghi (uint32)
+        mỗi bản ghi: độ dài meta (uint32), độ dài value (uint32), số giây còn sống (double, -1 là
+        không hết hạn), meta = [key, tags] và value đều được mã hóa bằng ValueCodec.
+
+    File được đọc bằng mmap, khi mở chỉ giải mã phần meta để dựng chỉ mục key -> vị trí, value chỉ
+    được giải mã khi key được truy cập lần đầu (nạp lười). Thời gian sống còn lại được tính từ thời
+    điểm ghi nên key đã hết hạn trong lúc worker tắt sẽ bị bỏ qua.
+
+    Khi nhiều worker dùng chung một file snapshot, chỉ worker giữ được khóa fcntl trên file
+    <path>.lock mới ghi, các worker khác chỉ nạp. Worker ghi thoát thì worker khác nhận khóa ở
+    lần ghi định kỳ tiếp theo.
+"""
+import atexit
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import time
+import weakref
+
+from src.libs.caching.value_codec import CODEC, get_codec
+
+SNAPSHOT_MAGIC = b'PTCS'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_INTERVAL_DEFAULT = 300
+
+_HEADER = struct.Struct('<4sBdI')
+_RECORD = struct.Struct('<IId')
+
+
+class SnapshotReader(object):
+    """ Đọc snapshot bằng mmap, value được giải mã khi lấy ra bằng pop """
+
+    def __init__(self, path, codec=CODEC.MARSHAL):
+        """
+        :param codec: codec đã dùng để ghi snapshot, bản ghi mã hóa bằng codec khác bị bỏ qua
+        """
+        self.path = path
+        self.codec = get_codec(codec)
+        self._file = open(path, 'rb')
+        try:
+            if os.fstat(self._file.fileno()).st_size < _HEADER.size:
+                raise ValueError('snapshot %s is truncated' % path)
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._index = {}
+            self._tags = {}
+            self._read_index()
+        except Exception:
+            self.close()
+            raise
+
+    def _read_index(self):
+        magic, version, written_at, count = _HEADER.unpack_from(self._mmap, 0)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise ValueError('%s is not a cache snapshot' % self.path)
+        now = time.time()
+        offset = _HEADER.size
+        try:
+            for _ in range(count):
+                meta_len, value_len, ttl = _RECORD.unpack_from(self._mmap, offset)
+                offset += _RECORD.size
+                meta = self._mmap[offset:offset + meta_len]
+                offset += meta_len
+                expire_at = None if ttl < 0 else written_at + ttl
+                if expire_at is None or expire_at > now:
+                    try:
+                        key, tags = self.codec.decode(meta)
+                        self._add(key, offset, value_len, expire_at, tags)
+                    except (ValueError, TypeError):
+                        pass
+                offset += value_len
+        except struct.error:
+            raise ValueError('snapshot %s is truncated' % self.path)
+
+    def _add(self, key, offset, length, expire_at, tags):
+        tags = tuple(tags) if tags else None
+        self._index[key] = (offset, length, expire_at, tags)
+        if tags:
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def pop(self, key):
+        """
+        lấy ra và giải mã value của key
+        :return: (value, thời điểm hết hạn hoặc None, tags)
+        :raise KeyError: nếu không có key hoặc value không giải mã được
+        """
+        offset, length, expire_at, tags = self._index.pop(key)
+        self._forget_tags(key, tags)
+        try:
+            value = self.codec.decode(self._mmap[offset:offset + length])
+        except ValueError:
+            raise KeyError(key)
+        return value, expire_at, tags
+
+    def discard(self, key):
+        item = self._index.pop(key, None)
+        if item is not None:
+            self._forget_tags(key, item[3])
+
+    def pop_tag(self, tag):
+        """ bỏ các key mang tag, trả về danh sách key """
+        keys = list(self._tags.pop(tag, ()))
+        for key in keys:
+            self.discard(key)
+        return keys
+
+    def _forget_tags(self, key, tags):
+        if tags:
+            for tag in tags:
+                keys = self._tags.get(tag)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del self._tags[tag]
+
+    def raw_items(self):
+        """ các bản ghi chưa được nạp: (key, value đã mã hóa, thời điểm hết hạn, tags) """
+        return [(key, self._mmap[offset:offset + length], expire_at, tags)
+                for key, (offset, length, expire_at, tags) in self._index.items()]
+
+    def close(self):
+        self._index = {}
+        self._tags = {}
+        if getattr(self, '_mmap', None) is not None:
+            self._mmap.close()
+            self._mmap = None
+        self._file.close()
+
+
+def write_snapshot(cache, path, codec=CODEC.MARSHAL):
+    """
+    ghi snapshot của cache ra file, file được ghi vào file tạm rồi đổi tên nên không bao giờ bị ghi dở
+    :param cache: LRUCacheDict
+    :param codec: codec dùng để mã hóa key và value, value không mã hóa được sẽ bị bỏ qua
+    :return: số bản ghi đã ghi
+    """
+    codec = get_codec(codec)
+    now = time.time()
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    count = 0
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, now, 0))
+            for key, value, expire_at, tags, encoded in cache.snapshot_items():
+                if expire_at is not None and expire_at <= now:
+                    continue
+                try:
+                    meta = codec.encode([key, list(tags) if tags else None])
+                    data = value if encoded else codec.encode(value)
+                except (TypeError, ValueError) as ex:
+                    print("write_snapshot: skip key %s: %s" % (key, ex))
+                    continue
+                ttl = -1.0 if expire_at is None else expire_at - now
+                f.write(_RECORD.pack(len(meta), len(data), ttl))
+                f.write(meta)
+                f.write(data)
+                count += 1
+            f.seek(0)
+            f.write(_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, now, count))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return count
+
+
+class CacheSnapshot(object):
+    """ Quản lý snapshot của một LRUCacheDict: nạp lười khi khởi động, ghi định kỳ và khi tiến trình kết thúc.
+
+    # >>> cache = LRUCacheDict(max_size=1024, expiration=3600)
+    # >>> snapshot = CacheSnapshot(cache, '/tmp/intent.snapshot', interval=300).start()
+    """
+
+    def __init__(self, cache, path, interval=SNAPSHOT_INTERVAL_DEFAULT, codec=CODEC.MARSHAL):
+        """
+        :param cache: LRUCacheDict, được chuyển sang concurrent vì snapshot được ghi từ thread riêng
+        """
+        cache.enable_concurrent()
+        self.cache = cache
+        self.path = path
+        self.interval = interval
+        self.codec = codec
+        self._lock = threading.Lock()
+        # fd của file khóa khi tiến trình này là tiến trình ghi snapshot
+        self._writer_fd = None
+
+    def load(self):
+        """ gắn snapshot đã có vào cache, trả về số key có thể nạp """
+        if not os.path.exists(self.path):
+            return 0
+        try:
+            reader = SnapshotReader(self.path, self.codec)
+        except (OSError, ValueError) as ex:
+            print("CacheSnapshot: can not load %s: %s" % (self.path, ex))
+            return 0
+        self.cache.attach_snapshot(reader)
+        return len(reader)
+
+    def _acquire_writer(self):
+        """ giữ khóa ghi snapshot, khóa được giải phóng khi tiến trình kết thúc """
+        if self._writer_fd is not None:
+            return True
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        fd = os.open(self.path + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        self._writer_fd = fd
+        return True
+
+    def save(self):
+        """ ghi snapshot nếu tiến trình này là tiến trình ghi, trả về số key đã ghi """
+        with self._lock:
+            try:
+                if not self._acquire_writer():
+                    return 0
+                return write_snapshot(self.cache, self.path, self.codec)
+            except (OSError, ValueError) as ex:
+                print("CacheSnapshot: can not save %s: %s" % (self.path, ex))
+                return 0
+
+    def start(self):
+        self.load()
+        if self.interval:
+            self.SnapshotThread(self).start()
+        ref = weakref.ref(self)
+        atexit.register(_save_at_exit, ref)
+        return self
+
+    class SnapshotThread(threading.Thread):
+        daemon = True
+
+        def __init__(self, snapshot):
+            self.ref = weakref.ref(snapshot)
+            self.interval = snapshot.interval
+            super(CacheSnapshot.SnapshotThread, self).__init__()
+
+        def run(self):
+            while True:
+                time.sleep(self.interval)
+                snapshot = self.ref()
+                if snapshot is None:
+                    return
+                try:
+                    snapshot.save()
+                except Exception as ex:
+                    print("CacheSnapshot: can not save %s: %r" % (snapshot.path, ex))
+                snapshot = None
+
+
+def _save_at_exit(ref):
+    snapshot = ref()
+    if snapshot is not None:
+        snapshot.save()
@@ -0,0 +1,142 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*-
+""" Thống kê cho các kho cache: số lần hit/miss/evict/expire và biểu đồ phân bố độ trễ.
+
+    Bộ đếm là các số nguyên tăng trực tiếp không dùng khóa để chi phí đủ rẻ khi bật ở production,
+    khi nhiều thread cùng tăng có thể lệch một vài đơn vị. Kết quả được xuất ra dạng text
+    theo định dạng của Prometheus bằng hàm render_metrics.
+"""
+from bisect import bisect_left
+
+LATENCY_BUCKETS_DEFAULT = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                           1.0, 2.5)
+
+
+class CacheStats(object):
+    """ bộ đếm của một kho cache hoặc một prefix_key """
+    __slots__ = ('hits', 'misses', 'evictions', 'expirations')
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def reset(self):
+        self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def merge(self, other):
+        self.hits += other.hits
+        self.misses += other.misses
+        self.evictions += other.evictions
+        self.expirations += other.expirations
+        return self
+
+    def hit_ratio(self):
+        total = self.hits + self.misses
+        return float(self.hits) / total if total else 0.0
+
+    def as_dict(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'hit_ratio': self.hit_ratio()
+        }
+
+
+class LatencyHistogram(object):
+    """ Biểu đồ phân bố độ trễ (giây) theo các bucket cố định.
+
+    >>> h = LatencyHistogram((0.001, 0.01))
+    >>> for seconds in (0.0005, 0.002, 0.003, 0.5):
+    ...     h.observe(seconds)
+    >>> h.count, h.quantile(0.5), h.quantile(0.99)
+    (4, 0.01, inf)
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS_DEFAULT):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(self.buckets, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def reset(self):
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def merge(self, other):
+        for i, n in enumerate(other.counts):
+            self.counts[i] += n
+        self.sum += other.sum
+        self.count += other.count
+        return self
+
+    def quantile(self, q):
+        """ ước lượng phân vị q bằng cận trên của bucket chứa nó """
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n:
+                return self.buckets[i] if i < len(self.buckets) else float('inf')
+        return float('inf')
+
+    def cumulative(self):
+        """ danh sách (cận trên, số lần đo <= cận trên), bucket cuối là +Inf """
+        result = []
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            result.append((self.buckets[i] if i < len(self.buckets) else float('inf'), seen))
+        return result
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'p50': self.quantile(0.5),
+            'p99': self.quantile(0.99)
+        }
+
+
+def _labels(labels):
+    return ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels)
+
+
+def _format_le(bound):
+    return '+Inf' if bound == float('inf') else repr(bound)
+
+
+def render_metrics(samples, prefix='pytemp_cache'):
+    """
+    chuyển các số liệu sang dạng text của Prometheus
+    :param samples: danh sách (tên metric, kiểu, labels dạng list các cặp (key, value), giá trị),
+        giá trị của kiểu 'histogram' là một LatencyHistogram
+    :return: chuỗi text
+    """
+    lines = []
+    declared = set()
+    # các dòng của cùng một metric phải nằm liền nhau
+    for name, kind, labels, value in sorted(samples, key=lambda sample: sample[0]):
+        metric = '%s_%s' % (prefix, name)
+        if metric not in declared:
+            declared.add(metric)
+            lines.append('# TYPE %s %s' % (metric, kind))
+        if kind == 'histogram':
+            for bound, seen in value.cumulative():
+                lines.append('%s_bucket{%s} %d' % (metric, _labels(list(labels) + [('le', _format_le(bound))]), seen))
+            lines.append('%s_sum{%s} %r' % (metric, _labels(labels), value.sum))
+            lines.append('%s_count{%s} %d' % (metric, _labels(labels), value.count))
+        else:
+            lines.append('%s{%s} %r' % (metric, _labels(labels), value))
+    return '\n'.join(lines) + '\n'
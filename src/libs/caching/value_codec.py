@@ -0,0 +1,124 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*-
+""" ValueCodec mã hóa value trước khi lưu vào các kho cache dạng byte (Redis, shared memory).
+    Mỗi value được ghi kèm một byte header cho biết codec đã dùng và có nén hay không, vì vậy
+    có thể đổi codec mà không phải xóa cache: value cũ vẫn được đọc bằng đúng codec đã ghi nó.
+    Value cũ không có header (json thuần) vẫn được đọc như json.
+    Vì marshal và pickle không an toàn với dữ liệu không tin cậy (Redis dùng chung, file trên đĩa),
+    chỉ value có header json, codec đang cấu hình hoặc các codec trong allow mới được giải mã.
+"""
+import json
+import marshal
+import pickle
+import zlib
+
+
+class CODEC:
+    JSON = 'json'
+    # định dạng nhị phân gọn của python, giữ được tuple, bytes, set nhưng phụ thuộc phiên bản python
+    MARSHAL = 'marshal'
+    # chỉ dùng cho dữ liệu nội bộ tin cậy, pickle có thể thực thi mã khi decode
+    PICKLE = 'pickle'
+
+
+_CODEC_IDS = {
+    CODEC.JSON: 0x01,
+    CODEC.MARSHAL: 0x02,
+    CODEC.PICKLE: 0x03,
+}
+_CODEC_NAMES = {codec_id: name for name, codec_id in _CODEC_IDS.items()}
+_COMPRESSED_FLAG = 0x80
+
+COMPRESS_THRESHOLD_DEFAULT = 1024
+COMPRESS_LEVEL_DEFAULT = 1
+
+
+def _dumps(codec, value):
+    if codec == CODEC.JSON:
+        return json.dumps(value, ensure_ascii=False).encode('utf-8')
+    elif codec == CODEC.MARSHAL:
+        return marshal.dumps(value)
+    return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+
+def _loads(codec, payload):
+    if codec == CODEC.JSON:
+        return json.loads(payload.decode('utf-8'))
+    elif codec == CODEC.MARSHAL:
+        return marshal.loads(payload)
+    return pickle.loads(payload)
+
+
+class ValueCodec:
+    """ Mã hóa/giải mã value kèm header 1 byte, nén zlib khi value lớn hơn compress_threshold byte.
+
+    >>> codec = ValueCodec(CODEC.MARSHAL, compress_threshold=16)
+    >>> codec.decode(codec.encode(('a', b'b', 1)))
+    ('a', b'b', 1)
+    >>> data = ValueCodec(CODEC.JSON, compress_threshold=16).encode({'x': 'y' * 100})
+    >>> ValueCodec(CODEC.MARSHAL).decode(data) == {'x': 'y' * 100}
+    True
+    >>> ValueCodec(CODEC.JSON).decode(ValueCodec(CODEC.PICKLE).encode(1))
+    Traceback (most recent call last):
+    ...
+    ValueError: codec pickle is not allowed
+    """
+
+    def __init__(self, codec=CODEC.JSON, compress_threshold=COMPRESS_THRESHOLD_DEFAULT,
+                 compress_level=COMPRESS_LEVEL_DEFAULT, allow=None):
+        """
+        :param allow: các codec khác được phép giải mã ngoài json và codec, vd codec cũ khi đổi codec
+            của một cache tin cậy
+        """
+        if codec not in _CODEC_IDS:
+            raise NotImplementedError('codec=%s' % codec)
+        for name in allow or ():
+            if name not in _CODEC_IDS:
+                raise NotImplementedError('codec=%s' % name)
+        self.codec = codec
+        self.allowed = {CODEC.JSON, codec}.union(allow or ())
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+
+    def encode(self, value):
+        payload = _dumps(self.codec, value)
+        header = _CODEC_IDS[self.codec]
+        if self.compress_threshold is not None and len(payload) > self.compress_threshold:
+            compressed = zlib.compress(payload, self.compress_level)
+            if len(compressed) < len(payload):
+                payload = compressed
+                header |= _COMPRESSED_FLAG
+        return bytes((header,)) + payload
+
+    def decode(self, data):
+        """
+        giải mã value theo header, header của codec không được phép thì bị từ chối
+        :raise ValueError: nếu dữ liệu hỏng, codec không được phép hoặc không giải mã được
+        """
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        if not data:
+            raise ValueError('empty value')
+        header = data[0]
+        codec = _CODEC_NAMES.get(header & ~_COMPRESSED_FLAG)
+        if codec is None:
+            # value cũ được lưu bằng json.dumps không có header
+            return json.loads(data.decode('utf-8'))
+        if codec not in self.allowed:
+            raise ValueError('codec %s is not allowed' % codec)
+        payload = data[1:]
+        try:
+            if header & _COMPRESSED_FLAG:
+                payload = zlib.decompress(payload)
+            return _loads(codec, payload)
+        except Exception as ex:
+            raise ValueError('can not decode value with codec %s: %s' % (codec, ex))
+
+
+def get_codec(codec):
+    """ chấp nhận tên codec hoặc một ValueCodec đã tạo sẵn """
+    if codec is None:
+        return ValueCodec()
+    if isinstance(codec, ValueCodec):
+        return codec
+    return ValueCodec(codec)
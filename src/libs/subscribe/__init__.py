@@ -16,7 +16,7 @@ from abc import abstractmethod
 from functools import wraps
 
 from src.libs.singleton import Singleton
-from src.libs.thread_pool import ThreadPool
+from src.libs.thread_pool import PRIORITY, ThreadPool
 
 
 def subscribe(label=None, entity_id_index=0):
@@ -128,7 +128,7 @@ class BasePerformer(object):
 
 @Singleton
 class SubscribeAssigner:
-    thread_pool = ThreadPool(num_workers=8)
+    thread_pool = ThreadPool(min_workers=2, max_workers=32)
 
     def __init__(self):
         self.performers = {}
@@ -151,7 +151,9 @@ class SubscribeAssigner:
             if data['label'] in p.get_capacities():
                 self._owner_run(data, p)
 
-    @thread_pool.thread
+    # chia lượt theo label để một label có quá nhiều thông báo không làm chậm các label khác,
+    # thông báo subscribe được xếp sau các nhiệm vụ có ưu tiên cao hơn
+    @thread_pool.thread(label=lambda args, kwargs: args[1]['label'], priority=PRIORITY.LOW)
     def _owner_run(self, item, p):
         p.do(item)
 
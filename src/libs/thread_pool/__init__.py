@@ -6,26 +6,206 @@
     Date created: 2017/12/22
 """
 import datetime
-import hashlib
 # import sys
 
 # import traceback
+from collections import deque
 from functools import wraps
 
-from queue import Queue
+from queue import Queue, Empty, Full
 
-from threading import Thread
+from threading import Thread, Lock, Event
 import logging
 
 import sys
+import time
+
+from src.libs.thread_pool.fair_queue import AGING_DEFAULT, PRIORITY, FairQueue
+from src.libs.thread_pool.spill_queue import SpillQueue
+
+# số Future đã xong được giữ lại cho wait_all_tasks_done, các Future cũ hơn bị bỏ
+RESULTS_MAX_DEFAULT = 100
+# số nhiệm vụ tối đa chờ trong hàng đợi, không phụ thuộc số worker
+QUEUE_SIZE_DEFAULT = 1024
+# chế độ co giãn: số giây worker rảnh trước khi bị thu hồi (khi còn nhiều hơn min_workers)
+KEEP_ALIVE_DEFAULT = 60
+# chế độ co giãn: thêm worker khi không còn worker rảnh và nhiệm vụ phải chờ quá số giây này
+# hoặc số nhiệm vụ chờ trong hàng đợi đạt tới SCALE_DEPTH_DEFAULT
+SCALE_WAIT_DEFAULT = 0.1
+SCALE_DEPTH_DEFAULT = 1
+
+
+class OVERFLOW_POLICY:
+    """ cách xử lý khi thêm nhiệm vụ lúc hàng đợi đã đầy """
+    # chờ tới khi có chỗ, tối đa block_timeout giây (None là chờ mãi) rồi raise TaskRejectedError
+    BLOCK = 'block'
+    # raise TaskRejectedError ngay
+    REJECT = 'reject'
+    # bỏ nhiệm vụ cũ nhất trong hàng đợi (Future của nó nhận TaskRejectedError) để nhận nhiệm vụ mới
+    DROP_OLDEST = 'drop_oldest'
+    # chạy nhiệm vụ ngay trong thread gọi add_task
+    CALLER_RUNS = 'caller_runs'
+    # ghi nhiệm vụ ra file tạm trên đĩa, nhiệm vụ phải pickle được
+    SPILL = 'spill'
+
+
+class TaskRejectedError(Exception):
+    """ nhiệm vụ không được nhận hoặc bị bỏ khi hàng đợi của ThreadPool đầy """
+    pass
+
+
+class Future:
+    """ Kết quả của một nhiệm vụ trong ThreadPool, dùng chung một khóa cho mọi Future nên tạo ra rất rẻ
+
+    >>> future = Future()
+    >>> future.add_done_callback(lambda f: print('done %r' % f.result()))
+    >>> future.done()
+    False
+    >>> future.set_result(3)
+    done 3
+    >>> future.result(timeout=0)
+    3
+    """
+    __slots__ = ('_state', '_result', '_exception', '_callbacks', '_waiters')
+    _PENDING = 0
+    _FINISHED = 1
+    _lock = Lock()
+
+    def __init__(self):
+        self._state = self._PENDING
+        self._result = None
+        self._exception = None
+        self._callbacks = None
+        self._waiters = None
+
+    def done(self):
+        return self._state == self._FINISHED
+
+    def result(self, timeout=None):
+        """
+        chờ nhiệm vụ hoàn thành và trả về kết quả
+        :param timeout: số giây chờ tối đa, None là chờ mãi
+        :raise TimeoutError: nếu quá timeout mà nhiệm vụ chưa xong
+        :raise Exception: exception của nhiệm vụ nếu nhiệm vụ bị lỗi
+        """
+        self._wait(timeout)
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        """ chờ nhiệm vụ hoàn thành và trả về exception của nhiệm vụ, None nếu không lỗi """
+        self._wait(timeout)
+        return self._exception
+
+    def _wait(self, timeout):
+        if self._state == self._FINISHED:
+            return
+        with self._lock:
+            if self._state == self._FINISHED:
+                return
+            event = Event()
+            if self._waiters is None:
+                self._waiters = []
+            self._waiters.append(event)
+        if not event.wait(timeout):
+            raise TimeoutError('task is not done after %ss' % timeout)
+
+    def add_done_callback(self, fn):
+        """ gọi fn(future) khi nhiệm vụ hoàn thành, gọi ngay nếu đã hoàn thành """
+        with self._lock:
+            if self._state != self._FINISHED:
+                if self._callbacks is None:
+                    self._callbacks = []
+                self._callbacks.append(fn)
+                return
+        self._invoke(fn)
+
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._finish()
+
+    def _finish(self):
+        with self._lock:
+            self._state = self._FINISHED
+            waiters, self._waiters = self._waiters, None
+            callbacks, self._callbacks = self._callbacks, None
+        for event in waiters or ():
+            event.set()
+        for fn in callbacks or ():
+            self._invoke(fn)
+
+    def _invoke(self, fn):
+        try:
+            fn(self)
+        except Exception as ex:
+            print("Future: callback %r error: %s" % (fn, ex))
+
+
+def as_completed(futures, timeout=None):
+    """
+    trả về lần lượt các Future theo thứ tự hoàn thành
+    :param timeout: tổng số giây chờ tối đa, None là chờ mãi
+    :raise TimeoutError: nếu quá timeout mà còn Future chưa xong
+    """
+    futures = list(futures)
+    finished = Queue()
+    for future in futures:
+        future.add_done_callback(finished.put)
+    deadline = None if timeout is None else time.time() + timeout
+    for i in range(len(futures)):
+        try:
+            remain = None if deadline is None else max(0, deadline - time.time())
+            yield finished.get(timeout=remain)
+        except Empty:
+            raise TimeoutError('%d tasks are not done after %ss' % (len(futures) - i, timeout))
 
 
 class ThreadPool:
-    """ Pool của Thread tiêu thụ nhiệm vụ từ một hàng đợi """
-
-    def __init__(self, num_workers, logger=None):
-        self._tasks = Queue(num_workers)
-        self._results = {}
+    """ Pool của Thread tiêu thụ nhiệm vụ từ một hàng đợi
+
+    Mặc định số worker cố định bằng num_workers. Khi max_workers lớn hơn min_workers (hoặc num_workers),
+    pool chạy ở chế độ co giãn: bắt đầu với min_workers worker, thêm worker (tối đa max_workers) khi không
+    còn worker rảnh mà nhiệm vụ phải chờ quá scale_wait giây hoặc hàng đợi có từ scale_depth nhiệm vụ,
+    worker rảnh quá keep_alive giây sẽ tự kết thúc cho tới khi còn min_workers worker.
+
+    Mỗi nhiệm vụ có mức ưu tiên (PRIORITY) và nhãn (mặc định là tên hàm), nhiệm vụ ưu tiên cao được chạy
+    trước (mức thấp vẫn được chạy sau aging lượt bị bỏ qua), các nhãn cùng mức ưu tiên được chia lượt
+    theo weights nên một nguồn đẩy nhiều nhiệm vụ không chiếm hết pool (xem FairQueue).
+    """
+
+    def __init__(self, num_workers=None, logger=None, max_results=RESULTS_MAX_DEFAULT, queue_size=QUEUE_SIZE_DEFAULT,
+                 overflow=OVERFLOW_POLICY.BLOCK, block_timeout=None, spill_dir=None,
+                 min_workers=None, max_workers=None, keep_alive=KEEP_ALIVE_DEFAULT,
+                 scale_wait=SCALE_WAIT_DEFAULT, scale_depth=SCALE_DEPTH_DEFAULT, weights=None,
+                 aging=AGING_DEFAULT):
+        """
+        :param num_workers: số worker cố định, là min_workers nếu không truyền min_workers
+        :param max_workers: số worker tối đa ở chế độ co giãn, None là không co giãn
+        :param keep_alive: số giây worker rảnh trước khi bị thu hồi ở chế độ co giãn
+        :param scale_wait: số giây chờ của nhiệm vụ để thêm worker ở chế độ co giãn
+        :param scale_depth: số nhiệm vụ chờ trong hàng đợi để thêm worker ở chế độ co giãn
+        :param max_results: số Future đã xong tối đa được giữ lại cho wait_all_tasks_done
+        :param queue_size: số nhiệm vụ tối đa chờ trong hàng đợi
+        :param overflow: chính sách khi hàng đợi đầy, một giá trị của OVERFLOW_POLICY
+        :param block_timeout: số giây chờ tối đa với OVERFLOW_POLICY.BLOCK
+        :param spill_dir: thư mục chứa file tạm với OVERFLOW_POLICY.SPILL, None là thư mục tạm của hệ thống
+        :param weights: dict nhãn -> số nhiệm vụ được lấy mỗi lượt, mặc định 1
+        :param aging: số lần một mức ưu tiên có nhiệm vụ bị bỏ qua trước khi được chạy một nhiệm vụ,
+            None là ưu tiên tuyệt đối
+        """
+        if overflow not in (OVERFLOW_POLICY.BLOCK, OVERFLOW_POLICY.REJECT, OVERFLOW_POLICY.DROP_OLDEST,
+                            OVERFLOW_POLICY.CALLER_RUNS, OVERFLOW_POLICY.SPILL):
+            raise NotImplementedError('overflow=%s' % overflow)
+        self._tasks = FairQueue(queue_size, weights, aging)
+        self._results = deque(maxlen=max_results)
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+        self._spill = SpillQueue(spill_dir) if overflow == OVERFLOW_POLICY.SPILL else None
         if logger is None:
             logger = logging.getLogger('ThreadPool-Logger')
             logger.setLevel(logging.DEBUG)
@@ -34,94 +214,227 @@ class ThreadPool:
             formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
             ch.setFormatter(formatter)
             logger.addHandler(ch)
-        for _ in range(num_workers):
-            self.Worker(self._tasks, logger, self._results)
+        self.logger = logger
+        self.min_workers = min_workers if min_workers is not None else num_workers
+        if self.min_workers is None:
+            raise ValueError('num_workers or min_workers must be set')
+        self.max_workers = max(self.min_workers, max_workers if max_workers is not None else self.min_workers)
+        self.elastic = self.max_workers > self.min_workers
+        self.keep_alive = keep_alive
+        self.scale_wait = scale_wait
+        self.scale_depth = scale_depth
+        self._lock = Lock()
+        self._workers = 0
+        self._idle = 0
+        for _ in range(self.min_workers):
+            self._spawn()
 
     def set_logger(self, logger):
-        self.Worker.logger = logger
-
-    def add_task(self, func, *args, **kargs) -> object:
+        self.logger = logger
+
+    @property
+    def num_workers(self):
+        """ số worker đang chạy """
+        return self._workers
+
+    def _spawn(self):
+        with self._lock:
+            if self._workers >= self.max_workers:
+                return
+            self._workers += 1
+        self.Worker(self)
+
+    def _scale_up(self, waited=False):
+        """ thêm worker nếu nhiệm vụ đã chờ lâu mà không còn worker rảnh, hoặc số nhiệm vụ chờ vượt số
+        worker rảnh từ scale_depth trở lên """
+        if self._workers >= self.max_workers:
+            return
+        if (waited and not self._idle) or self._tasks.qsize() - self._idle >= self.scale_depth:
+            self._spawn()
+
+    def add_task(self, func, *args, **kargs) -> Future:
         """ Thêm một tác vụ vào hàng đợi
         :param func:
         :param args:
         :param kargs:
-        :return:
+        :return: Future của tác vụ
         """
-        self._tasks.put((func, args, kargs))
-        return self.Worker.get_function_id(func, args, kargs)
+        return self.submit(func, args, kargs)
+
+    def submit(self, func, args=(), kargs=None, label=None, priority=PRIORITY.NORMAL) -> Future:
+        """ Thêm một tác vụ vào hàng đợi kèm nhãn và mức ưu tiên
+        :param label: nhãn để chia lượt công bằng, None là tên hàm
+        :param priority: một giá trị của PRIORITY
+        :return: Future của tác vụ
+        """
+        if label is None:
+            label = getattr(func, '__name__', None)
+        future = Future()
+        item = (future, func, args, kargs or {}, time.time(), priority, label)
+        if self._spill is not None and len(self._spill):
+            # còn nhiệm vụ trên đĩa thì nhiệm vụ mới cũng phải xếp sau để giữ thứ tự FIFO
+            self._overflow(item)
+        else:
+            try:
+                self._tasks.put_nowait(item)
+            except Full:
+                if self.elastic:
+                    self._scale_up()
+                self._overflow(item)
+        if self.elastic:
+            self._scale_up()
+        return future
+
+    def _overflow(self, item):
+        future, func, args, kargs = item[:4]
+        if self.overflow == OVERFLOW_POLICY.BLOCK:
+            try:
+                self._tasks.put(item, timeout=self.block_timeout)
+            except Full:
+                raise TaskRejectedError('queue of %s is full after %ss' % (func.__name__, self.block_timeout))
+        elif self.overflow == OVERFLOW_POLICY.REJECT:
+            raise TaskRejectedError('queue of %s is full' % func.__name__)
+        elif self.overflow == OVERFLOW_POLICY.DROP_OLDEST:
+            while True:
+                try:
+                    self._tasks.put_nowait(item)
+                    return
+                except Full:
+                    pass
+                # nhãn có nhiều nhiệm vụ chờ nhất ở làn ưu tiên thấp nhất bị bỏ trước
+                dropped = self._tasks.drop()
+                if dropped is None:
+                    continue
+                dropped[0].set_exception(TaskRejectedError('task %s is dropped' % dropped[1].__name__))
+                self._tasks.task_done()
+        elif self.overflow == OVERFLOW_POLICY.CALLER_RUNS:
+            _run_task(future, func, args, kargs, self.logger)
+        else:
+            try:
+                self._spill.push(future, func, args, kargs, item[4:])
+            except Exception as ex:
+                raise TaskRejectedError('task %s can not be spilled: %s' % (func.__name__, ex))
+            # worker có thể đã rảnh hết trước khi nhiệm vụ được ghi ra đĩa
+            self._spill.refill(self._tasks)
 
     def map(self, func, args_list) -> list:
         """ Thêm một danh sách các nhiệm vụ vào hàng đợi
         :param func:
         :param args_list: danh sách tham số
-        :return:
+        :return: danh sách Future theo thứ tự của args_list
         """
-        ids = []
+        futures = []
         for args in args_list:
-            ids.append(self.add_task(func, *args))
-        return ids
+            futures.append(self.add_task(func, *args))
+        return futures
 
     def wait_all_tasks_done(self):
-        """ Chờ hoàn thành tất cả các nhiệm vụ trong hàng đợi """
+        """ Chờ hoàn thành tất cả các nhiệm vụ trong hàng đợi
+        :return: dict Future -> kết quả của tối đa max_results nhiệm vụ thành công gần nhất
+        """
         self._tasks.join()
-        res = self._results
-        self._results = {}
+        res = {}
+        while self._results:
+            future = self._results.popleft()
+            if future._exception is None:
+                res[future] = future._result
         return res
 
-    def thread(self, f):
-        """ chuyển hàm được gọi trở thành Thread để chạy ngầm """
+    def thread(self, f=None, label=None, priority=PRIORITY.NORMAL):
+        """ chuyển hàm được gọi trở thành Thread để chạy ngầm, hàm trả về Future
+        dùng @pool.thread hoặc @pool.thread(label=..., priority=...)
+        :param label: nhãn của nhiệm vụ, hoặc hàm label(args, kargs) tính nhãn từ tham số của lần gọi
+        :param priority: một giá trị của PRIORITY
+        """
+
+        def wrapper(func):
+            @wraps(func)
+            def decorated(*args, **kargs):
+                task_label = label(args, kargs) if callable(label) else label
+                return self.submit(func, args, kargs, task_label, priority)
 
-        @wraps(f)
-        def decorated(*args, **kargs):
-            return self.add_task(f, *args, **kargs)
+            return decorated
 
-        return decorated
+        if f is not None:
+            return wrapper(f)
+        return wrapper
 
     class Worker(Thread):
-        """ Thread thực hiện nhiệm vụ từ một hàng đợi nhiệm vụ nhất định """
+        """ Thread thực hiện nhiệm vụ từ hàng đợi nhiệm vụ của pool """
 
-        def __init__(self, tasks, logger, results):
+        def __init__(self, pool):
             Thread.__init__(self)
-            self.results = results
-            self.tasks = tasks
-            self.logger = logger
+            self.pool = pool
+            self.results = pool._results
+            self.tasks = pool._tasks
+            self.spill = pool._spill
             self.daemon = True
             self.start()
 
         def run(self):
-            """ hàm thực hiện nhiệm vụ và ghi kết quả vào result
+            """ hàm thực hiện nhiệm vụ và ghi kết quả vào Future
                 quá trình thực hiện nếu lỗi được ghi log nếu logger != None
             """
+            pool = self.pool
             while True:
-                func, args, kargs = self.tasks.get()
+                if pool.elastic:
+                    item = self._next_elastic()
+                    if item is None:
+                        return
+                else:
+                    item = self.tasks.get()
+                future, func, args, kargs, enqueued_at = item[:5]
+                if pool.elastic and enqueued_at is not None and time.time() - enqueued_at > pool.scale_wait:
+                    pool._scale_up(waited=True)
                 try:
-                    func_id = self.get_function_id(func, args, kargs)
-                    result = func(*args, **kargs)
-                    self.results[func_id] = result
-                except Exception as ex:
-                    if self.logger is None:
-                        print(ex)
-                    else:
-                        line = '=================================================================='
-                        if args is ():
-                            self.logger.exception('Exception in thread %s\n%s :: %s' %
-                                                  (line, str(datetime.datetime.now()), func.__name__))
-                        else:
-                            self.logger.exception('Exception in thread %s\n%s :: %s with param %r' %
-                                                  (line, str(datetime.datetime.now()), func.__name__, args))
+                    _run_task(future, func, args, kargs, pool.logger)
                 finally:
+                    # deque có maxlen nên Future cũ tự bị bỏ
+                    self.results.append(future)
+                    # chuyển nhiệm vụ trên đĩa vào chỗ vừa trống trước khi task_done để join không trả về sớm
+                    if self.spill is not None:
+                        self.spill.refill(self.tasks)
                     # Đánh dấu công việc này là xong, dù có ngoại lệ xảy ra hay không
                     self.tasks.task_done()
-                    if len(self.results.keys()) > 99:
-                        key = self.results.keys()[0]
-                        self.results.__delete__(key)
 
-        @staticmethod
-        def get_function_id(func, args, kargs=None):
-            identify = "{function} {agrs} ".format(
-                function=func.__name__,
-                agrs="args %r kargs %r" % (args, kargs))
-            return hashlib.md5(identify.encode('utf-8')).hexdigest()
+        def _next_elastic(self):
+            """ lấy nhiệm vụ tiếp theo, trả về None nếu worker rảnh quá keep_alive và được thu hồi """
+            pool = self.pool
+            while True:
+                with pool._lock:
+                    pool._idle += 1
+                try:
+                    item = self.tasks.get(timeout=pool.keep_alive)
+                except Empty:
+                    with pool._lock:
+                        pool._idle -= 1
+                        if pool._workers > pool.min_workers:
+                            pool._workers -= 1
+                            return None
+                    continue
+                with pool._lock:
+                    pool._idle -= 1
+                return item
+
+
+def _run_task(future, func, args, kargs, logger):
+    """ thực hiện nhiệm vụ và ghi kết quả vào Future, lỗi được ghi log nếu logger != None """
+    try:
+        result = func(*args, **kargs)
+    except Exception as ex:
+        if logger is None:
+            print(ex)
+        else:
+            line = '=================================================================='
+            if args is ():
+                logger.exception('Exception in thread %s\n%s :: %s' %
+                                 (line, str(datetime.datetime.now()), func.__name__))
+            else:
+                logger.exception('Exception in thread %s\n%s :: %s with param %r' %
+                                 (line, str(datetime.datetime.now()), func.__name__, args))
+        future.set_exception(ex)
+    else:
+        future.set_result(result)
 
 
 # ------------------Test------------------------
@@ -171,16 +484,14 @@ if __name__ == "__main__":
     # Thêm các công việc với số lượng lớn vào thread.
     # Hoặc bạn có thể sử dụng `pool.add_task` để thêm
     # các công việc đơn lẻ.
-    t_func_ids = t_pool.map(wait_delay, t_delays)
+    t_futures = t_pool.map(wait_delay, t_delays)
     # thêm một nhiệm vụ đơn lẻ
-    t_func_id = t_pool.add_task(wait_delay, 16, 8)
-
-    # đợi cho đến khi tất cả nhiệm vụ được hoàn thành
-    t_results = t_pool.wait_all_tasks_done()
-    # kiểm tra kết quả
-    for t_id in t_func_ids:
-        print('function %s result %r' % (t_id, t_results[t_id]))
-    print('function %s result %r' % (t_func_id, t_results[t_func_id]))
+    t_future = t_pool.add_task(wait_delay, 16, 8)
+
+    # kiểm tra kết quả theo thứ tự hoàn thành
+    for t_done in as_completed(t_futures):
+        print('function result %r' % t_done.result())
+    print('function result %r' % t_future.result(timeout=10))
 
     # gọi hàm có lỗi
     func_error2(1)
@@ -0,0 +1,143 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*-
+""" Hàng đợi nhiệm vụ có làn ưu tiên và chia lượt công bằng theo nhãn cho ThreadPool.
+
+    Mỗi nhiệm vụ mang một mức ưu tiên (PRIORITY) và một nhãn (vd label của subscribe, tên scheduler).
+    Làn có ưu tiên cao hơn được lấy trước, nhưng một làn đang có nhiệm vụ mà bị bỏ qua aging lần liên
+    tiếp sẽ được lấy một nhiệm vụ, nên làn thấp vẫn chạy khi làn cao luôn bận. Trong cùng một làn, các
+    nhãn đang có nhiệm vụ được phục vụ xoay vòng, mỗi lượt một nhãn được lấy tối đa weight nhiệm vụ
+    (weighted round robin), nên một nhãn đẩy vào rất nhiều nhiệm vụ cũng chỉ chiếm phần của nó.
+    Thứ tự FIFO được giữ trong từng nhãn.
+"""
+from collections import deque
+from queue import Queue
+
+
+class PRIORITY:
+    HIGH = 0
+    NORMAL = 1
+    LOW = 2
+
+
+# số lần một làn có nhiệm vụ bị bỏ qua trước khi được lấy một nhiệm vụ
+AGING_DEFAULT = 8
+
+
+class _Lane(object):
+    __slots__ = ('queues', 'active', 'credit', 'skipped')
+
+    def __init__(self):
+        # nhãn -> deque nhiệm vụ
+        self.queues = {}
+        # các nhãn đang có nhiệm vụ theo thứ tự tới lượt
+        self.active = deque()
+        # số nhiệm vụ nhãn ở đầu active còn được lấy trong lượt này
+        self.credit = 0
+        # số lần liên tiếp làn có nhiệm vụ nhưng làn khác được lấy
+        self.skipped = 0
+
+
+class FairQueue(Queue):
+    """ Queue có cùng giao diện với queue.Queue, phần tử là tuple có mức ưu tiên và nhãn ở hai vị trí cuối
+
+    >>> q = FairQueue(weights={'a': 2})
+    >>> for item in [('a1', PRIORITY.NORMAL, 'a'), ('a2', PRIORITY.NORMAL, 'a'), ('a3', PRIORITY.NORMAL, 'a'),
+    ...              ('b1', PRIORITY.NORMAL, 'b'), ('h1', PRIORITY.HIGH, 'c')]:
+    ...     q.put(item)
+    >>> [q.get()[0] for _ in range(5)]
+    ['h1', 'a1', 'a2', 'b1', 'a3']
+
+    Làn NORMAL luôn đầy vẫn không chặn được làn LOW:
+
+    >>> q = FairQueue(aging=3)
+    >>> q.put(('low', PRIORITY.LOW, 'subscribe'))
+    >>> q.put(('low', PRIORITY.LOW, 'subscribe'))
+    >>> served = []
+    >>> for i in range(8):
+    ...     q.put(('normal', PRIORITY.NORMAL, 'api'))
+    ...     served.append(q.get()[0])
+    >>> served
+    ['normal', 'normal', 'normal', 'low', 'normal', 'normal', 'normal', 'low']
+    """
+
+    def __init__(self, maxsize=0, weights=None, aging=AGING_DEFAULT):
+        """
+        :param aging: số lần một làn có nhiệm vụ bị bỏ qua trước khi được lấy một nhiệm vụ, None là
+            ưu tiên tuyệt đối (làn thấp chỉ chạy khi các làn cao rỗng)
+        """
+        self.weights = dict(weights or {})
+        self.aging = aging
+        Queue.__init__(self, maxsize)
+
+    def _init(self, maxsize):
+        self._lanes = {}
+        self._count = 0
+
+    def _qsize(self):
+        return self._count
+
+    def _put(self, item):
+        priority, label = item[-2], item[-1]
+        lane = self._lanes.get(priority)
+        if lane is None:
+            lane = self._lanes[priority] = _Lane()
+        items = lane.queues.get(label)
+        if items is None:
+            items = lane.queues[label] = deque()
+            lane.active.append(label)
+        items.append(item)
+        self._count += 1
+
+    def _get(self):
+        active = sorted(p for p, lane in self._lanes.items() if lane.active)
+        priority = active[0]
+        if self.aging is not None:
+            for p in active[1:]:
+                if self._lanes[p].skipped >= self.aging:
+                    priority = p
+                    break
+            for p in active:
+                if p == priority:
+                    self._lanes[p].skipped = 0
+                else:
+                    self._lanes[p].skipped += 1
+        lane = self._lanes[priority]
+        label = lane.active[0]
+        if lane.credit <= 0:
+            lane.credit = self.weights.get(label, 1)
+        items = lane.queues[label]
+        item = items.popleft()
+        lane.credit -= 1
+        if not items:
+            del lane.queues[label]
+            lane.active.popleft()
+            lane.credit = 0
+        elif lane.credit <= 0:
+            lane.active.rotate(-1)
+        self._count -= 1
+        return item
+
+    def drop(self):
+        """
+        lấy ra một nhiệm vụ để bỏ khi hàng đợi đầy: nhiệm vụ cũ nhất của nhãn có nhiều nhiệm vụ chờ nhất
+        trong làn ưu tiên thấp nhất, nên nhãn gây tràn bị bỏ trước
+        :return: nhiệm vụ hoặc None nếu hàng đợi rỗng
+        """
+        with self.mutex:
+            lanes = [p for p, lane in self._lanes.items() if lane.active]
+            if not lanes:
+                return None
+            lane = self._lanes[max(lanes)]
+            label = max(lane.active, key=lambda name: len(lane.queues[name]))
+            items = lane.queues[label]
+            item = items.popleft()
+            if not items:
+                del lane.queues[label]
+                if lane.active[0] == label:
+                    lane.credit = 0
+                lane.active.remove(label)
+                if not lane.active:
+                    lane.skipped = 0
+            self._count -= 1
+            self.not_full.notify()
+            return item
@@ -0,0 +1,280 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*-
+""" ProcessPool: chạy nhiệm vụ nặng CPU trong các tiến trình con để không tranh GIL với thread phục vụ request.
+
+    Có cùng giao diện add_task/submit/map/thread/wait_all_tasks_done với ThreadPool và cũng trả về Future.
+    - Các tiến trình con được tạo khi có nhiệm vụ đầu tiên và được dùng lại cho mọi nhiệm vụ sau
+      (max_tasks_per_child để thay tiến trình sau một số nhiệm vụ nếu cần giải phóng bộ nhớ).
+    - Nhiệm vụ được pickle trước khi gửi, nhiệm vụ không pickle được (lambda, hàm lồng, method của đối
+      tượng chứa lock/kết nối...) được chạy trong một ThreadPool dự phòng thay vì báo lỗi.
+    - Tham số kiểu bytes/bytearray/memoryview lớn hơn shared_threshold byte được ghi vào một file mmap
+      trong /dev/shm và tiến trình con đọc trực tiếp từ đó, không phải truyền qua pipe.
+    Nhãn và mức ưu tiên được nhận để tương thích với ThreadPool nhưng nhiệm vụ được chạy theo thứ tự gửi.
+"""
+import datetime
+import logging
+import mmap
+import multiprocessing
+import os
+import pickle
+import sys
+import tempfile
+import threading
+from collections import deque
+from functools import wraps
+
+from src.libs.thread_pool import RESULTS_MAX_DEFAULT, Future, PRIORITY, ThreadPool
+
+SHARED_THRESHOLD_DEFAULT = 1024 * 1024
+SHARED_DIR_DEFAULT = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+START_METHOD_DEFAULT = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+
+class SharedArg(object):
+    """ tham số được đặt trong file mmap, tiến trình con dựng lại đúng kiểu ban đầu """
+    __slots__ = ('path', 'kind')
+
+    def __init__(self, path, kind):
+        self.path = path
+        self.kind = kind
+
+    def __getstate__(self):
+        return self.path, self.kind
+
+    def __setstate__(self, state):
+        self.path, self.kind = state
+
+    @classmethod
+    def create(cls, value, directory):
+        fd, path = tempfile.mkstemp(prefix='process-pool-', suffix='.arg', dir=directory)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(value)
+        return cls(path, type(value).__name__)
+
+    def load(self):
+        with open(self.path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return self._cast(b'')
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.kind == 'memoryview':
+            # không sao chép, mmap được đóng khi không còn tham chiếu
+            return memoryview(mapped)
+        try:
+            return self._cast(mapped[:])
+        finally:
+            mapped.close()
+
+    def _cast(self, data):
+        if self.kind == 'bytearray':
+            return bytearray(data)
+        if self.kind == 'memoryview':
+            return memoryview(data)
+        return data
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class _FunctionRef(object):
+    """ tham chiếu tới hàm gốc của một hàm được bọc bởi ProcessPool.thread, vì tên của hàm gốc trong
+    module đã trỏ tới hàm bọc nên không pickle hàm gốc trực tiếp được """
+
+    def __init__(self, func):
+        self.module = func.__module__
+        self.qualname = func.__qualname__
+        self.__name__ = func.__name__
+
+    def __call__(self, *args, **kargs):
+        target = sys.modules.get(self.module) or __import__(self.module, fromlist=['_'])
+        for name in self.qualname.split('.'):
+            target = getattr(target, name)
+        return getattr(target, '__wrapped__', target)(*args, **kargs)
+
+
+def _run_pickled(payload):
+    """ chạy trong tiến trình con """
+    func, args, kargs = pickle.loads(payload)
+    args = [arg.load() if isinstance(arg, SharedArg) else arg for arg in args]
+    kargs = {k: v.load() if isinstance(v, SharedArg) else v for k, v in kargs.items()}
+    return func(*args, **kargs)
+
+
+class ProcessPool:
+    """ Pool của tiến trình con có cùng giao diện với ThreadPool
+
+    # >>> pool = ProcessPool(num_workers=4)
+    # >>> future = pool.add_task(zlib.compress, big_bytes)
+    # >>> future.result(timeout=10)
+    """
+
+    def __init__(self, num_workers=None, logger=None, max_results=RESULTS_MAX_DEFAULT, max_tasks_per_child=None,
+                 shared_threshold=SHARED_THRESHOLD_DEFAULT, shared_dir=SHARED_DIR_DEFAULT,
+                 start_method=START_METHOD_DEFAULT):
+        """
+        :param num_workers: số tiến trình con, None là số CPU
+        :param max_tasks_per_child: số nhiệm vụ mỗi tiến trình con chạy trước khi được thay, None là không thay
+        :param shared_threshold: tham số bytes lớn hơn số byte này được truyền qua file mmap, None là không dùng
+        :param shared_dir: thư mục chứa file mmap của tham số
+        :param start_method: cách tạo tiến trình con của multiprocessing, mặc định forkserver để không fork
+            tiến trình đang có nhiều thread
+        """
+        self.num_workers = num_workers or os.cpu_count() or 1
+        self.max_tasks_per_child = max_tasks_per_child
+        self.shared_threshold = shared_threshold
+        self.shared_dir = shared_dir
+        self.start_method = start_method
+        if logger is None:
+            logger = logging.getLogger('ThreadPool-Logger')
+        self.logger = logger
+        self._results = deque(maxlen=max_results)
+        self._pool = None
+        self._fallback = None
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._all_done = threading.Condition(self._lock)
+        # tên các hàm không pickle được, để chỉ ghi log một lần cho mỗi hàm phải chạy bằng thread
+        self._unpicklable = set()
+
+    def set_logger(self, logger):
+        self.logger = logger
+        if self._fallback is not None:
+            self._fallback.set_logger(logger)
+
+    def _get_pool(self):
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    context = multiprocessing.get_context(self.start_method)
+                    self._pool = context.Pool(self.num_workers, maxtasksperchild=self.max_tasks_per_child)
+        return self._pool
+
+    def _get_fallback(self):
+        if self._fallback is None:
+            with self._lock:
+                if self._fallback is None:
+                    self._fallback = ThreadPool(self.num_workers, logger=self.logger)
+        return self._fallback
+
+    def add_task(self, func, *args, **kargs) -> Future:
+        """ Thêm một tác vụ để chạy trong tiến trình con
+        :return: Future của tác vụ
+        """
+        return self.submit(func, args, kargs)
+
+    def submit(self, func, args=(), kargs=None, label=None, priority=PRIORITY.NORMAL) -> Future:
+        """ Thêm một tác vụ, label và priority chỉ để tương thích với ThreadPool
+        :return: Future của tác vụ
+        """
+        kargs = kargs or {}
+        shared = []
+        try:
+            payload = pickle.dumps((func, self._share(args, shared), self._share(kargs, shared)),
+                                   pickle.HIGHEST_PROTOCOL)
+        except Exception as ex:
+            for arg in shared:
+                arg.remove()
+            return self._run_in_thread(func, args, kargs, label, priority, ex)
+        future = Future()
+        with self._lock:
+            self._pending += 1
+
+        def on_done(result):
+            future.set_result(result)
+            self._finish(future, shared)
+
+        def on_error(ex):
+            self.logger.error('Exception in process %s\n%s :: %s with param %r: %r' %
+                              ('==================================================================',
+                               str(datetime.datetime.now()), getattr(func, '__name__', func), args, ex))
+            future.set_exception(ex)
+            self._finish(future, shared)
+
+        try:
+            self._get_pool().apply_async(_run_pickled, (payload,), callback=on_done, error_callback=on_error)
+        except Exception as ex:
+            on_error(ex)
+        return future
+
+    def _share(self, args, shared):
+        """ thay các tham số bytes lớn bằng SharedArg """
+        if self.shared_threshold is None:
+            return args
+
+        def share(value):
+            if isinstance(value, (bytes, bytearray, memoryview)) and len(value) >= self.shared_threshold:
+                arg = SharedArg.create(value, self.shared_dir)
+                shared.append(arg)
+                return arg
+            return value
+
+        if isinstance(args, dict):
+            return {k: share(v) for k, v in args.items()}
+        return tuple(share(arg) for arg in args)
+
+    def _run_in_thread(self, func, args, kargs, label, priority, ex):
+        name = getattr(func, '__qualname__', None) or repr(type(func))
+        if name not in self._unpicklable:
+            self._unpicklable.add(name)
+            print("ProcessPool: %s can not be pickled (%s), run it in threads"
+                  % (getattr(func, '__name__', func), ex))
+        return self._get_fallback().submit(func, args, kargs, label, priority)
+
+    def _finish(self, future, shared):
+        for arg in shared:
+            arg.remove()
+        self._results.append(future)
+        with self._lock:
+            self._pending -= 1
+            if not self._pending:
+                self._all_done.notify_all()
+
+    def map(self, func, args_list) -> list:
+        """ Thêm một danh sách các nhiệm vụ
+        :return: danh sách Future theo thứ tự của args_list
+        """
+        return [self.add_task(func, *args) for args in args_list]
+
+    def wait_all_tasks_done(self):
+        """ Chờ hoàn thành tất cả các nhiệm vụ
+        :return: dict Future -> kết quả của tối đa max_results nhiệm vụ thành công gần nhất
+        """
+        with self._lock:
+            while self._pending:
+                self._all_done.wait()
+        res = {}
+        if self._fallback is not None:
+            res.update(self._fallback.wait_all_tasks_done())
+        while self._results:
+            future = self._results.popleft()
+            if future._exception is None:
+                res[future] = future._result
+        return res
+
+    def thread(self, f=None, label=None, priority=PRIORITY.NORMAL):
+        """ chuyển hàm được gọi thành nhiệm vụ chạy trong tiến trình con, hàm trả về Future
+        dùng @pool.thread hoặc @pool.thread(label=..., priority=...), hàm phải được khai báo ở mức module
+        """
+
+        def wrapper(func):
+            ref = _FunctionRef(func)
+
+            @wraps(func)
+            def decorated(*args, **kargs):
+                task_label = label(args, kargs) if callable(label) else label
+                return self.submit(ref, args, kargs, task_label, priority)
+
+            return decorated
+
+        if f is not None:
+            return wrapper(f)
+        return wrapper
+
+    def close(self):
+        """ dừng nhận nhiệm vụ và chờ các tiến trình con kết thúc """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
@@ -0,0 +1,89 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*-
+""" Hàng đợi tràn ra đĩa cho ThreadPool với chính sách OVERFLOW_POLICY.SPILL.
+
+    Khi hàng đợi trong bộ nhớ đầy, nhiệm vụ (func, args, kargs) được pickle và ghi nối vào một file
+    tạm (mỗi bản ghi gồm độ dài uint32 và dữ liệu), chỉ Future của nhiệm vụ được giữ trong bộ nhớ.
+    Mỗi khi worker làm xong một nhiệm vụ, các bản ghi trên đĩa được chuyển lại vào hàng đợi theo thứ
+    tự FIFO tới khi hàng đợi đầy. File được cắt về rỗng khi đã đọc hết. Nhiệm vụ trên đĩa không được
+    chạy lại sau khi tiến trình khởi động lại vì Future của nó đã mất.
+"""
+import os
+import pickle
+import struct
+import tempfile
+import threading
+from collections import OrderedDict
+from queue import Full
+
+_LENGTH = struct.Struct('<I')
+
+
+class SpillQueue(object):
+    def __init__(self, directory=None, prefix='thread-pool-'):
+        fd, self.path = tempfile.mkstemp(prefix=prefix, suffix='.spill', dir=directory)
+        self._file = os.fdopen(fd, 'r+b')
+        self._read_offset = 0
+        self._write_offset = 0
+        self._futures = OrderedDict()
+        self._seq = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._futures)
+
+    def push(self, future, func, args, kargs, meta=()):
+        """
+        ghi nhiệm vụ ra đĩa
+        :param meta: các giá trị còn lại của phần tử trong hàng đợi (thời điểm thêm, mức ưu tiên, nhãn),
+            được giữ trong bộ nhớ cùng Future
+        :raise pickle.PicklingError, TypeError, AttributeError: nếu nhiệm vụ không pickle được
+        """
+        data = pickle.dumps((func, args, kargs), pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._seq += 1
+            self._file.seek(self._write_offset)
+            self._file.write(_LENGTH.pack(len(data)))
+            self._file.write(data)
+            self._write_offset = self._file.tell()
+            self._futures[self._seq] = (future, meta)
+
+    def refill(self, tasks):
+        """ chuyển nhiệm vụ từ đĩa vào hàng đợi tasks tới khi hết hoặc hàng đợi đầy, trả về số nhiệm vụ đã chuyển """
+        if not self._futures:
+            return 0
+        moved = 0
+        with self._lock:
+            while self._futures:
+                seq = next(iter(self._futures))
+                self._file.seek(self._read_offset)
+                length, = _LENGTH.unpack(self._file.read(_LENGTH.size))
+                data = self._file.read(length)
+                try:
+                    func, args, kargs = pickle.loads(data)
+                except Exception as ex:
+                    self._advance()
+                    self._futures.pop(seq)[0].set_exception(ex)
+                    continue
+                try:
+                    future, meta = self._futures[seq]
+                    tasks.put_nowait((future, func, args, kargs) + meta)
+                except Full:
+                    break
+                del self._futures[seq]
+                self._advance()
+                moved += 1
+        return moved
+
+    def _advance(self):
+        self._read_offset = self._file.tell()
+        if self._read_offset >= self._write_offset:
+            # đã đọc hết, cắt file để không phình mãi
+            self._file.seek(0)
+            self._file.truncate()
+            self._read_offset = self._write_offset = 0
+
+    def close(self):
+        self._file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -37,6 +37,12 @@ class NLP_APP_STRUCTURE:
     CACHE_EXPIRED_TIME_DEFAULT = 24 * 3600
     MAX_CACHE = 'max_cache'
     MAX_CACHE_DEFAULT = 102400
+    MAX_CACHE_BYTES = 'max_cache_bytes'
+    CACHE_SNAPSHOT_INTERVAL = 'cache_snapshot_interval'
+    CACHE_SNAPSHOT_INTERVAL_DEFAULT = 300
+    # lru, tinylfu hoặc arc
+    CACHE_POLICY = 'cache_policy'
+    CACHE_POLICY_DEFAULT = 'tinylfu'
 
 
 class PERMITTED_STRUCTURE:
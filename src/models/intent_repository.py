@@ -8,9 +8,10 @@
 
 import hashlib
 
+from src.common import DMAI_CACHE_SNAPSHOT_DIR
 from src.common.lang_config import LANG
 from src.common.my_except import InputNotFoundError
-from src.libs.caching import LRUCacheDict
+from src.libs.caching import CacheSnapshot, LRUCacheDict, deep_sizeof
 from src.libs.singleton import Singleton
 from src.models import BOT_STRUCTURE, NLP_APP_STRUCTURE
 from src.models.bot_config_repository import BotConfigRepository
@@ -44,6 +45,13 @@ class IntentRepository:
         except KeyError:
             raise InputNotFoundError(LANG.NOT_EXIST, 'bot_id', bot_id)
 
+    def get_cache_usage(self):
+        """
+        lấy thông tin sử dụng caching của từng nlp app, dùng để tính max_cache_bytes trong bots.json
+        :return: dict theo nlp key gồm số intent, số byte đang dùng và giới hạn byte
+        """
+        return {key: intent.get_cache_usage() for key, intent in self._intent_dic.items()}
+
     class Intent:
         """ lớp tạo caching để lưu trữ các intent """
 
@@ -58,7 +66,23 @@ class IntentRepository:
             if NLP_APP_STRUCTURE.MAX_CACHE not in nlp_config:
                 self.nlp_config[NLP_APP_STRUCTURE.MAX_CACHE] = NLP_APP_STRUCTURE.MAX_CACHE_DEFAULT
             self.my_cache = LRUCacheDict(max_size=self.nlp_config[NLP_APP_STRUCTURE.MAX_CACHE],
-                                         expiration=self.nlp_config[NLP_APP_STRUCTURE.CACHE_EXPIRED_TIME])
+                                         expiration=self.nlp_config[NLP_APP_STRUCTURE.CACHE_EXPIRED_TIME],
+                                         concurrent=True,
+                                         max_bytes=self.nlp_config.get(NLP_APP_STRUCTURE.MAX_CACHE_BYTES),
+                                         size_estimator=deep_sizeof,
+                                         policy=self.nlp_config.get(NLP_APP_STRUCTURE.CACHE_POLICY,
+                                                                    NLP_APP_STRUCTURE.CACHE_POLICY_DEFAULT))
+            # khởi động lại vẫn dùng được các intent đã cache, snapshot được ghi định kỳ và khi tắt,
+            # các worker dùng chung file nên chỉ một worker ghi, các worker khác chỉ nạp
+            self.snapshot = CacheSnapshot(self.my_cache, self._snapshot_path(),
+                                          interval=self.nlp_config.get(
+                                              NLP_APP_STRUCTURE.CACHE_SNAPSHOT_INTERVAL,
+                                              NLP_APP_STRUCTURE.CACHE_SNAPSHOT_INTERVAL_DEFAULT)).start()
+
+        def _snapshot_path(self):
+            """ tên file snapshot theo md5 của nlp key để không lộ key trên đĩa """
+            name = hashlib.md5(self.nlp_config[NLP_APP_STRUCTURE.KEY].encode('utf-8')).hexdigest()
+            return '%s/intent_%s.snapshot' % (DMAI_CACHE_SNAPSHOT_DIR, name)
 
         def _create_key(self, message):
             """
@@ -88,3 +112,12 @@ class IntentRepository:
                 return self.my_cache[self._create_key(message)]
             except KeyError:
                 return None
+
+        def get_cache_usage(self):
+            """ lấy số intent và số byte đang được lưu trong caching """
+            return {
+                'size': self.my_cache.size(),
+                'bytes': self.my_cache.bytes_size(),
+                NLP_APP_STRUCTURE.MAX_CACHE: self.my_cache.max_size,
+                NLP_APP_STRUCTURE.MAX_CACHE_BYTES: self.my_cache.max_bytes
+            }
@@ -9,7 +9,7 @@ import time
 @Singleton
 class SchedulerFactory:
 
-    thread_pool = ThreadPool(num_workers=8)
+    thread_pool = ThreadPool(min_workers=1, max_workers=16)
 
     def __init__(self):
         self.schedulers = {}
@@ -38,6 +38,7 @@ class SchedulerFactory:
             schedule.run_pending()
             time.sleep(1)
 
-    @thread_pool.thread
+    # chia lượt theo tên scheduler
+    @thread_pool.thread(label=lambda args, kwargs: args[1].__class__.__name__)
     def owner_run_scheduler(self, scheduler: BaseScheduler):
         scheduler.do()